@@ -1,19 +1,20 @@
 import logging
 from aiogram import F, Router, Bot
 from aiogram.enums import ParseMode
-from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
 import config as cfg
 from app.handlers import show_main_menu
-from database.db import Database
+from loader import db, membership, analytics
+import app.keyboard_cache as keyboard_cache
 import app.keyboards as kb
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, date, timedelta
 from config import TOKEN, ADMINS
 from redis.asyncio import Redis
 
-db = Database(cfg.db_config)
 router = Router()
 
 
@@ -32,35 +33,127 @@ async def admin_panel(message: Message):
     await message.answer("Добро пожаловать в админ-панель:", reply_markup=kb.admin)
 
 
-@router.callback_query(F.data == "admin_analytics")
-async def admin_analytics(callback: CallbackQuery):
-    await callback.answer("Admin Analytics")
+# Загрузка пула MySQL: если ожидание соединения растёт, пул пора увеличить (DB_POOL_MAXSIZE)
+@router.message(Command("db_pool"), F.from_user.id.in_(cfg.ADMINS))
+async def db_pool_stats(message: Message):
+    stats = db.get_pool_stats()
+    await message.answer(
+        "🗄 <b>Пул MySQL:</b>\n\n"
+        f"Соединений: {stats['size']} (свободно {stats['free']}, максимум {stats['maxsize']})\n"
+        f"Выдано соединений: {stats['acquired']}\n"
+        f"Ожидание соединения: среднее {stats['avg_wait_ms']:.2f} мс, p99 {stats['p99_wait_ms']:.2f} мс, "
+        f"максимум {stats['max_wait_ms']:.2f} мс",
+        parse_mode=ParseMode.HTML
+    )
+
+
+# Кэши клавиатур и подписок: процент попаданий и сколько запросов к Bot API не пришлось отправлять
+@router.message(Command("cache_stats"), F.from_user.id.in_(cfg.ADMINS))
+async def cache_stats(message: Message):
+    lines = ["🧩 <b>Кэш клавиатур:</b>\n"]
+    for stats in (keyboard_cache.task_keyboards.stats(), keyboard_cache.channel_keyboards.stats()):
+        lines.append(f"{stats['name'].capitalize()}: вариантов {stats['size']}, попаданий {stats['hits']}, "
+                     f"промахов {stats['misses']} ({stats['hit_rate']:.1%})")
+    lines.append(f"\nПропущено лишних правок клавиатуры: {keyboard_cache.skipped_edits}")
+    stats = membership.stats()
+    lines.append(f"Проверки подписки: из кэша {stats['hits']}, через Bot API {stats['misses']} "
+                 f"({stats['hit_rate']:.1%} из кэша), в индексе {stats['indexed_users']} пользователей")
+    await message.answer("\n".join(lines), parse_mode=ParseMode.HTML)
+
+
+async def render_analytics(callback: CallbackQuery, refresh=False):
     try:
-        stats = await db.get_detailed_user_statistics()
-        total_referral_bonus = await db.calculate_total_referral_bonuses()
-        total_referrals = await db.count_total_referrals()
-        active_referrers = await db.count_active_referrers()  # Подсчет активных реферов
+        if refresh:
+            await analytics.refresh()
+        stats, taken_at = await analytics.get()
+        age = int(datetime.now().timestamp() - taken_at)
+        # DAU / MAU есть, только если доступны HyperLogLog-счётчики; их оценка — со стандартной ошибкой 0,81%
+        hll_line = (f"📅 <b>DAU / MAU:</b> {stats['dau']} / {stats['mau']} "
+                    f"(оценка HyperLogLog, ±{analytics.active_users.error:.2%})\n" if "dau" in stats else "")
 
         analytics_data = (
             "📊 <b>Пользовательская аналитика:</b>\n\n"
             f"👥 <b>Всего пользователей:</b> {stats['total_users']}\n"
             f"🟢 <b>Активные пользователи (за последнюю неделю):</b> {stats['active_users']}\n"
+            f"{hll_line}"
             f"🆕 <b>Новые пользователи (за последнюю неделю):</b> {stats['new_users']}\n"
             f"💰 <b>Среднее количество бонусов на пользователя:</b> {stats['average_bonus_per_user']:.2f}\n"
             f"🏅 <b>Всего бонусов:</b> {stats['total_bonus']}\n"
-            f"🔗 <b>Общая сумма бонусов по рефералам:</b> {total_referral_bonus}\n"
-            f"👫 <b>Общее число рефералов:</b> {total_referrals}\n"
-            f"🤝 <b>Активные реферы (кто привлёк хотя бы одного реферала):</b> {active_referrers}\n"
+            f"🔗 <b>Общая сумма бонусов по рефералам:</b> {stats['total_referral_bonus']}\n"
+            f"👫 <b>Общее число рефералов:</b> {stats['total_referrals']}\n"
+            f"🤝 <b>Активные реферы (кто привлёк хотя бы одного реферала):</b> {stats['active_referrers']}\n"
             f"✅ <b>Выполненные задачи (добавить $CLOWN к имени):</b> {stats['task_name_completed']}\n"
             f"✅ <b>Выполненные задачи (подписка на канал):</b> {stats['task_subscribe_completed']}\n"
-            f"✅ <b>Выполненные задачи (пригласить друзей):</b> {stats['task_invite_completed']}"
+            f"✅ <b>Выполненные задачи (пригласить друзей):</b> {stats['task_invite_completed']}\n\n"
+            f"🕒 <i>Данные на {datetime.fromtimestamp(taken_at):%H:%M:%S} ({age // 60} мин {age % 60} с назад)</i>"
         )
-        await callback.message.edit_text(analytics_data, parse_mode=ParseMode.HTML, reply_markup=kb.admin_back)
+        await callback.message.edit_text(analytics_data, parse_mode=ParseMode.HTML, reply_markup=kb.admin_analytics)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
     except Exception as e:
         logging.error(f"Error fetching analytics: {str(e)}")
         await callback.message.edit_text(f"Ошибка при получении аналитики: {str(e)}")
 
 
+def parse_history_range(args):
+    """ «/history» — 30 дней, «/history 90» — N дней, «/history 2024-05-01 2024-05-31» — диапазон """
+    parts = (args or "").split()
+    if len(parts) == 2:
+        return date.fromisoformat(parts[0]), date.fromisoformat(parts[1])
+    days = int(parts[0]) if parts else 30
+    if not 1 <= days <= 366:
+        raise ValueError("число дней должно быть от 1 до 366")
+    today = date.today()
+    return today - timedelta(days=days - 1), today
+
+
+# Историческая статистика из дневных агрегатов daily_stats: таблица users не сканируется
+@router.message(Command("history"), F.from_user.id.in_(cfg.ADMINS))
+async def history(message: Message, command: CommandObject):
+    try:
+        start_day, end_day = parse_history_range(command.args)
+    except ValueError as e:
+        await message.answer(f"Не понял период: {e}\nПримеры: /history, /history 90, /history 2024-05-01 2024-05-31")
+        return
+    await ensure_db_connection()
+    days = await db.rollups.get_days(start_day, end_day)
+    languages = await db.rollups.get_languages(start_day, end_day)
+
+    lines = [f"📈 <b>Статистика с {start_day:%d.%m.%Y} по {end_day:%d.%m.%Y}</b>\n"]
+    if days:
+        dau = [day['active_users'] for day in days]
+        lines.append(f"🆕 Регистраций: {sum(day['registrations'] for day in days)}, "
+                     f"из них по рефералам: {sum(day['referrals'] for day in days)}")
+        # Точный DAU по daily_active_users: те же апдейты, что и у оценки HyperLogLog на экране аналитики
+        lines.append(f"🟢 DAU (точно): в среднем {sum(dau) / len(dau):.0f}, максимум {max(dau)}")
+        lines.append(f"🏅 Начислено бонусов: {sum(day['bonus_points'] for day in days)}\n")
+    for row in languages:
+        lines.append(f"🗣 {row['language'] or 'без языка'}: регистраций {row['registrations']}, "
+                     f"рефералов {row['referrals']}, бонусов {row['bonus_points']}")
+    # По дням выводим не больше 31 строки, чтобы сообщение уложилось в лимит Telegram
+    if days:
+        lines.append("\n<b>По дням</b> (регистрации / DAU / бонусы):")
+        for day in days[-31:]:
+            lines.append(f"{day['day']:%d.%m}: {day['registrations']} / {day['active_users']} / {day['bonus_points']}")
+    else:
+        lines.append("Данных за этот период нет.")
+    await message.answer("\n".join(lines), parse_mode=ParseMode.HTML)
+
+
+# Экран показывает готовый снимок из AnalyticsCache; «Пересчитать» делает новый проход по users
+@router.callback_query(F.data == "admin_analytics")
+async def admin_analytics(callback: CallbackQuery):
+    await callback.answer("Admin Analytics")
+    await render_analytics(callback)
+
+
+@router.callback_query(F.data == "admin_analytics_refresh")
+async def admin_analytics_refresh(callback: CallbackQuery):
+    await callback.answer("Пересчитываем…")
+    await render_analytics(callback, refresh=True)
+
+
 @router.callback_query(F.data == "admin_panel_back")
 async def back_admin(callback: CallbackQuery):
     await callback.answer("Back")
@@ -124,7 +217,7 @@ async def export_users(callback: CallbackQuery):
         await ensure_db_connection()
         query = "SELECT * FROM users"
 
-        async with db.pool.acquire() as conn:
+        async with db.acquire() as conn:
             async with conn.cursor() as cursor:
                 await cursor.execute(query)
                 data = await cursor.fetchall()
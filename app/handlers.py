@@ -5,15 +5,16 @@ from aiogram.enums import ChatAction, ParseMode
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, ChatMemberUpdated
 import app.keyboards as kb
 import app.keyboardsEN as kbe
 import config as cfg
 from database.db import Database
-from aiogram.exceptions import TelegramBadRequest
+from database.tasks import is_completed
+from app.keyboard_cache import task_keyboards, channel_keyboards, edit_reply_markup_if_changed
+from loader import suppression, db, membership
 
 router = Router()
-db = Database(cfg.db_config)
 
 russian_main_text = (
     "Мем-коины давно превратились в одну большую клоунскую индустрию 🤡\n\n"
@@ -51,6 +52,12 @@ async def send_welcome(message: Message, state: FSMContext):
     await db.update_last_activity(message.from_user.id)
     await ensure_db_connection()
     user_id = message.from_user.id
+
+    # Пользователь снова написал боту — возвращаем его в рассылки
+    try:
+        await suppression.remove(user_id)
+    except Exception as e:
+        logging.error(f"Ошибка при снятии блокировки рассылки для пользователя {user_id}: {e}")
     tg_name = message.from_user.username
     args = message.text.split()
 
@@ -78,13 +85,9 @@ async def send_welcome(message: Message, state: FSMContext):
         logging.info(f"Adding new user: {user_id}, Referer ID: {referer_id}")
         await db.add_user(user_id, referer_id, tg_name)
 
-    # Начисление бонусов при подписке
-    if referer_id and (new_user or not await db.is_bonus_awarded(user_id)):
-        logging.info(f"User {user_id} is now subscribed. Adding referral bonuses.")
-        await db.increment_referral_count(referer_id)
-        await db.add_bonus(referer_id, 300)  # Начисление бонусов рефереру
-        await db.add_bonus(user_id, 100)  # Начисление бонусов рефералу
-        await db.mark_bonus_awarded(user_id)  # Отметить, что бонусы были начислены
+    # Начисление бонусов новому пользователю: проверка и оба начисления — одна транзакция
+    if new_user and referer_id and await db.award_referral(user_id, cfg.REFERER_BONUS, cfg.REFERRAL_BONUS):
+        logging.info(f"User {user_id} is now subscribed. Referral bonuses added.")
 
     language = await db.get_user_language(user_id)
     if not language:
@@ -106,7 +109,7 @@ async def check_subscription_handler_main(callback_query: CallbackQuery, state:
 
     logging.info(f"Checking subscription for user {user_id}. Referer ID: {referer_id}")
 
-    if await check_subscription_main(callback_query.bot, user_id, main_channel_id):
+    if await check_subscription_main(callback_query.bot, user_id, main_channel_id, recheck_negative=True):
         await callback_query.message.delete()
 
         # Если пользователь подписан на канал, но реферал не добавлен
@@ -116,12 +119,8 @@ async def check_subscription_handler_main(callback_query: CallbackQuery, state:
             logging.info(f"Adding new user: {user_id}, Referer ID: {referer_id}")
             await db.add_user(user_id, referer_id, tg_name)
 
-        if referer_id and not await db.is_bonus_awarded(user_id):
-            logging.info(f"User {user_id} is now subscribed. Adding referral bonuses.")
-            await db.increment_referral_count(referer_id)
-            await db.add_bonus(referer_id, 300)  # Начисление бонусов рефереру
-            await db.add_bonus(user_id, 100)  # Начисление бонусов рефералу
-            await db.mark_bonus_awarded(user_id)  # Отметить, что бонусы были начислены
+        if referer_id and await db.award_referral(user_id, cfg.REFERER_BONUS, cfg.REFERRAL_BONUS):
+            logging.info(f"User {user_id} is now subscribed. Referral bonuses added.")
 
         await send_welcome(callback_query.message, state)  # Call the welcome function again after successful subscription
     else:
@@ -132,14 +131,13 @@ async def check_subscription_handler_main(callback_query: CallbackQuery, state:
         await callback_query.message.answer("Доступ есть только клоунам\nOnly clowns have access 🤡", reply_markup=keyboard)
         await callback_query.answer()
 
-async def check_subscription_main(bot: Bot, user_id: int, channel_id: int):
-    try:
-        member = await bot.get_chat_member(channel_id, user_id)
-        logging.info(f"User {user_id} status in channel {channel_id}: {member.status}")
-        return member.status in ["member", "administrator", "creator"]
-    except Exception as e:
-        logging.error(f"Ошибка при проверке подписки для пользователя {user_id} в канале {channel_id}: {e}")
-        return False
+async def check_subscription_main(bot: Bot, user_id: int, channel_id: int, recheck_negative=False):
+    return await membership.is_member(bot, channel_id, user_id, recheck_negative)
+
+# Вступления и выходы в каналах проекта сразу попадают в индекс подписок (бот должен быть админом канала)
+@router.chat_member(F.chat.id.in_(membership.channels))
+async def channel_member_updated(event: ChatMemberUpdated):
+    await membership.store(event.chat.id, event.new_chat_member.user.id, event.new_chat_member.status)
 
 @router.message(Command("change_language"))
 async def command_change_language(message: Message, state: FSMContext):
@@ -200,6 +198,9 @@ async def back(callback: CallbackQuery):
     await callback.message.delete()
     await show_main_menu(callback.message, "ru")
 
+def format_rank(rank):
+    return f"{rank[0]} из {rank[1]}" if rank else "—"
+
 @router.callback_query(F.data == "profile_ru")
 async def profile(callback: CallbackQuery):
     await db.update_last_activity(callback.from_user.id)
@@ -211,12 +212,17 @@ async def profile(callback: CallbackQuery):
     tg_name = callback.from_user.username or "Не указано"
     num_referals = await db.count_referals(user_id)
     bonus = await db.get_bonus_points(user_id)
+    language = await db.get_user_language(user_id)
+    rank = await db.get_user_rank(user_id)
+    language_rank = await db.get_user_rank(user_id, language) if language else None
 
     profile_info = (
         "<b>Эй, Клоун, вот твой профиль?!</b>\n\n"
         f"🤡 <b>Имя:</b> @{tg_name}\n"
         f"🤝 <b>Количество рефералов:</b> {num_referals}\n"
-        f"🎁 <b>Количество бонусов:</b> {bonus}"
+        f"🎁 <b>Количество бонусов:</b> {bonus}\n"
+        f"🏆 <b>Место в рейтинге:</b> {format_rank(rank)}\n"
+        f"🗣 <b>Место среди клоунов твоего языка:</b> {format_rank(language_rank)}"
     )
     await callback.message.delete()
     await callback.answer("Ваш профиль")
@@ -329,40 +335,35 @@ async def ensure_db_connection():
             raise Exception("Failed to connect to the database")
         print("Database connected successfully.")
 
-async def check_and_award_all_subscriptions(bot: Bot, user_id: int, db: Database):
-    if await check_all_subscriptions(bot, user_id) and not await db.is_task_completed(user_id, "task_subscribe_completed"):
+async def check_and_award_all_subscriptions(bot: Bot, user_id: int, db: Database, subscriptions=None):
+    # subscriptions — уже полученный в этом апдейте вектор подписок, чтобы не проверять каналы второй раз
+    if subscriptions is None:
+        subscriptions = await membership.check_memberships(bot, user_id)
+    if all(subscriptions) and not await db.is_task_completed(user_id, "task_subscribe_completed"):
         bonus_amount = 2000  # Общий бонус за подписку на все каналы
-        await db.add_bonus(user_id, bonus_amount)
-        await db.mark_task_completed(user_id, "task_subscribe_completed")
-        return True
+        return await db.complete_task_and_award(user_id, "task_subscribe_completed", bonus_amount)
     return False
 
 async def check_all_subscriptions(bot: Bot, user_id: int):
-    all_subscribed = True
-    for _, channel_id, _ in cfg.CHANNELS:
-        member = await bot.get_chat_member(channel_id, user_id)
-        if member.status not in ["member", "administrator", "creator"]:
-            all_subscribed = False
-            break
-    return all_subscribed
+    return all(await membership.check_memberships(bot, user_id))
 
 
 async def is_chat_boosted(bot: Bot, user_id: int):
-    try:
-        chat_member = await bot.get_chat_member(cfg.BOOST_CHAT_ID, user_id)
-        if chat_member.status in ["member", "administrator", "creator"]:
-            return True
-    except Exception as e:
-        logging.error(f"Error checking chat boost for user {user_id}: {e}")
-    return False
+    # Вызывается по кнопке проверки: «не подписан» из индекса перепроверяем в Bot API
+    return await membership.is_member(bot, cfg.BOOST_CHAT_ID, user_id, recheck_negative=True)
 
 async def get_task_keyboard(user_id):
     await ensure_db_connection()
-    task_name_completed = await db.is_task_completed(user_id, "task_name_completed")
-    task_subscribe_completed = await db.is_task_completed(user_id, "task_subscribe_completed")
-    task_invite_completed = await db.is_task_completed(user_id, "task_invite_completed")
-    # task_repost_completed = await db.is_task_completed(user_id, "task_repost_completed")
-    task_boost_completed = await db.is_task_completed(user_id, "task_boost_completed")
+    # Все флаги заданий приходят одним чтением битовой маски, готовая клавиатура — из кэша по (язык, маска)
+    task_flags = await db.get_task_flags(user_id)
+    return task_keyboards.get(("ru", task_flags), lambda: build_task_keyboard(task_flags))
+
+def build_task_keyboard(task_flags):
+    task_name_completed = is_completed(task_flags, "task_name_completed")
+    task_subscribe_completed = is_completed(task_flags, "task_subscribe_completed")
+    task_invite_completed = is_completed(task_flags, "task_invite_completed")
+    # task_repost_completed = is_completed(task_flags, "task_repost_completed")
+    task_boost_completed = is_completed(task_flags, "task_boost_completed")
 
     task_keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -429,22 +430,20 @@ async def task_name_2000(callback: CallbackQuery):
     user_id = callback.from_user.id
     await ensure_db_connection()
     if await db.is_task_completed(user_id, "task_name_completed"):
-        await callback.answer("This task has already been completed.", show_alert=True)
+        await callback.answer("Это задание уже выполнено.", show_alert=True)
         return
 
     reward_points = 2000
-    task_keyboard = await get_task_keyboard(user_id)
 
     user_profile = await callback.bot.get_chat_member(callback.message.chat.id, user_id)
     if "clown" in (user_profile.user.full_name or "").lower():
-        await db.add_bonus(user_id, reward_points)
-        await db.mark_task_completed(user_id, "task_name_completed")
+        # Одновременные нажатия начислят бонус только один раз
+        if not await db.complete_task_and_award(user_id, "task_name_completed", reward_points):
+            await callback.answer("Это задание уже выполнено.", show_alert=True)
+            return
         await callback.answer(f"Вы успешно добавили $CLOWN к своему имени и заработали баллы {reward_points}.", show_alert=True)
-        try:
-            await callback.message.edit_reply_markup(reply_markup=task_keyboard)
-        except TelegramBadRequest as e:
-            if "message is not modified" not in str(e):
-                raise e
+        task_keyboard = await get_task_keyboard(user_id)
+        await edit_reply_markup_if_changed(callback.message, task_keyboard)
     else:
         await callback.answer("В вашем имени нет $CLOWN Задание не было выполнено.", show_alert=True)
 
@@ -470,12 +469,16 @@ async def check_subscription_handler(callback_query: CallbackQuery):
     await ensure_db_connection()
     user_id = callback_query.from_user.id
 
-    if await check_and_award_all_subscriptions(callback_query.bot, user_id, db):
+    # Один вектор подписок и для начисления бонуса, и для клавиатуры каналов; «не подписан» перепроверяем в Bot API
+    subscriptions = await membership.check_memberships(callback_query.bot, user_id, recheck_negative=True)
+    if await check_and_award_all_subscriptions(callback_query.bot, user_id, db, subscriptions):
         message = "Вы подписаны на все каналы и получили 2000 бонусных очков!"
-        await callback_query.message.answer(message, reply_markup=await get_task_keyboard(user_id))
+        keyboard = await get_task_keyboard(user_id)
     else:
         message = "Вы не подписаны на все каналы. Пожалуйста, подпишитесь для получения бонуса."
-        await callback_query.message.answer(message, reply_markup=await get_task_keyboard(user_id))
+        keyboard = (await get_task_keyboard(user_id) if all(subscriptions)
+                    else await get_channels_keyboard(callback_query.bot, user_id, subscriptions))
+    await callback_query.message.answer(message, reply_markup=keyboard)
 
     await callback_query.answer()
 
@@ -492,9 +495,7 @@ async def task_invite_friends(callback: CallbackQuery):
     referral_link = f"https://t.me/{cfg.bot_name}?start={referral_code}"
 
     if referals_count >= required_referals:
-        if not await db.is_task_completed(user_id, "task_invite_completed"):
-            await db.add_bonus(user_id, reward_points)
-            await db.mark_task_completed(user_id, "task_invite_completed")
+        if await db.complete_task_and_award(user_id, "task_invite_completed", reward_points):
             response_text = f"Вы успешно пригласили {required_referals} друзей и заработали {reward_points} очков! Всего приглашено: {referals_count}."
         else:
             response_text = f"Вы уже выполнили это задание. Всего приглашено: {referals_count}."
@@ -590,16 +591,6 @@ async def task_already_completed(callback: CallbackQuery):
 #     await state.update_data(message_id=response_message.message_id)
 #     await state.clear()
 
-async def is_chat_boosted(bot, user_id):
-    chat_id = "-1002087214352"  # ID вашего чата
-    try:
-        chat_member = await bot.get_chat_member(chat_id, user_id)
-        if chat_member.is_boosted:
-            return True
-    except Exception as e:
-        logging.error(f"Error checking chat boost for user {user_id}: {e}")
-    return False
-
 from aiogram.types import ChatBoostUpdated
 
 @router.chat_boost()
@@ -670,9 +661,7 @@ async def check_boost(callback: CallbackQuery):
 
     try:
         if await is_user_boosting_chat(callback.bot, user_id, chat_id):
-            if not await db.is_task_completed(user_id, "task_boost_completed"):
-                await db.add_bonus(user_id, reward_points)
-                await db.mark_task_completed(user_id, "task_boost_completed")
+            if await db.complete_task_and_award(user_id, "task_boost_completed", reward_points):
                 response_text = f"Буст успешно проверен! Вы заработали {reward_points} очков!"
                 logger.info(f"User {user_id} received {reward_points} bonus points for boosting the chat.")
             else:
@@ -694,19 +683,17 @@ async def check_boost(callback: CallbackQuery):
 
 
 async def check_subscription(bot: Bot, user_id: int, channel_id: int):
-    try:
-        member = await bot.get_chat_member(channel_id, user_id)
-        return member.status in ["member", "administrator", "creator"]
-    except Exception as e:
-        logging.error(f"Ошибка при проверке подписки: {e}")
-        return False
+    return await membership.is_member(bot, channel_id, user_id)
 
-async def get_channels_keyboard(bot: Bot, user_id: int):
+async def get_channels_keyboard(bot: Bot, user_id: int, subscriptions=None):
     await ensure_db_connection()
-    is_subscribed_clown_token = await check_subscription(bot, user_id, '-1002087214352')
-    is_subscribed_clown_chat = await check_subscription(bot, user_id, '-1002212790090')
-    is_subscribed_clown_tokenton = await check_subscription(bot, user_id, '-1002178525662')
-    is_subscribed_clown_chat_EN = await check_subscription(bot, user_id, '-1002197074859')
+    # Каналы проверяются параллельно; вариантов клавиатуры столько, сколько комбинаций подписок — собираем каждую один раз
+    if subscriptions is None:
+        subscriptions = await membership.check_memberships(bot, user_id)
+    return channel_keyboards.get(("ru", subscriptions), lambda: build_channels_keyboard(*subscriptions))
+
+def build_channels_keyboard(is_subscribed_clown_token, is_subscribed_clown_chat, is_subscribed_clown_tokenton,
+                            is_subscribed_clown_chat_EN):
 
     channels_keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [
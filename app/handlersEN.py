@@ -13,10 +13,12 @@ from app.handlers import show_main_menu
 import app.keyboardsEN as kbe
 import config as cfg
 from database.db import Database
+from database.tasks import is_completed
+from app.keyboard_cache import task_keyboards, channel_keyboards, edit_reply_markup_if_changed
+from loader import suppression, db, membership
 from aiogram.exceptions import TelegramBadRequest
 
 router = Router()
-db = Database(cfg.db_config)
 
 english_main_text = (
     "Meme-coins have long turned into one big clown industry 🤡\n\n"
@@ -42,6 +44,12 @@ async def send_welcome(message: Message, state: FSMContext):
     await db.update_last_activity(message.from_user.id)
     await ensure_db_connection()
     user_id = message.from_user.id
+
+    # Пользователь снова написал боту — возвращаем его в рассылки
+    try:
+        await suppression.remove(user_id)
+    except Exception as e:
+        logging.error(f"Error removing mailing suppression for user {user_id}: {e}")
     tg_name = message.from_user.username
     args = message.text.split()
 
@@ -65,10 +73,9 @@ async def send_welcome(message: Message, state: FSMContext):
     new_user = not await db.user_exists(user_id)
     if new_user:
         await db.add_user(user_id, referer_id, tg_name)
-        await db.increment_referral_count(referer_id)
-        await db.add_bonus(referer_id, 300)
-        await db.add_bonus(user_id, 100)
-        await db.mark_bonus_awarded(user_id)
+        # Только новому пользователю: бонус достаётся рефереру, записанному при регистрации
+        if referer_id:
+            await db.award_referral(user_id, cfg.REFERER_BONUS, cfg.REFERRAL_BONUS)
 
     language = await db.get_user_language(user_id)
     if not language:
@@ -88,7 +95,7 @@ async def check_subscription_handler(callback_query: CallbackQuery, state: FSMCo
     data = await state.get_data()
     referer_id = data.get('referer_id')
 
-    if await check_subscription_EN(callback_query.bot, user_id, cfg.CHANNELS[0][1]):
+    if await check_subscription_EN(callback_query.bot, user_id, cfg.CHANNELS[0][1], recheck_negative=True):
         await callback_query.message.delete()
 
         # Если пользователь новый
@@ -96,29 +103,17 @@ async def check_subscription_handler(callback_query: CallbackQuery, state: FSMCo
         if new_user:
             tg_name = data.get('tg_name')
             await db.add_user(user_id, referer_id, tg_name)
-            await db.increment_referral_count(referer_id)
-            await db.add_bonus(referer_id, 300)
-            await db.add_bonus(user_id, 100)
-            await db.mark_bonus_awarded(user_id)
-        
-        # Если пользователь уже существует и бонусы еще не начислены
-        elif referer_id and not await db.is_bonus_awarded(user_id):
-            await db.increment_referral_count(referer_id)
-            await db.add_bonus(referer_id, 300)
-            await db.add_bonus(user_id, 100)
-            await db.mark_bonus_awarded(user_id)
+
+        # Бонусы начисляются один раз и рефереру из базы: award_referral проверяет флаг в одной транзакции
+        if referer_id:
+            await db.award_referral(user_id, cfg.REFERER_BONUS, cfg.REFERRAL_BONUS)
 
         await send_welcome(callback_query.message, state)
     else:
         await callback_query.answer("You are not subscribed to the main channel. Please subscribe to continue.")
 
-async def check_subscription_EN(bot: Bot, user_id: int, channel_id: int):
-    try:
-        member = await bot.get_chat_member(channel_id, user_id)
-        return member.status in ["member", "administrator", "creator"]
-    except Exception as e:
-        logging.error(f"Error checking subscription: {e}")
-        return False
+async def check_subscription_EN(bot: Bot, user_id: int, channel_id: int, recheck_negative=False):
+    return await membership.is_member(bot, channel_id, user_id, recheck_negative)
     
 
 @router.callback_query(F.data == "back_en")
@@ -130,6 +125,9 @@ async def back(callback: CallbackQuery):
         pass
     await show_main_menu(callback.message, "en")
 
+def format_rank(rank):
+    return f"{rank[0]} of {rank[1]}" if rank else "—"
+
 @router.callback_query(F.data == "profile_en")
 async def profile(callback: CallbackQuery):
     await callback.bot.send_chat_action(chat_id=callback.from_user.id, action=ChatAction.TYPING)
@@ -138,12 +136,17 @@ async def profile(callback: CallbackQuery):
     tg_name = callback.from_user.username or "Not specified"
     num_referrals = await db.count_referals(user_id)
     bonus = await db.get_bonus_points(user_id)
+    language = await db.get_user_language(user_id)
+    rank = await db.get_user_rank(user_id)
+    language_rank = await db.get_user_rank(user_id, language) if language else None
 
     profile_info = (
         "<b>Hey Clown, here's your profile?!</b>\n\n"
         f"🤡 <b>Name:</b> @{tg_name}\n"
         f"🤝 <b>Number of referrals:</b> {num_referrals}\n"
-        f"🎁 <b>Number of bonus points:</b> {bonus}"
+        f"🎁 <b>Number of bonus points:</b> {bonus}\n"
+        f"🏆 <b>Leaderboard rank:</b> {format_rank(rank)}\n"
+        f"🗣 <b>Rank among clowns of your language:</b> {format_rank(language_rank)}"
     )
     try:
         await callback.message.delete()
@@ -235,10 +238,15 @@ async def top10(callback: CallbackQuery):
 
 async def get_task_keyboard_en(user_id):
     await ensure_db_connection()
-    task_name_completed = await db.is_task_completed(user_id, "task_name_completed")
-    task_subscribe_completed = await db.is_task_completed(user_id, "task_subscribe_completed")
-    task_invite_completed = await db.is_task_completed(user_id, "task_invite_completed")
-    task_boost_completed = await db.is_task_completed(user_id, "task_boost_completed")
+    # Все флаги заданий приходят одним чтением битовой маски, готовая клавиатура — из кэша по (язык, маска)
+    task_flags = await db.get_task_flags(user_id)
+    return task_keyboards.get(("en", task_flags), lambda: build_task_keyboard_en(task_flags))
+
+def build_task_keyboard_en(task_flags):
+    task_name_completed = is_completed(task_flags, "task_name_completed")
+    task_subscribe_completed = is_completed(task_flags, "task_subscribe_completed")
+    task_invite_completed = is_completed(task_flags, "task_invite_completed")
+    task_boost_completed = is_completed(task_flags, "task_boost_completed")
 
     task_keyboard_en = InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -296,35 +304,31 @@ async def task_name_2000(callback: CallbackQuery):
         return
 
     reward_points = 2000
-    task_keyboard = await get_task_keyboard_en(user_id)
 
     user_profile = await callback.bot.get_chat_member(callback.message.chat.id, user_id)
     if "clown" in (user_profile.user.full_name or "").lower():
-        await db.add_bonus(user_id, reward_points)
-        await db.mark_task_completed(user_id, "task_name_completed")
+        # Одновременные нажатия начислят бонус только один раз
+        if not await db.complete_task_and_award(user_id, "task_name_completed", reward_points):
+            await callback.answer("You have already completed this task.", show_alert=True)
+            return
         await callback.answer(f"You have successfully added $CLOWN to your name and earned {reward_points} points!", show_alert=True)
-        try:
-            await callback.message.edit_reply_markup(reply_markup=task_keyboard)
-        except TelegramBadRequest as e:
-            if "message is not modified" not in str(e):
-                raise e
+        task_keyboard = await get_task_keyboard_en(user_id)
+        await edit_reply_markup_if_changed(callback.message, task_keyboard)
     else:
         await callback.answer("Your name does not contain '$CLOWN'. The task was not completed.", show_alert=True)
 
 async def check_subscription(bot: Bot, user_id: int, channel_id: int):
-    try:
-        member = await bot.get_chat_member(channel_id, user_id)
-        return member.status in ["member", "administrator", "creator"]
-    except Exception as e:
-        logging.error(f"Error checking subscription: {e}")
-        return False
+    return await membership.is_member(bot, channel_id, user_id)
 
-async def get_channels_keyboard(bot: Bot, user_id: int):
+async def get_channels_keyboard(bot: Bot, user_id: int, subscriptions=None):
     await ensure_db_connection()
-    is_subscribed_clown_token = await check_subscription(bot, user_id, cfg.CHANNELS[0][1])
-    is_subscribed_clown_chat = await check_subscription(bot, user_id, cfg.CHANNELS[1][1])
-    is_subscribed_clown_tokenton = await check_subscription(bot, user_id, cfg.CHANNELS[2][1])
-    is_subscribed_clown_chat_EN = await check_subscription(bot, user_id, cfg.CHANNELS[3][1])
+    # Каналы проверяются параллельно; вариантов клавиатуры столько, сколько комбинаций подписок — собираем каждую один раз
+    if subscriptions is None:
+        subscriptions = await membership.check_memberships(bot, user_id)
+    return channel_keyboards.get(("en", subscriptions), lambda: build_channels_keyboard(*subscriptions))
+
+def build_channels_keyboard(is_subscribed_clown_token, is_subscribed_clown_chat, is_subscribed_clown_tokenton,
+                            is_subscribed_clown_chat_EN):
 
     channels_keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -369,31 +373,34 @@ async def task_subscribe_500(callback: CallbackQuery):
         await callback.message.answer("You have already completed this task.")
     await callback.answer()
 
-async def check_and_award_all_subscriptions(bot: Bot, user_id: int, db: Database):
-    if await check_all_subscriptions(bot, user_id) and not await db.is_task_completed(user_id, "task_subscribe_completed"):
+async def check_and_award_all_subscriptions(bot: Bot, user_id: int, db: Database, subscriptions=None):
+    # subscriptions — уже полученный в этом апдейте вектор подписок, чтобы не проверять каналы второй раз
+    if subscriptions is None:
+        subscriptions = await membership.check_memberships(bot, user_id)
+    if all(subscriptions) and not await db.is_task_completed(user_id, "task_subscribe_completed"):
         bonus_amount = 2000  # Общий бонус за подписку на все каналы
-        await db.add_bonus(user_id, bonus_amount)
-        await db.mark_task_completed(user_id, "task_subscribe_completed")
-        return True
+        return await db.complete_task_and_award(user_id, "task_subscribe_completed", bonus_amount)
     return False
 
 async def check_all_subscriptions(bot: Bot, user_id: int):
-    for _, channel_id, _ in cfg.CHANNELS:
-        if not await check_subscription(bot, user_id, channel_id):
-            return False
-    return True
+    return all(await membership.check_memberships(bot, user_id))
 
 @router.callback_query(F.data == "checksub_en")
 async def check_subscription_handler(callback_query: CallbackQuery):
     await ensure_db_connection()
     user_id = callback_query.from_user.id
 
-    if await check_and_award_all_subscriptions(callback_query.bot, user_id, db):
+    # Один вектор подписок и для начисления бонуса, и для клавиатуры каналов; «не подписан» перепроверяем в Bot API
+    subscriptions = await membership.check_memberships(callback_query.bot, user_id, recheck_negative=True)
+    if await check_and_award_all_subscriptions(callback_query.bot, user_id, db, subscriptions):
         message = "You are subscribed to all channels and received 2000 bonus points!"
+        keyboard = await get_task_keyboard_en(user_id)
     else:
         message = "You are not subscribed to all channels. Please subscribe to receive your bonus."
-    
-    await callback_query.message.answer(message, reply_markup=await get_task_keyboard_en(user_id))
+        keyboard = (await get_task_keyboard_en(user_id) if all(subscriptions)
+                    else await get_channels_keyboard(callback_query.bot, user_id, subscriptions))
+
+    await callback_query.message.answer(message, reply_markup=keyboard)
     await callback_query.answer()
 
 @router.callback_query(F.data == "task_invite_friends_en")
@@ -409,9 +416,7 @@ async def task_invite_friends(callback: CallbackQuery):
     referral_link = f"https://t.me/{cfg.bot_name}?start={referral_code}"
 
     if referrals_count >= required_referrals:
-        if not await db.is_task_completed(user_id, "task_invite_completed"):
-            await db.add_bonus(user_id, reward_points)
-            await db.mark_task_completed(user_id, "task_invite_completed")
+        if await db.complete_task_and_award(user_id, "task_invite_completed", reward_points):
             response_text = f"You have successfully invited {required_referrals} friends and earned {reward_points} points! Total invited: {referrals_count}."
         else:
             response_text = f"You have already completed this task. Total invited: {referrals_count}."
@@ -459,19 +464,17 @@ async def check_boost(callback: CallbackQuery):
     await ensure_db_connection()
     user_id = callback.from_user.id
     reward_points = 2500
-    task_keyboard = await get_task_keyboard_en(user_id)
 
     await callback.message.delete()
     if await is_chat_boosted(callback.bot, user_id):
-        if not await db.is_task_completed(user_id, "task_boost_completed"):
-            await db.add_bonus(user_id, reward_points)
-            await db.mark_task_completed(user_id, "task_boost_completed")
+        if await db.complete_task_and_award(user_id, "task_boost_completed", reward_points):
             response_text = f"You have successfully boosted the chat and earned {reward_points} points!"
         else:
             response_text = "You have already completed this task."
     else:
         response_text = "You have not boosted the chat. Task not completed."
 
+    task_keyboard = await get_task_keyboard_en(user_id)
     await callback.message.answer(response_text, reply_markup=task_keyboard)
     await callback.answer()
 
@@ -497,10 +500,5 @@ async def command_change_language(message: Message, state: FSMContext):
 
 
 async def is_chat_boosted(bot: Bot, user_id: int):
-    try:
-        chat_member = await bot.get_chat_member(cfg.BOOST_CHAT_ID, user_id)
-        if chat_member.status in ["member", "administrator", "creator"]:
-            return True
-    except Exception as e:
-        logging.error(f"Error checking chat boost for user {user_id}: {e}")
-    return False
+    # Вызывается по кнопке проверки: «не подписан» из индекса перепроверяем в Bot API
+    return await membership.is_member(bot, cfg.BOOST_CHAT_ID, user_id, recheck_negative=True)
@@ -0,0 +1,52 @@
+import logging
+
+from aiogram.exceptions import TelegramBadRequest
+
+
+class KeyboardCache:
+    """ Готовые клавиатуры по сигнатуре состояния, например (язык, маска заданий): вариантов мало, собираем их один раз """
+
+    def __init__(self, name):
+        self.name = name
+        self._markups = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        markup = self._markups.get(key)
+        if markup is None:
+            self.misses += 1
+            markup = self._markups[key] = build()
+        else:
+            self.hits += 1
+        return markup
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {"name": self.name, "size": len(self._markups), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hit_rate}
+
+
+task_keyboards = KeyboardCache("задания")
+channel_keyboards = KeyboardCache("каналы")
+skipped_edits = 0
+
+
+async def edit_reply_markup_if_changed(message, markup):
+    """ Не отправляет edit_reply_markup, если у сообщения уже такая клавиатура """
+    global skipped_edits
+    if message.reply_markup == markup:
+        skipped_edits += 1
+        return False
+    try:
+        await message.edit_reply_markup(reply_markup=markup)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+        logging.info(f"Keyboard of message {message.message_id} was already up to date")
+        return False
+    return True
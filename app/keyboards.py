@@ -81,4 +81,9 @@ admin = InlineKeyboardMarkup(inline_keyboard=[
 
 admin_back = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="Назад", callback_data="admin_panel_back")]
+])
+
+admin_analytics = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔄 Пересчитать", callback_data="admin_analytics_refresh")],
+    [InlineKeyboardButton(text="Назад", callback_data="admin_panel_back")]
 ])
\ No newline at end of file
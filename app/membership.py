@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import time
+
+MEMBER_STATUSES = ("member", "administrator", "creator")
+# Слот канала в числе пользователя: младший бит — подписан, остальные 32 — когда статус проверен (unix-время, с)
+SLOT_BITS = 33
+SLOT_MASK = (1 << SLOT_BITS) - 1
+
+
+class MembershipCache:
+    """ Подписки на каналы проекта: индекс в памяти и таблица channel_members, которые наполняют апдейты chat_member.
+    Запись индекса верна не дольше ttl секунд: потом статус снова берётся из Redis или Bot API, ведь выход из канала
+    мог пройти без апдейта (бот не админ). Для прочих чатов есть только кэш в Redis """
+
+    def __init__(self, redis, channel_ids, ttl=600, negative_ttl=30, concurrency=20, pool=None, prefix="membership"):
+        self.redis = redis
+        self.channels = list(dict.fromkeys(int(channel_id) for channel_id in channel_ids))
+        self._positions = {channel_id: position for position, channel_id in enumerate(self.channels)}
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.pool = pool
+        self.prefix = prefix
+        # user_id -> слоты по SLOT_BITS бит на канал i: подписка и время её проверки.
+        # Одно число на пользователя вместо записи на каждую пару (канал, пользователь)
+        self._index = {}
+        # Общий на процесс предел одновременных get_chat_member из проверок подписки
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.hits = 0
+        self.misses = 0
+        self._sync_task = None
+
+    def _key(self, channel_id, user_id):
+        # В config id каналов строки, в апдейтах — числа: приводим к одному виду
+        return f"{self.prefix}:{int(channel_id)}:{user_id}"
+
+    def _lookup(self, channel_id, user_id):
+        position = self._positions.get(int(channel_id))
+        if position is None:
+            return None
+        slot = self._index.get(user_id, 0) >> SLOT_BITS * position & SLOT_MASK
+        verified_at = slot >> 1
+        # Незнакомый пользователь и устаревшая запись одинаково требуют проверки
+        if not verified_at or time.time() - verified_at > self.ttl:
+            return None
+        return bool(slot & 1)
+
+    def _remember(self, channel_id, user_id, is_member, verified_at=None):
+        position = self._positions.get(int(channel_id))
+        if position is None:
+            return False
+        shift = SLOT_BITS * position
+        bits = self._index.get(user_id, 0) & ~(SLOT_MASK << shift)
+        self._index[user_id] = bits | (int(verified_at or time.time()) << 1 | is_member) << shift
+        return True
+
+    async def is_member(self, bot, channel_id, user_id, recheck_negative=False):
+        """ recheck_negative — явная проверка по кнопке: «не подписан» из индекса и кэша перепроверяется в Bot API,
+        ведь подписка могла появиться без апдейта chat_member (бот не админ) и до очередной сверки """
+        known = self._lookup(channel_id, user_id)
+        if known is not None and (known or not recheck_negative):
+            self.hits += 1
+            return known
+
+        if known is None:
+            try:
+                cached = await self.redis.get(self._key(channel_id, user_id))
+            except Exception as e:
+                logging.error(f"Кэш подписок недоступен: {e}")
+                cached = None
+            if cached is not None and (cached == b"1" or not recheck_negative):
+                self.hits += 1
+                return cached == b"1"
+
+        self.misses += 1
+        try:
+            async with self._semaphore:
+                member = await bot.get_chat_member(channel_id, user_id)
+        except Exception as e:
+            # Ошибку Bot API не кэшируем: следующая проверка снова спросит Telegram
+            logging.error(f"Ошибка при проверке подписки пользователя {user_id} в канале {channel_id}: {e}")
+            return False
+        await self.store(channel_id, user_id, member.status)
+        return member.status in MEMBER_STATUSES
+
+    async def check_memberships(self, bot, user_id, channel_ids=None, recheck_negative=False):
+        """ Подписки пользователя на несколько каналов сразу: промахи индекса спрашиваются у Bot API параллельно.
+        Возвращает кортеж флагов в порядке channel_ids (по умолчанию — каналы проекта) """
+        channel_ids = self.channels if channel_ids is None else channel_ids
+        return tuple(await asyncio.gather(*(self.is_member(bot, channel_id, user_id, recheck_negative)
+                                            for channel_id in channel_ids)))
+
+    async def store(self, channel_id, user_id, status):
+        is_member = status in MEMBER_STATUSES
+        if self._remember(channel_id, user_id, is_member) and self.pool is not None:
+            try:
+                async with self.pool.acquire() as conn:
+                    async with conn.cursor() as cursor:
+                        await cursor.execute(
+                            "INSERT INTO channel_members (user_id, channel_id, status, updated_at) "
+                            "VALUES (%s, %s, %s, NOW()) "
+                            "ON DUPLICATE KEY UPDATE status = VALUES(status), updated_at = VALUES(updated_at)",
+                            (user_id, int(channel_id), status))
+                        await conn.commit()
+            except Exception as e:
+                logging.error(f"Не удалось записать подписку пользователя {user_id} в канале {channel_id}: {e}")
+        try:
+            await self.redis.set(self._key(channel_id, user_id), int(is_member),
+                                 ex=self.ttl if is_member else self.negative_ttl)
+        except Exception as e:
+            logging.error(f"Не удалось сохранить подписку пользователя {user_id} в канале {channel_id}: {e}")
+
+    async def ensure_table(self):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS channel_members (
+                        user_id BIGINT NOT NULL,
+                        channel_id BIGINT NOT NULL,
+                        status VARCHAR(16) NOT NULL,
+                        updated_at DATETIME NOT NULL,
+                        PRIMARY KEY (user_id, channel_id),
+                        KEY idx_channel_members_channel (channel_id, user_id)
+                    )
+                """)
+                await conn.commit()
+
+    async def ensure_loaded(self):
+        """ Загружает в индекс записи channel_members моложе ttl страницами по 10000 строк; время проверки
+        берётся из updated_at, так что после рестарта запись устаревает тогда же, когда устарела бы без него """
+        after = (0, 0)
+        total = 0
+        while True:
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(
+                        "SELECT user_id, channel_id, status, UNIX_TIMESTAMP(updated_at) FROM channel_members "
+                        "WHERE (user_id, channel_id) > (%s, %s) AND updated_at >= NOW() - INTERVAL %s SECOND "
+                        "ORDER BY user_id, channel_id LIMIT 10000", (*after, self.ttl))
+                    rows = await cursor.fetchall()
+            if not rows:
+                break
+            for user_id, channel_id, status, verified_at in rows:
+                self._remember(channel_id, user_id, status in MEMBER_STATUSES, verified_at)
+            total += len(rows)
+            after = rows[-1][:2]
+        logging.info(f"Индекс подписок загружен: {total} записей, {len(self._index)} пользователей")
+
+    def start_sync(self, bot, interval=3600, stale_after=86400, rate=5):
+        if self._sync_task is None:
+            self._sync_task = asyncio.create_task(self._sync_periodically(bot, interval, stale_after, rate))
+
+    async def close(self):
+        if self._sync_task:
+            self._sync_task.cancel()
+            await asyncio.gather(self._sync_task, return_exceptions=True)
+            self._sync_task = None
+
+    async def sync(self, bot, stale_after=86400, rate=5):
+        """ Дозаполняет индекс пользователями из users, которых он не видел, и перепроверяет записи старше
+        stale_after секунд — на случай пропущенных апдейтов. Не больше rate запросов к Bot API в секунду """
+        checked = 0
+        for channel_id in self.channels:
+            checked += await self._check_pages(
+                bot, channel_id, rate,
+                "SELECT u.user_id FROM users u WHERE u.user_id > %s AND NOT EXISTS ("
+                "SELECT 1 FROM channel_members m WHERE m.user_id = u.user_id AND m.channel_id = %s) "
+                "ORDER BY u.user_id LIMIT 500", (channel_id,))
+            checked += await self._check_pages(
+                bot, channel_id, rate,
+                "SELECT user_id FROM channel_members WHERE user_id > %s AND channel_id = %s "
+                "AND updated_at < NOW() - INTERVAL %s SECOND ORDER BY user_id LIMIT 500", (channel_id, stale_after))
+        return checked
+
+    async def _check_pages(self, bot, channel_id, rate, query, params):
+        checked = 0
+        after_id = 0
+        while True:
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(query, (after_id, *params))
+                    user_ids = [row[0] for row in await cursor.fetchall()]
+            if not user_ids:
+                return checked
+            for user_id in user_ids:
+                try:
+                    member = await bot.get_chat_member(channel_id, user_id)
+                except Exception as e:
+                    # Пропускаем до следующего прохода: курсор по user_id всё равно идёт дальше
+                    logging.warning(f"Не удалось сверить подписку {user_id} в канале {channel_id}: {e}")
+                else:
+                    await self.store(channel_id, user_id, member.status)
+                checked += 1
+                await asyncio.sleep(1 / rate)
+            after_id = user_ids[-1]
+
+    async def _sync_periodically(self, bot, interval, stale_after, rate):
+        while True:
+            try:
+                checked = await self.sync(bot, stale_after, rate)
+                if checked:
+                    logging.info(f"Сверка подписок: проверено {checked} записей")
+            except Exception as e:
+                logging.error(f"Сверка подписок прервана: {e}")
+            await asyncio.sleep(interval)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0,
+                "indexed_users": len(self._index)}
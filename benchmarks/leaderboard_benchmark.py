@@ -0,0 +1,126 @@
+""" Бенчмарк рейтинга: место пользователя, начисление и топ-10 на sorted set Redis
+
+Запуск из корня проекта (только на локальном Redis; ключи живут под отдельным префиксом и удаляются в конце):
+
+    python -m benchmarks.leaderboard_benchmark --users 1000000 --queries 20000
+
+Рейтинг заполняется случайными очками с длинным хвостом, как у настоящих пользователей, и языками ru/en.
+Дальше по случайным пользователям замеряются Leaderboard.rank (общий и по языку), Leaderboard.credit
+и Leaderboard.top. В конце печатаются p50/p99 задержки каждой операции и запросов в секунду.
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+import time
+
+from redis.asyncio import Redis
+
+import config
+from database.leaderboard import Leaderboard
+
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+async def seed(leaderboard, users, en_share, batch=10000):
+    rng = random.Random(0)
+    for start in range(0, users, batch):
+        points = {}
+        languages = {}
+        for user_id in range(start + 1, min(users, start + batch) + 1):
+            # Большинство набирает сотни очков, единицы — десятки тысяч
+            points[user_id] = int(rng.paretovariate(1.2) * 100)
+            languages[user_id] = "en" if rng.random() < en_share else "ru"
+        pipe = leaderboard.redis.pipeline(transaction=False)
+        pipe.zadd(leaderboard.points_key, points)
+        pipe.hset(leaderboard.languages_key, mapping=languages)
+        for language in ("ru", "en"):
+            pipe.zadd(leaderboard.language_key(language),
+                      {user_id: points[user_id] for user_id in points if languages[user_id] == language})
+        await pipe.execute()
+
+
+async def measure(name, queries, operation):
+    samples = []
+    started_at = time.perf_counter()
+    for _ in range(queries):
+        call_started_at = time.perf_counter()
+        await operation()
+        samples.append((time.perf_counter() - call_started_at) * 1000)
+    elapsed = time.perf_counter() - started_at
+    return name, {
+        "p50_ms": round(statistics.median(samples), 3),
+        "p99_ms": round(percentile(samples, 99), 3),
+        "ops_per_s": round(queries / elapsed, 1),
+    }
+
+
+async def run(args):
+    redis = Redis(host=config.redis_config['host'], port=config.redis_config['port'],
+                  password=config.redis_config['password'])
+    leaderboard = Leaderboard(redis, prefix=args.prefix)
+    rng = random.Random(1)
+    try:
+        started_at = time.perf_counter()
+        await seed(leaderboard, args.users, args.en_share)
+        seed_s = time.perf_counter() - started_at
+
+        def user_id():
+            return rng.randint(1, args.users)
+
+        results = dict([
+            await measure("rank", args.queries, lambda: leaderboard.rank(user_id())),
+            await measure("rank_language", args.queries, lambda: leaderboard.rank(user_id(), "ru")),
+            await measure("credit", args.queries, lambda: leaderboard.credit((user_id(), rng.randint(100, 2000)))),
+            await measure("top10", args.queries, lambda: leaderboard.top(10)),
+        ])
+        report = {
+            "users": args.users,
+            "queries": args.queries,
+            "seed_s": round(seed_s, 1),
+            "memory_mb": round(
+                sum([await redis.memory_usage(key) or 0 for key in (
+                    leaderboard.points_key, leaderboard.languages_key,
+                    leaderboard.language_key("ru"), leaderboard.language_key("en"))]) / 2 ** 20, 1),
+            **results,
+        }
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    finally:
+        await redis.delete(leaderboard.points_key, leaderboard.names_key, leaderboard.languages_key,
+                           leaderboard.language_key("ru"), leaderboard.language_key("en"))
+        await redis.aclose()
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарк рейтинга на sorted set Redis")
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--queries", type=int, default=20000, help="запросов на каждую операцию")
+    parser.add_argument("--en-share", type=float, default=0.3, help="доля англоязычных пользователей")
+    parser.add_argument("--prefix", default="bench_leaderboard", help="префикс ключей прогона, удаляются в конце")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if config.redis_config['host'] not in LOCAL_HOSTS:
+        print("Бенчмарк пишет в Redis миллионы записей: запускайте его только на локальном Redis", file=sys.stderr)
+        return 2
+    if args.prefix == "leaderboard":
+        print("Префикс leaderboard занят рабочим рейтингом бота", file=sys.stderr)
+        return 2
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
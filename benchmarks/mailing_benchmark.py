@@ -0,0 +1,313 @@
+""" Офлайн-бенчмарк рассылки: настоящий путь отправки против локальной заглушки Bot API
+
+Запуск из корня проекта (только на локальных MySQL и Redis и только в отдельной базе с «bench» в имени —
+её таблицы, ключи рассылки в Redis и очередь Dramatiq очищаются, поэтому нужен явный --reset):
+
+    python -m benchmarks.mailing_benchmark --database clown_bench --reset --users 5000 --latency-ms 40 --p429 0.01
+
+Заглушка на aiohttp отвечает на sendMessage/sendPhoto с заданной задержкой, изредка отдаёт 429 с retry_after
+и 403 для части пользователей. Рассылка идёт через prepare_mass_mailing и воркер Dramatiq внутри процесса,
+с теми же лимитерами, StatusWriter и шардами, что и в проде. В конце печатаются сообщений в секунду,
+p50/p99 задержки отправки, записей в базу на сообщение и повторные доставки одному пользователю.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import statistics
+import sys
+import time
+import uuid
+from collections import Counter
+
+import aiomysql
+import dramatiq
+from aiohttp import web
+
+import config
+
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+# Имя базы бенчмарка должно содержать это слово: так рабочую базу не очистить опечаткой в --database
+BENCH_DATABASE_MARK = "bench"
+SEND_METHODS = ("sendmessage", "sendphoto")
+
+
+class FakeBotApi:
+    """ Заглушка Bot API: задержка, 429 с retry_after и 403 для «заблокировавших» пользователей """
+
+    def __init__(self, latency_ms, jitter_ms, p429, retry_after, blocked_percent, seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.p429 = p429
+        self.retry_after = retry_after
+        self.blocked_percent = blocked_percent
+        self.random = random.Random(seed)
+        self.deliveries = Counter()
+        self.responses = Counter()
+        self.first_delivery = None
+        self.last_delivery = None
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    def is_blocked(self, chat_id):
+        # Один и тот же пользователь блокирует бота при каждой попытке, как в жизни
+        return chat_id % 100 < self.blocked_percent
+
+    async def handle(self, request):
+        method = request.match_info["method"].lower()
+        data = await request.post()
+        latency = max(0.0, self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms))
+        await asyncio.sleep(latency / 1000)
+
+        if method == "getme":
+            return self.ok({"id": 1, "is_bot": True, "first_name": "benchmark", "username": "benchmark_bot"})
+        if method not in SEND_METHODS:
+            return self.ok(True)
+
+        chat_id = int(data["chat_id"])
+        if self.random.random() < self.p429:
+            self.responses[429] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+        if self.is_blocked(chat_id):
+            self.responses[403] += 1
+            return web.json_response({
+                "ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user",
+            }, status=403)
+
+        self.responses[200] += 1
+        self.deliveries[chat_id] += 1
+        now = time.monotonic()
+        self.first_delivery = self.first_delivery or now
+        self.last_delivery = now
+        message = {"message_id": sum(self.deliveries.values()), "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private"}}
+        if method == "sendphoto":
+            message["photo"] = [{"file_id": data.get("photo", "photo"), "file_unique_id": "u", "width": 1,
+                                 "height": 1}]
+        else:
+            message["text"] = data.get("text", "")
+        return self.ok(message)
+
+    @staticmethod
+    def ok(result):
+        return web.json_response({"ok": True, "result": result})
+
+
+class LatencyProbe(dramatiq.Middleware):
+    """ Ставит в сессию бота каждого потока воркера замер времени запросов отправки """
+
+    def __init__(self, worker_resources, samples):
+        self.worker_resources = worker_resources
+        self.samples = samples
+
+    def after_worker_thread_boot(self, broker, thread):
+        samples = self.samples
+
+        # Регистрируется после ApiRateLimitMiddleware и поэтому стоит внутри него: ожидание лимита не попадает в замер
+        async def measure(make_request, bot, method):
+            started_at = time.perf_counter()
+            try:
+                return await make_request(bot, method)
+            finally:
+                if type(method).__name__ in ("SendMessage", "SendPhoto"):
+                    samples.append((time.perf_counter() - started_at) * 1000)
+
+        self.worker_resources.current().bot.session.middleware(measure)
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+async def db_writes(cursor):
+    await cursor.execute("SHOW GLOBAL STATUS WHERE Variable_name IN "
+                         "('Com_insert', 'Com_update', 'Com_delete', 'Com_replace')")
+    return sum(int(value) for _, value in await cursor.fetchall())
+
+
+async def seed(pool, users, en_share):
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            # Минимальные таблицы, которых касается рассылка; campaigns и campaign_shards создаёт SpamService
+            await cursor.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id BIGINT PRIMARY KEY,
+                    language VARCHAR(8) NULL
+                )
+            """)
+            await cursor.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                    user_id BIGINT NOT NULL,
+                    language VARCHAR(8) NULL,
+                    message TEXT NULL,
+                    photo VARCHAR(255) NULL,
+                    status VARCHAR(16) NOT NULL,
+                    campaign_id VARCHAR(36) NULL,
+                    UNIQUE KEY uq_messages_campaign_user (campaign_id, user_id)
+                )
+            """)
+            for table in ("users", "messages", "campaigns", "campaign_shards", "blocked_users"):
+                await cursor.execute("SHOW TABLES LIKE %s", (table,))
+                if await cursor.fetchone():
+                    await cursor.execute(f"DELETE FROM {table}")
+            rows = [(100000 + i, "en" if random.random() < en_share else "ru") for i in range(users)]
+            for start in range(0, len(rows), 5000):
+                await cursor.executemany("INSERT INTO users (user_id, language) VALUES (%s, %s)",
+                                         rows[start:start + 5000])
+            await conn.commit()
+
+
+async def reset_redis(redis):
+    # Бюджеты, паузы и битовые карты прошлых прогонов исказили бы результат
+    for pattern in ("mailing:*", "suppressed:*", "telegram:*"):
+        async for key in redis.scan_iter(match=pattern):
+            await redis.delete(key)
+
+
+async def wait_for_campaign(pool, campaign_id, timeout):
+    started_at = time.monotonic()
+    while time.monotonic() - started_at < timeout:
+        async with pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                await cursor.execute("SELECT * FROM campaigns WHERE campaign_id = %s", (campaign_id,))
+                campaign = await cursor.fetchone()
+            await conn.commit()
+        if campaign and campaign['status'] == 'done':
+            return campaign
+        await asyncio.sleep(0.5)
+    return None
+
+
+async def run(args):
+    api = FakeBotApi(args.latency_ms, args.jitter_ms, args.p429, args.retry_after, args.blocked, args.seed)
+    runner = web.AppRunner(api.app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+
+    # Модули рассылки читают настройки при импорте, поэтому импортируем их уже после подмены config
+    from redis.asyncio import Redis
+    from spam.dramatiq_tasks import redis_broker, worker_resources, prepare_mass_mailing
+
+    samples = []
+    redis_broker.add_middleware(LatencyProbe(worker_resources, samples))
+    redis_broker.flush_all()
+
+    redis = Redis(host=config.redis_config['host'], port=config.redis_config['port'],
+                  password=config.redis_config['password'])
+    await reset_redis(redis)
+    await redis.aclose()
+
+    db = config.db_config
+    pool = await aiomysql.create_pool(host=db['host'], port=db['port'], user=db['user'], password=db['password'],
+                                      db=db['database'], autocommit=False)
+    await seed(pool, args.users, args.en_share)
+
+    worker = dramatiq.Worker(redis_broker, worker_threads=args.threads)
+    campaign_id = str(uuid.uuid4())
+    try:
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                writes_before = await db_writes(cursor)
+        started_at = time.monotonic()
+        worker.start()
+        prepare_mass_mailing.send(args.language, None, "Benchmark <b>message</b>", campaign_id, None, args.rate)
+        campaign = await wait_for_campaign(pool, campaign_id, args.timeout)
+        elapsed = time.monotonic() - started_at
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                writes = await db_writes(cursor) - writes_before
+    finally:
+        # Воркер останавливается в отдельном потоке: его потоки шлют запросы в заглушку этого event loop
+        await asyncio.get_running_loop().run_in_executor(None, worker.stop)
+        pool.close()
+        await pool.wait_closed()
+        await runner.cleanup()
+
+    if campaign is None:
+        print(f"Кампания не завершилась за {args.timeout} с", file=sys.stderr)
+        return 1
+
+    processed = campaign['sent_count'] + campaign['failed_count'] + campaign['blocked_count']
+    delivered = sum(api.deliveries.values())
+    duplicates = sum(count - 1 for count in api.deliveries.values() if count > 1)
+    send_window = (api.last_delivery - api.first_delivery) if delivered > 1 else 0
+    report = {
+        "users": args.users,
+        "processed": processed,
+        "sent": campaign['sent_count'],
+        "failed": campaign['failed_count'],
+        "blocked": campaign['blocked_count'],
+        "elapsed_s": round(elapsed, 2),
+        "msgs_per_s": round(delivered / send_window, 2) if send_window else 0,
+        "p50_send_ms": round(statistics.median(samples), 1) if samples else 0,
+        "p99_send_ms": round(percentile(samples, 99), 1),
+        "db_writes_per_message": round(writes / processed, 3) if processed else 0,
+        "duplicate_deliveries": duplicates,
+        "api_responses": dict(api.responses),
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарк рассылки против локальной заглушки Bot API")
+    parser.add_argument("--database", required=True,
+                        help=f"отдельная локальная база для прогона с «{BENCH_DATABASE_MARK}» в имени")
+    parser.add_argument("--reset", action="store_true",
+                        help="подтверждает очистку таблиц базы, ключей рассылки в Redis и очереди Dramatiq")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--en-share", type=float, default=0.3, help="доля англоязычных пользователей")
+    parser.add_argument("--language", default="all", choices=("ru", "en", "all"))
+    parser.add_argument("--rate", type=float, default=config.MAILING_RATE, help="темп кампании, сообщ./с")
+    parser.add_argument("--threads", type=int, default=4, help="потоков воркера Dramatiq")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency-ms", type=float, default=40)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--p429", type=float, default=0.0, help="вероятность ответа 429 на отправку")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--blocked", type=int, default=5, help="процент пользователей, отвечающих 403")
+    parser.add_argument("--timeout", type=float, default=1800)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    if config.db_config['host'] not in LOCAL_HOSTS or config.redis_config['host'] not in LOCAL_HOSTS:
+        print("Бенчмарк очищает таблицы и очередь Dramatiq: запускайте его только на локальных MySQL и Redis",
+              file=sys.stderr)
+        return 2
+    if BENCH_DATABASE_MARK not in args.database.lower() or args.database == config.db_config['database']:
+        print(f"Бенчмарк очищает таблицы базы: укажите отдельную базу с «{BENCH_DATABASE_MARK}» в имени, "
+              f"а не базу бота", file=sys.stderr)
+        return 2
+    if not args.reset:
+        print(f"Бенчмарк очистит таблицы базы {args.database}, ключи рассылки в Redis и очередь Dramatiq: "
+              f"подтвердите флагом --reset", file=sys.stderr)
+        return 2
+
+    # Бот и воркеры ходят в заглушку вместо api.telegram.org; админам отчёт не шлём
+    config.TELEGRAM_API_SERVER = f"http://127.0.0.1:{args.port}"
+    config.TOKEN = "123456:benchmark"
+    config.ADMINS = []
+    config.db_config = dict(config.db_config, database=args.database)
+    logging.basicConfig(level=logging.WARNING)
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,13 +6,16 @@ from aiogram import Bot, Dispatcher
 from aiogram.fsm.storage.memory import MemoryStorage
 
 from app import handlers, handlersEN, admin
-from config import TOKEN, ADMINS, db_config
-from database.db import Database
+from config import TOKEN, ADMINS, MEMBERSHIP_SYNC_INTERVAL, MEMBERSHIP_STALE_AFTER, MEMBERSHIP_SYNC_RATE
+from loader import redis, suppression, db, membership, leaderboard, analytics, active_users
 from spam import handlers as spam
 # from middlewares.SubscriptionMiddleware import SubscriptionMiddleware
 from middlewares.AntiFloodMiddleware import ThrottlingMiddleware
 from middlewares.AntiFloodMiddleware import ThrottlingMiddleware
 from middlewares.ignore_non_private import IgnoreNonPrivateMiddleware
+from middlewares.ApiRateLimitMiddleware import ApiRateLimitMiddleware
+from middlewares.UserSnapshotMiddleware import UserSnapshotMiddleware
+from middlewares.ActiveUsersMiddleware import ActiveUsersMiddleware
 
 
 import atexit
@@ -20,14 +23,14 @@ import psutil
 
 
 
-# Создание экземпляра базы данных
-db = Database(db_config)
-
 # Создание бота и диспетчера
 storage = MemoryStorage()
 bot = Bot(token=TOKEN)
 dp = Dispatcher(storage=storage)
 
+# Общий с воркерами рассылки лимит запросов к Bot API; ответы пользователям идут с приоритетом
+bot.session.middleware(ApiRateLimitMiddleware(redis))
+
 
 
 # Регистрация middleware для проверки подписки
@@ -37,6 +40,14 @@ channel_link = "https://t.me/clown_token"
 throttle_middleware = ThrottlingMiddleware(throttle_time_spin=5, throttle_time_other=2)
 dp.message.middleware(throttle_middleware)
 dp.message.middleware(IgnoreNonPrivateMiddleware())
+# Строка пользователя читается один раз на сообщение или нажатие кнопки, хендлеры и Database берут её из снимка
+user_snapshot_middleware = UserSnapshotMiddleware(db)
+dp.message.outer_middleware(user_snapshot_middleware)
+dp.callback_query.outer_middleware(user_snapshot_middleware)
+# Регистрируется после снимка: берёт из него user_id и referer_id для дневных HyperLogLog
+active_users_middleware = ActiveUsersMiddleware(active_users, db.rollups)
+dp.message.outer_middleware(active_users_middleware)
+dp.callback_query.outer_middleware(active_users_middleware)
 
 # Настройка логирования
 def setup_logging():
@@ -62,13 +73,50 @@ async def notify_admins(message: str):
         except Exception as e:
             logging.exception(f"Failed to send message to admin {admin_id}: {e}")
 
+async def report_startup_error(subsystem, e):
+    await notify_admins(f"Error starting {subsystem}: {e}")
+    logging.exception(f"Error starting {subsystem}: {e}")
+
 async def on_startup():
+    # Фоновые сбросы буферов запускаются до всего остального: сбой одной подсистемы не должен оставить
+    # активность, начисления и счётчики активных копиться в памяти. Недоступную базу они переживают сами
+    db.activity.start()
+    db.rollups.start()
+    active_users.start()
+    analytics.start()
     try:
-        await db.connect()
+        await db.warm_up()
         logging.info("Database connected successfully.")
     except Exception as e:
-        await notify_admins(f"Error connecting to the database: {e}")
-        logging.exception(f"Error connecting to the database: {e}")
+        await report_startup_error("the database", e)
+    try:
+        # Разовое заполнение daily_stats из users и пересчёт дней, пропущенных за время простоя, — здесь, а не
+        # в connect(): обработчики не ждут его за блокировкой
+        await db.rollups.ensure_backfilled()
+    except Exception as e:
+        await report_startup_error("daily rollups", e)
+    try:
+        suppression.pool = db.pool
+        await suppression.ensure_table()
+        await suppression.ensure_loaded()
+    except Exception as e:
+        await report_startup_error("the blocked users set", e)
+    try:
+        membership.pool = db.pool
+        await membership.ensure_table()
+        await membership.ensure_loaded()
+    except Exception as e:
+        await report_startup_error("the membership index", e)
+    # Сверка подписок сама переживает ошибки и заодно дозаполнит индекс, если загрузка не удалась
+    membership.start_sync(bot, MEMBERSHIP_SYNC_INTERVAL, MEMBERSHIP_STALE_AFTER, MEMBERSHIP_SYNC_RATE)
+    try:
+        await leaderboard.rebuild(db.pool)
+    except Exception as e:
+        await report_startup_error("the leaderboard", e)
+    try:
+        await active_users.ensure_seeded(db.pool)
+    except Exception as e:
+        await report_startup_error("active users counters", e)
 async def startup(ctx):
     ctx['bot'] = bot
     logging.info("Bot started successfully.")
@@ -77,6 +125,9 @@ async def startup(ctx):
 
 async def on_shutdown():
     try:
+        await membership.close()
+        await analytics.close()
+        await active_users.close()
         await db.disconnect()
         logging.info("Database disconnected successfully.")
     except Exception as e:
@@ -96,13 +147,15 @@ async def main():
 
 
     try:
-        await dp.start_polling(bot)
+        # chat_member приходят только если запрошены явно: берём типы апдейтов из зарегистрированных хендлеров
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     except Exception as e:
         await notify_admins(f"Bot stopped unexpectedly: {e}")
         logging.exception(f"Bot stopped unexpectedly: {e}")
         raise
     finally:
         await bot.session.close()
+        await redis.aclose()
         await db.disconnect()
 
 def exit_handler():
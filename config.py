@@ -11,8 +11,63 @@ CHANNELS = [
 BOOST_CHAT_ID = -1002087214352
 
 BONUSES = [50, 50, 50]
+# Бонусы за приглашение: пригласившему и приглашённому
+REFERER_BONUS = 300
+REFERRAL_BONUS = 100
 ADMINS = []
 NOT_SUB_MESSAGE = "🤡Чтобы пользоваться ботом, подпишитесь на наш канал.\nTo use the bot, subscribe to our channel."
 
 
 
+# Рассылка: целевая скорость (сообщений в секунду на всю кампанию) и число параллельных отправителей в шарде
+MAILING_RATE = 25
+MAILING_CONCURRENCY = 10
+# Статусы рассылки пишутся пачками: по MAILING_STATUS_BATCH строк или раз в MAILING_STATUS_FLUSH_INTERVAL секунд
+MAILING_STATUS_BATCH = 500
+MAILING_STATUS_FLUSH_INTERVAL = 1.0
+# Получатели закрепляются и курсор кампании сохраняется страницами по MAILING_PAGE_SIZE пользователей;
+# через MAILING_TIME_BUDGET секунд актор ставит продолжение в очередь, не дожидаясь time_limit
+MAILING_PAGE_SIZE = 500
+MAILING_TIME_BUDGET = 240
+# Аудитория кампании делится на шарды примерно по MAILING_SHARD_SIZE пользователей, шарды идут параллельно
+MAILING_SHARD_SIZE = 5000
+# Сообщение с ходом рассылки обновляется раз в MAILING_PROGRESS_INTERVAL секунд;
+# шард на паузе проверяет, не сняли ли её, раз в MAILING_PAUSE_POLL секунд
+MAILING_PROGRESS_INTERVAL = 5
+MAILING_PAUSE_POLL = 10
+# Шард, чей курсор не двигался MAILING_SHARD_STALE_AFTER секунд, считается брошенным упавшим воркером и
+# передаётся новому сообщению; должно быть больше time_limit актора шарда (300 с). Цепочка обновлений прогресса
+# обрывается после MAILING_PROGRESS_MAX_UPDATES обновлений (сутки), а незавершённая кампания помечается failed
+MAILING_SHARD_STALE_AFTER = 3 * MAILING_TIME_BUDGET
+MAILING_PROGRESS_MAX_UPDATES = 24 * 3600 // MAILING_PROGRESS_INTERVAL
+# Пул MySQL каждого потока воркера рассылки: поток ведёт один шард, которому хватает соединения на каждого
+# отправителя и ещё двух на закрепление страниц и курсор. Всего воркеры держат до
+# процессы × потоки × MAILING_DB_POOL_MAX соединений: при настройках Dramatiq по умолчанию (8 потоков) — 96 на процесс
+MAILING_DB_POOL_MIN = 1
+MAILING_DB_POOL_MAX = MAILING_CONCURRENCY + 2
+# Адрес Bot API; None — api.telegram.org. Нужен для локального Bot API сервера и для бенчмарка рассылки
+TELEGRAM_API_SERVER = None
+# Один пул MySQL на процесс бота: minsize соединений открывается при старте, maxsize — потолок под нагрузкой
+DB_POOL_MINSIZE = 10
+DB_POOL_MAXSIZE = 50
+# last_activity / last_login копятся в памяти и пишутся одним UPDATE раз в ACTIVITY_FLUSH_INTERVAL секунд
+# или сразу, когда в буфере набралось ACTIVITY_BUFFER_SIZE пользователей
+ACTIVITY_FLUSH_INTERVAL = 5
+ACTIVITY_BUFFER_SIZE = 1000
+# Подписки на каналы кэшируются в Redis: подписка — на MEMBERSHIP_TTL секунд, её отсутствие — на
+# MEMBERSHIP_NEGATIVE_TTL; апдейты chat_member из каналов обновляют кэш сразу. Запись индекса в памяти
+# тоже верна не дольше MEMBERSHIP_TTL секунд после проверки
+MEMBERSHIP_TTL = 600
+MEMBERSHIP_NEGATIVE_TTL = 30
+# Не больше MEMBERSHIP_CHECK_CONCURRENCY одновременных get_chat_member при проверке нескольких каналов
+MEMBERSHIP_CHECK_CONCURRENCY = 20
+# Таблица channel_members сверяется с Telegram раз в MEMBERSHIP_SYNC_INTERVAL секунд: дозаполняются
+# пользователи без записи и перепроверяются записи старше MEMBERSHIP_STALE_AFTER секунд, не быстрее
+# MEMBERSHIP_SYNC_RATE запросов get_chat_member в секунду
+MEMBERSHIP_SYNC_INTERVAL = 3600
+MEMBERSHIP_STALE_AFTER = 86400
+MEMBERSHIP_SYNC_RATE = 5
+# Аналитика админки пересчитывается одним запросом в фоне раз в ANALYTICS_REFRESH_INTERVAL секунд
+ANALYTICS_REFRESH_INTERVAL = 300
+# Дневные агрегаты (daily_stats) за вчера и сегодня пересчитываются раз в ROLLUP_REFRESH_INTERVAL секунд
+ROLLUP_REFRESH_INTERVAL = 600
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+from datetime import date, timedelta
+
+
+class ActiveUsers:
+    """ Активные пользователи по дням в HyperLogLog Redis: DAU, WAU, MAU и активные реферы считаются PFCOUNT
+    по дневным ключам за O(число дней) и 12 КБ на ключ, без обращения к users.
+
+    Стандартная ошибка HyperLogLog в Redis — 0,81%: примерно в 99,7% случаев оценка отличается от точного
+    числа не больше чем на 2,4% """
+
+    error = 0.0081
+
+    def __init__(self, redis, flush_interval=5.0, retention_days=35, prefix="active"):
+        self.redis = redis
+        self.flush_interval = flush_interval
+        # Ключи живут чуть дольше самого длинного окна (MAU), потом Redis удаляет их сам
+        self.retention_days = retention_days
+        self.users_prefix = f"{prefix}:users"
+        self.referrers_prefix = f"{prefix}:referrers"
+        self.seeded_key = f"{prefix}:seeded"
+        # Между сбросами user_id копятся в памяти: один PFADD на день и вид ключа вместо запроса на апдейт
+        self._pending_users = {}
+        self._pending_referrers = {}
+        self._task = None
+
+    def record(self, user_id, referer_id=None):
+        today = date.today()
+        self._pending_users.setdefault(today, set()).add(user_id)
+        # Рефер активен, если активен кто-то из приглашённых им — как в count_active_referrers
+        if referer_id:
+            self._pending_referrers.setdefault(today, set()).add(referer_id)
+
+    async def flush(self):
+        users, self._pending_users = self._pending_users, {}
+        referrers, self._pending_referrers = self._pending_referrers, {}
+        if not users and not referrers:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for prefix, pending in ((self.users_prefix, users), (self.referrers_prefix, referrers)):
+            for day, ids in pending.items():
+                key = f"{prefix}:{day.isoformat()}"
+                pipe.pfadd(key, *ids)
+                pipe.expire(key, self.retention_days * 86400)
+        try:
+            await pipe.execute()
+        except Exception:
+            # PFADD идемпотентен: при повторной попытке те же user_id ничего не испортят
+            for day, ids in users.items():
+                self._pending_users.setdefault(day, set()).update(ids)
+            for day, ids in referrers.items():
+                self._pending_referrers.setdefault(day, set()).update(ids)
+            raise
+
+    async def ensure_seeded(self, pool):
+        """ Первый запуск: каждый пользователь попадает в ключ дня своей last_activity. Для окон до
+        retention_days дней это с точностью до дня прежнее условие last_activity >= NOW() - INTERVAL N DAY """
+        if await self.redis.exists(self.seeded_key):
+            return
+        since = date.today() - timedelta(days=self.retention_days - 1)
+        after_id = 0
+        total = 0
+        while True:
+            async with pool.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(
+                        "SELECT user_id, referer_id, DATE(last_activity) FROM users "
+                        "WHERE user_id > %s AND last_activity >= %s ORDER BY user_id LIMIT 10000", (after_id, since))
+                    rows = await cursor.fetchall()
+            if not rows:
+                break
+            for user_id, referer_id, day in rows:
+                self._pending_users.setdefault(day, set()).add(user_id)
+                if referer_id:
+                    self._pending_referrers.setdefault(day, set()).add(referer_id)
+            await self.flush()
+            total += len(rows)
+            after_id = rows[-1][0]
+        await self.redis.set(self.seeded_key, 1)
+        logging.info(f"Счётчики активных пользователей заполнены из users: {total} пользователей")
+
+    def _keys(self, prefix, days):
+        today = date.today()
+        return [f"{prefix}:{(today - timedelta(days=offset)).isoformat()}" for offset in range(days)]
+
+    async def count(self, days=1):
+        """ Уникальные активные пользователи за последние days дней, включая сегодня """
+        return await self.redis.pfcount(*self._keys(self.users_prefix, days))
+
+    async def count_referrers(self, days=30):
+        return await self.redis.pfcount(*self._keys(self.referrers_prefix, days))
+
+    async def get_metrics(self):
+        await self.flush()
+        return {
+            "dau": await self.count(1),
+            "wau": await self.count(7),
+            "mau": await self.count(30),
+            "active_referrers": await self.count_referrers(30),
+        }
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_periodically())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Не удалось записать активных пользователей в Redis: {e}")
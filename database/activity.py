@@ -0,0 +1,86 @@
+import asyncio
+import logging
+
+
+class ActivityBuffer:
+    """ Копит last_activity / last_login по user_id и пишет их в users одним UPDATE раз в flush_interval секунд """
+
+    columns = ("last_activity", "last_login")
+
+    def __init__(self, db, flush_interval=5.0, max_size=1000):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        # Нужна только последняя отметка: повторные касания одного пользователя перезаписывают её в буфере
+        self._pending = {}
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._flush_soon = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_periodically())
+
+    def touch(self, user_id, column, moment):
+        self._pending.setdefault(user_id, {})[column] = moment
+        if len(self._pending) >= self.max_size and (self._flush_soon is None or self._flush_soon.done()):
+            self._flush_soon = asyncio.create_task(self._flush_quietly())
+
+    def _build_query(self, batch):
+        params = []
+        assignments = []
+        for column in self.columns:
+            cases = [(user_id, values[column]) for user_id, values in batch if column in values]
+            if not cases:
+                continue
+            assignments.append(f"{column} = CASE user_id " + " ".join(["WHEN %s THEN %s"] * len(cases))
+                               + f" ELSE {column} END")
+            for user_id, moment in cases:
+                params.extend((user_id, moment))
+        placeholders = ", ".join(["%s"] * len(batch))
+        params.extend(user_id for user_id, _ in batch)
+        return f"UPDATE users SET {', '.join(assignments)} WHERE user_id IN ({placeholders})", params
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            items = list(pending.items())
+            for start in range(0, len(items), self.max_size):
+                batch = items[start:start + self.max_size]
+                query, params = self._build_query(batch)
+                try:
+                    await self.db.ensure_connected()
+                    async with self.db.acquire() as conn:
+                        async with conn.cursor() as cursor:
+                            await cursor.execute(query, params)
+                        await conn.commit()
+                except Exception as e:
+                    # Возвращаем отметки в буфер, не затирая более свежие, пришедшие во время записи
+                    for user_id, values in items[start:]:
+                        current = self._pending.setdefault(user_id, {})
+                        for column, moment in values.items():
+                            current.setdefault(column, moment)
+                    logging.error(f"Не удалось записать активность {len(items) - start} пользователей: {e}")
+                    raise
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._flush_soon:
+            await asyncio.gather(self._flush_soon, return_exceptions=True)
+        await self.flush()
+
+    async def _flush_quietly(self):
+        try:
+            await self.flush()
+        except Exception:
+            pass
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self._flush_quietly()
@@ -0,0 +1,61 @@
+import asyncio
+import logging
+import time
+
+
+class AnalyticsCache:
+    """ Снимок аналитики админки: считается одним запросом в фоне раз в refresh_interval секунд,
+    экран аналитики показывает готовый снимок и его возраст """
+
+    def __init__(self, db, refresh_interval=300, active_users=None):
+        self.db = db
+        # HyperLogLog-счётчики (database.active_users.ActiveUsers) заменяют SQL-подсчёт активных
+        self.active_users = active_users
+        self.refresh_interval = refresh_interval
+        self.statistics = None
+        self.taken_at = None
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_periodically())
+
+    async def refresh(self):
+        # Одновременные запросы обновления ждут один и тот же проход по таблице
+        started_at = time.time()
+        async with self._lock:
+            if self.taken_at is not None and self.taken_at >= started_at:
+                return
+            metrics = None
+            if self.active_users is not None:
+                try:
+                    metrics = await self.active_users.get_metrics()
+                except Exception as e:
+                    logging.error(f"HyperLogLog активных недоступен, считаем активных в MySQL: {e}")
+            # Активных из users считаем, только если счётчиков нет: иначе эти колонки лишь замедляют проход
+            statistics = await self.db.get_detailed_user_statistics(include_activity=metrics is None)
+            if metrics is not None:
+                statistics.update(metrics, active_users=metrics["wau"])
+            self.statistics = statistics
+            self.taken_at = time.time()
+
+    async def get(self):
+        """ (статистика, время снимка); первый вызов до фонового обновления считает снимок сразу """
+        if self.statistics is None:
+            await self.refresh()
+        return self.statistics, self.taken_at
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _refresh_periodically(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.error(f"Не удалось обновить аналитику: {e}")
+            await asyncio.sleep(self.refresh_interval)
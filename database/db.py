@@ -1,36 +1,163 @@
 import aiomysql
+import asyncio
 import logging
+import time
 import uuid
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from datetime import datetime
 
+from database.activity import ActivityBuffer
+from database.rollups import DailyRollups
+from database.tasks import TASKS, task_mask, is_completed
+
+# Строка пользователя, загруженная UserSnapshotMiddleware один раз на апдейт; читается аксессорами Database
+current_user = ContextVar("current_user", default=None)
+MISSING = object()
+
+
+class PoolStats:
+    """ Время ожидания свободного соединения в пуле: по нему подбирается maxsize """
+
+    def __init__(self, window=1000):
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent = deque(maxlen=window)
+
+    def record(self, wait):
+        self.acquired += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.recent.append(wait)
+
+    def percentile(self, percent):
+        if not self.recent:
+            return 0.0
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
 
 class Database:
-    def __init__(self, db_config):
+    def __init__(self, db_config, minsize=None, maxsize=None, activity_flush_interval=5.0, activity_buffer_size=1000,
+                 leaderboard=None, rollup_refresh_interval=600):
         self.db_config = db_config
+        self.minsize = minsize or db_config.get('minsize', 10)
+        self.maxsize = maxsize or db_config.get('maxsize', 50)
         self.pool = None
+        self.pool_stats = PoolStats()
+        # last_activity / last_login пишутся отложенно пачками, см. ActivityBuffer
+        self.activity = ActivityBuffer(self, activity_flush_interval, activity_buffer_size)
+        # Дневные агрегаты для исторической статистики, см. DailyRollups
+        self.rollups = DailyRollups(self, rollup_refresh_interval, flush_interval=activity_flush_interval)
+        # Рейтинг в Redis (database.leaderboard.Leaderboard) обновляется вместе с каждым начислением
+        self.leaderboard = leaderboard
+        self._connect_lock = asyncio.Lock()
 
     async def connect(self):
-        logging.info("Connecting to the database...")
-        self.pool = await aiomysql.create_pool(
-            host=self.db_config['host'],
-            port=self.db_config.get('port', 3306),
-            user=self.db_config['user'],
-            password=self.db_config['password'],
-            db=self.db_config['database'],
-            minsize=self.db_config.get('minsize', 10),
-            maxsize=self.db_config.get('maxsize', 120)
-        )
-        logging.info("Database connection established.")
-        await self.ensure_indexes()
+        # Один пул на процесс: повторные вызовы из разных роутеров не открывают новый
+        async with self._connect_lock:
+            if self.pool is not None:
+                return
+            logging.info("Connecting to the database...")
+            self.pool = await aiomysql.create_pool(
+                host=self.db_config['host'],
+                port=self.db_config.get('port', 3306),
+                user=self.db_config['user'],
+                password=self.db_config['password'],
+                db=self.db_config['database'],
+                minsize=self.minsize,
+                maxsize=self.maxsize
+            )
+            logging.info(f"Database connection established (pool {self.minsize}..{self.maxsize}).")
+            await self.ensure_indexes()
+            await self.ensure_task_flags()
+            await self.rollups.ensure_tables()
+
+    async def warm_up(self):
+        """ Подключается при старте и проверяет minsize соединений, чтобы первые апдейты не ждали их открытия """
+        await self.connect()
+        conns = [await self.pool.acquire() for _ in range(self.minsize)]
+        try:
+            for conn in conns:
+                await conn.ping()
+        finally:
+            for conn in conns:
+                self.pool.release(conn)
+        logging.info(f"Database pool warmed up: {self.pool.size} connections.")
+
+    async def _sync_leaderboard(self, action, *args):
+        # Рейтинг производный от users: ошибка Redis не отменяет запись в MySQL, его поправит пересборка на старте
+        if self.leaderboard is None:
+            return
+        try:
+            await getattr(self.leaderboard, action)(*args)
+        except Exception as e:
+            logging.error(f"Не удалось обновить рейтинг ({action}): {e}")
+
+    @asynccontextmanager
+    async def acquire(self):
+        started_at = time.perf_counter()
+        async with self.pool.acquire() as conn:
+            self.pool_stats.record(time.perf_counter() - started_at)
+            yield conn
+
+    def get_pool_stats(self):
+        stats = self.pool_stats
+        return {
+            "size": self.pool.size if self.pool else 0,
+            "free": self.pool.freesize if self.pool else 0,
+            "maxsize": self.maxsize,
+            "acquired": stats.acquired,
+            "avg_wait_ms": stats.total_wait / stats.acquired * 1000 if stats.acquired else 0.0,
+            "p99_wait_ms": stats.percentile(99) * 1000,
+            "max_wait_ms": stats.max_wait * 1000,
+        }
+
+    async def load_user_snapshot(self, user_id):
+        """ Вся строка пользователя и число его рефералов одним запросом """
+        await self.ensure_connected()
+        async with self.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                await cursor.execute(
+                    "SELECT u.*, (SELECT COUNT(*) FROM users r WHERE r.referer_id = u.user_id) AS referrals "
+                    "FROM users u WHERE u.user_id = %s", (user_id,))
+                row = await cursor.fetchone()
+        if row is None:
+            return {"user_id": user_id, "exists": False}
+        row["exists"] = True
+        return row
+
+    def _from_snapshot(self, user_id, field):
+        snapshot = current_user.get()
+        if snapshot is None or snapshot["user_id"] != user_id:
+            return MISSING
+        if field == "exists" or snapshot["exists"]:
+            return snapshot.get(field, MISSING)
+        return MISSING
+
+    def _patch_snapshot(self, user_id, field, update):
+        # Записи в течение апдейта поправляют снимок, чтобы следующие чтения видели новое значение
+        snapshot = current_user.get()
+        if snapshot is not None and snapshot["user_id"] == user_id and field in snapshot:
+            snapshot[field] = update(snapshot[field])
+
+    def _forget_snapshot(self, user_id):
+        snapshot = current_user.get()
+        if snapshot is not None and snapshot["user_id"] == user_id:
+            current_user.set(None)
 
     async def ensure_indexes(self):
         index_queries = [
             ("users", "idx_user_id", "user_id"),
+            ("users", "idx_referer_id", "referer_id"),
             ("users", "idx_tg_name", "tg_name"),
             ("users", "idx_last_activity", "last_activity"),
-            ("users", "idx_referral_code", "referral_code")
+            ("users", "idx_referral_code", "referral_code"),
+            ("users", "idx_registration_date", "registration_date")
         ]
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 for table, index_name, column in index_queries:
                     await cursor.execute(
@@ -41,10 +168,72 @@ class Database:
                         await cursor.execute(f"CREATE INDEX {index_name} ON {table} ({column})")
                 await conn.commit()
 
+    async def ensure_migrations_table(self):
+        async with self.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        name VARCHAR(64) PRIMARY KEY,
+                        applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+                await conn.commit()
+
+    @staticmethod
+    async def is_migration_applied(cursor, name):
+        await cursor.execute("SELECT 1 FROM schema_migrations WHERE name = %s", (name,))
+        return await cursor.fetchone() is not None
+
+    @staticmethod
+    async def mark_migration_applied(cursor, name):
+        """ Отметка пишется в транзакции самой миграции: без её COMMIT миграция повторится при следующем старте """
+        await cursor.execute("INSERT IGNORE INTO schema_migrations (name) VALUES (%s)", (name,))
+
+    async def ensure_task_flags(self):
+        """ Миграция: флаги заданий из отдельных BOOLEAN-колонок переносятся в битовую маску users.task_flags.
+        ALTER TABLE фиксируется сразу, поэтому готовность миграции — отметка в schema_migrations, а не наличие
+        колонки; перенос только добавляет биты и безопасен при повторе """
+        await self.ensure_migrations_table()
+        async with self.acquire() as conn:
+            async with conn.cursor() as cursor:
+                if await self.is_migration_applied(cursor, "task_flags"):
+                    return
+                await cursor.execute(
+                    "SELECT column_name FROM INFORMATION_SCHEMA.COLUMNS "
+                    "WHERE table_schema = DATABASE() AND table_name = 'users'")
+                columns = {row[0] for row in await cursor.fetchall()}
+                logging.info("Migrating task flags to users.task_flags...")
+                if "task_flags" not in columns:
+                    await cursor.execute("ALTER TABLE users ADD COLUMN task_flags INT UNSIGNED NOT NULL DEFAULT 0")
+                # Старые колонки остаются для отката, но больше не пишутся
+                legacy = [task for task in TASKS.values() if task.key in columns]
+                try:
+                    await conn.begin()
+                    if legacy:
+                        bits = " | ".join(f"(COALESCE({task.key}, FALSE) << {task.bit})" for task in legacy)
+                        await cursor.execute(
+                            f"UPDATE users SET task_flags = task_flags | ({bits}) "
+                            f"WHERE task_flags | ({bits}) <> task_flags")
+                    await self.mark_migration_applied(cursor, "task_flags")
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+                logging.info("Task flags migrated.")
+
     async def disconnect(self):
+        if self.pool is None:
+            return
         logging.info("Disconnecting from the database...")
+        try:
+            # Перед закрытием пула дописываем накопленную активность
+            await self.rollups.close()
+            await self.activity.close()
+        except Exception as e:
+            logging.error(f"Failed to flush user activity on shutdown: {e}")
         self.pool.close()
         await self.pool.wait_closed()
+        self.pool = None
         logging.info("Database disconnected.")
 
     async def ensure_connected(self):
@@ -52,8 +241,11 @@ class Database:
             await self.connect()
 
     async def user_exists(self, user_id):
+        exists = self._from_snapshot(user_id, "exists")
+        if exists is not MISSING:
+            return exists
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 query = "SELECT 1 FROM users WHERE user_id = %s"
                 await cursor.execute(query, (user_id,))
@@ -62,7 +254,7 @@ class Database:
 
     async def add_user(self, user_id, referer_id=None, tg_name=None):
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 referral_code = str(uuid.uuid4())
                 query = (
@@ -71,10 +263,12 @@ class Database:
                 )
                 await cursor.execute(query, (user_id, referer_id, tg_name, referral_code))
                 await conn.commit()
+        self._forget_snapshot(user_id)
+        await self._sync_leaderboard("add_user", user_id, tg_name)
 
     async def get_referral_code(self, user_id):
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 query = "SELECT referral_code FROM users WHERE user_id = %s"
                 await cursor.execute(query, (user_id,))
@@ -90,7 +284,7 @@ class Database:
 
     async def get_user_by_referral_code(self, referral_code):
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 query = "SELECT user_id FROM users WHERE referral_code = %s"
                 await cursor.execute(query, (referral_code,))
@@ -99,21 +293,27 @@ class Database:
 
     async def add_bonus(self, user_id, bonus_amount):
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 try:
                     logging.info(f"Добавление {bonus_amount} бонусных очков пользователю {user_id}")
                     query = "UPDATE users SET bonus_points = bonus_points + %s WHERE user_id = %s"
                     await cursor.execute(query, (bonus_amount, user_id))
                     await conn.commit()
+                    self.rollups.add_bonus(user_id, bonus_amount)
+                    self._patch_snapshot(user_id, "bonus_points", lambda points: points + bonus_amount)
                     logging.info(f"Успешно добавлено {bonus_amount} бонусных очков пользователю {user_id}")
                 except Exception as e:
                     logging.error(f"Ошибка при добавлении бонусных очков пользователю {user_id}: {e}")
                     raise e
+        await self._sync_leaderboard("credit", (user_id, bonus_amount))
 
     async def get_bonus_points(self, user_id):
+        bonus_points = self._from_snapshot(user_id, "bonus_points")
+        if bonus_points is not MISSING:
+            return bonus_points
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 query = "SELECT bonus_points FROM users WHERE user_id = %s"
                 await cursor.execute(query, (user_id,))
@@ -122,23 +322,27 @@ class Database:
 
     async def update_user_tg_name(self, user_id, tg_name):
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 query = "UPDATE users SET tg_name = %s WHERE user_id = %s"
                 await cursor.execute(query, (tg_name, user_id))
                 await conn.commit()
+        await self._sync_leaderboard("set_name", user_id, tg_name)
 
     async def get_user_info(self, user_id):
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor(aiomysql.DictCursor) as cursor:
                 query = "SELECT * FROM users WHERE user_id = %s"
                 await cursor.execute(query, (user_id,))
                 return await cursor.fetchone()
 
     async def count_referals(self, user_id):
+        referrals = self._from_snapshot(user_id, "referrals")
+        if referrals is not MISSING:
+            return referrals
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 query = "SELECT COUNT(*) FROM users WHERE referer_id = %s"
                 await cursor.execute(query, (user_id,))
@@ -147,15 +351,17 @@ class Database:
 
     async def delete_user(self, user_id):
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 query = "DELETE FROM users WHERE user_id = %s"
                 await cursor.execute(query, (user_id,))
                 await conn.commit()
+        self._forget_snapshot(user_id)
+        await self._sync_leaderboard("remove", user_id)
 
     async def has_received_bonus_for_channel(self, user_id, channel_id):
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 query = "SELECT bonus_received FROM subscriptions WHERE user_id = %s AND channel_id = %s"
                 await cursor.execute(query, (user_id, channel_id))
@@ -164,7 +370,7 @@ class Database:
 
     async def mark_bonus_received_for_channel(self, user_id, channel_id):
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 query = (
                     "INSERT INTO subscriptions (user_id, channel_id, bonus_received) "
@@ -173,26 +379,21 @@ class Database:
                 await cursor.execute(query, (user_id, channel_id))
                 await conn.commit()
 
-    async def count_users_registered_between(self, start_date, end_date):
-        await self.ensure_connected()
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cursor:
-                query = "SELECT COUNT(*) FROM users WHERE registration_date BETWEEN %s AND %s"
-                await cursor.execute(query, (start_date, end_date))
-                result = await cursor.fetchone()
-                return result[0] if result else 0
-
     async def increment_referral_count(self, user_id):
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 query = "UPDATE users SET referral_count = referral_count + 1 WHERE user_id = %s"
                 await cursor.execute(query, (user_id,))
                 await conn.commit()
+        self._patch_snapshot(user_id, "referral_count", lambda count: count + 1)
 
     async def get_referral_count(self, user_id):
+        referral_count = self._from_snapshot(user_id, "referral_count")
+        if referral_count is not MISSING:
+            return referral_count
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 query = "SELECT referral_count FROM users WHERE user_id = %s"
                 await cursor.execute(query, (user_id,))
@@ -200,29 +401,15 @@ class Database:
                 return result[0] if result else 0
 
     async def update_last_login(self, user_id):
-        now = datetime.now()
-        await self.ensure_connected()
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cursor:
-                query = "UPDATE users SET last_login = %s WHERE user_id = %s"
-                await cursor.execute(query, (now, user_id))
-                await conn.commit()
+        self.activity.touch(user_id, "last_login", datetime.now())
 
     async def update_last_activity(self, user_id):
-        """ Обновляет время последней активности пользователя """
-        now = datetime.now()
-        await self.ensure_connected()
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute(
-                    "UPDATE users SET last_activity = %s WHERE user_id = %s",
-                    (now, user_id)
-                )
-                await conn.commit()
+        """ Обновляет время последней активности пользователя (запись в базу — пачкой, через ActivityBuffer) """
+        self.activity.touch(user_id, "last_activity", datetime.now())
 
     async def is_subscribed_to_notifications(self, user_id):
         await self.ensure_connected()
-        async with self.pool.acquire() as connection:
+        async with self.acquire() as connection:
             async with connection.cursor() as cursor:
                 await cursor.execute("SELECT subscribed FROM user_notifications WHERE user_id = %s", (user_id,))
                 result = await cursor.fetchone()
@@ -230,7 +417,7 @@ class Database:
 
     async def subscribe_to_notifications(self, user_id):
         await self.ensure_connected()
-        async with self.pool.acquire() as connection:
+        async with self.acquire() as connection:
             async with connection.cursor() as cursor:
                 await cursor.execute(
                     "INSERT INTO user_notifications (user_id, subscribed) VALUES (%s, TRUE) "
@@ -239,7 +426,7 @@ class Database:
 
     async def unsubscribe_from_notifications(self, user_id):
         await self.ensure_connected()
-        async with self.pool.acquire() as connection:
+        async with self.acquire() as connection:
             async with connection.cursor() as cursor:
                 await cursor.execute(
                     "INSERT INTO user_notifications (user_id, subscribed) VALUES (%s, FALSE) "
@@ -248,7 +435,7 @@ class Database:
 
     async def save_notification(self, photo=None, caption=None):
         await self.ensure_connected()
-        async with self.pool.acquire() as connection:
+        async with self.acquire() as connection:
             async with connection.cursor() as cursor:
                 await cursor.execute(
                     "INSERT INTO notifications (photo, caption) VALUES (%s, %s)", (photo, caption))
@@ -260,94 +447,150 @@ class Database:
 
     async def get_notification(self, notification_id):
         await self.ensure_connected()
-        async with self.pool.acquire() as connection:
+        async with self.acquire() as connection:
             async with connection.cursor() as cursor:
                 await cursor.execute("SELECT photo, caption FROM notifications WHERE id = %s", (notification_id,))
                 return await cursor.fetchone()
 
-    async def get_detailed_user_statistics(self):
-        await self.ensure_connected()
-        statistics = {}
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("SELECT COUNT(*) FROM users")
-                statistics['total_users'] = (await cursor.fetchone())[0]
-
-                await cursor.execute("SELECT COUNT(*) FROM users WHERE last_activity >= NOW() - INTERVAL 7 DAY")
-                statistics['active_users'] = (await cursor.fetchone())[0]
-
-                await cursor.execute("SELECT COUNT(*) FROM users WHERE registration_date >= NOW() - INTERVAL 7 DAY")
-                statistics['new_users'] = (await cursor.fetchone())[0]
-
-                await cursor.execute("SELECT AVG(bonus_points) FROM users")
-                statistics['average_bonus_per_user'] = (await cursor.fetchone())[0]
-
-                await cursor.execute("SELECT SUM(bonus_points) FROM users")
-                statistics['total_bonus'] = (await cursor.fetchone())[0]
-
-                task_columns = [
-                    "task_name_completed",
-                    "task_subscribe_completed",
-                    "task_invite_completed",
-                    "task_repost_completed",
-                    "task_boost_completed"
-                ]
-                for task in task_columns:
-                    await cursor.execute(f"SELECT COUNT(*) FROM users WHERE {task} = TRUE")
-                    statistics[task] = (await cursor.fetchone())[0]
-        return statistics
+    async def get_detailed_user_statistics(self, include_activity=True):
+        """ Вся аналитика админки одним проходом по users, включая рефералов и задания.
+        include_activity=False — без active_users и active_referrers, когда их дают счётчики HyperLogLog """
+        metrics = [
+            ("total_users", "COUNT(*)"),
+            ("new_users", "COALESCE(SUM(registration_date >= NOW() - INTERVAL 7 DAY), 0)"),
+            ("average_bonus_per_user", "COALESCE(AVG(bonus_points), 0)"),
+            ("total_bonus", "COALESCE(SUM(bonus_points), 0)"),
+            ("total_referral_bonus", "COALESCE(SUM(CASE WHEN referer_id IS NOT NULL THEN bonus_points END), 0)"),
+            ("total_referrals", "COUNT(referer_id)"),
+        ]
+        if include_activity:
+            metrics += [
+                ("active_users", "COALESCE(SUM(last_activity >= NOW() - INTERVAL 7 DAY), 0)"),
+                ("active_referrers", "COUNT(DISTINCT CASE WHEN last_activity >= NOW() - INTERVAL 30 DAY "
+                                     "THEN referer_id END)"),
+            ]
+        metrics += [(key, f"COALESCE(SUM(task_flags & {task_mask(key)} <> 0), 0)") for key in TASKS]
+        await self.ensure_connected()
+        async with self.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(f"SELECT {', '.join(expression for _, expression in metrics)} FROM users")
+                row = await cursor.fetchone()
+        # MySQL отдаёт SUM и AVG как Decimal
+        return {key: float(value) if key == "average_bonus_per_user" else int(value)
+                for (key, _), value in zip(metrics, row)}
 
     async def get_top_users(self, limit=10):
+        if self.leaderboard is not None and self.leaderboard.ready:
+            try:
+                return await self.leaderboard.top(limit)
+            except Exception as e:
+                logging.error(f"Рейтинг в Redis недоступен, читаем топ из MySQL: {e}")
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor(aiomysql.DictCursor) as cursor:
                 query = "SELECT user_id, tg_name, bonus_points FROM users ORDER BY bonus_points DESC LIMIT %s"
                 await cursor.execute(query, (limit,))
                 return await cursor.fetchall()
 
+    async def get_user_rank(self, user_id, language=None):
+        """ (место, всего участников) в общем рейтинге или среди пользователей языка; None для незнакомого """
+        if self.leaderboard is not None and self.leaderboard.ready:
+            try:
+                return await self.leaderboard.rank(user_id, language)
+            except Exception as e:
+                logging.error(f"Рейтинг в Redis недоступен, считаем место в MySQL: {e}")
+        language_filter = " AND language = %s" if language else ""
+        params = (language,) if language else ()
+        await self.ensure_connected()
+        async with self.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("SELECT bonus_points FROM users WHERE user_id = %s", (user_id,))
+                row = await cursor.fetchone()
+                if row is None:
+                    return None
+                await cursor.execute(
+                    f"SELECT COUNT(CASE WHEN bonus_points > %s THEN 1 END) + 1, COUNT(*) FROM users "
+                    f"WHERE 1 = 1{language_filter}", (row[0], *params))
+                rank, total = await cursor.fetchone()
+                return int(rank), int(total)
+
     async def update_user_language(self, user_id, language):
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 query = "UPDATE users SET language = %s WHERE user_id = %s"
                 await cursor.execute(query, (language, user_id))
                 await conn.commit()
+        self._patch_snapshot(user_id, "language", lambda _: language)
+        await self._sync_leaderboard("set_language", user_id, language)
 
     async def get_user_language(self, user_id):
+        language = self._from_snapshot(user_id, "language")
+        if language is not MISSING:
+            return language
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 query = "SELECT language FROM users WHERE user_id = %s"
                 await cursor.execute(query, (user_id,))
                 result = await cursor.fetchone()
                 return result[0] if result else None
 
-    async def is_task_completed(self, user_id, task_column):
+    async def get_task_flags(self, user_id):
+        """ Битовая маска выполненных заданий (см. database.tasks) — одно чтение на всю клавиатуру заданий """
+        flags = self._from_snapshot(user_id, "task_flags")
+        if flags is not MISSING:
+            return flags
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
-                query = f"SELECT {task_column} FROM users WHERE user_id = %s"
-                await cursor.execute(query, (user_id,))
+                await cursor.execute("SELECT task_flags FROM users WHERE user_id = %s", (user_id,))
                 result = await cursor.fetchone()
-                return result[0] if result else False
+                return result[0] if result else 0
+
+    async def is_task_completed(self, user_id, task_column):
+        return is_completed(await self.get_task_flags(user_id), task_column)
 
     async def mark_task_completed(self, user_id, task_column):
+        mask = task_mask(task_column)
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 try:
                     logging.info(f"Пометка задания '{task_column}' как выполненного для пользователя {user_id}")
-                    query = f"UPDATE users SET {task_column} = TRUE WHERE user_id = %s"
-                    await cursor.execute(query, (user_id,))
+                    query = "UPDATE users SET task_flags = task_flags | %s WHERE user_id = %s"
+                    await cursor.execute(query, (mask, user_id))
                     await conn.commit()
+                    self._patch_snapshot(user_id, "task_flags", lambda flags: flags | mask)
                     logging.info(f"Задание '{task_column}' успешно помечено как выполненное для пользователя {user_id}")
                 except Exception as e:
                     logging.error(f"Ошибка при пометке задания '{task_column}' как выполненного для пользователя {user_id}: {e}")
                     raise e
 
+    async def complete_task_and_award(self, user_id, task_column, points):
+        """ Отмечает задание и начисляет бонус одним условным UPDATE; False, если задание уже было выполнено """
+        mask = task_mask(task_column)
+        await self.ensure_connected()
+        async with self.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    "UPDATE users SET task_flags = task_flags | %s, bonus_points = bonus_points + %s "
+                    "WHERE user_id = %s AND task_flags & %s = 0",
+                    (mask, points, user_id, mask))
+                completed = cursor.rowcount == 1
+                await conn.commit()
+        # Ноль изменённых строк у существующего пользователя значит, что бит уже стоял
+        self._patch_snapshot(user_id, "task_flags", lambda flags: flags | mask)
+        if completed:
+            logging.info(f"Задание '{task_column}' выполнено пользователем {user_id}, начислено {points} очков")
+            self.rollups.add_bonus(user_id, points)
+            self._patch_snapshot(user_id, "bonus_points", lambda bonus_points: bonus_points + points)
+            await self._sync_leaderboard("credit", (user_id, points))
+        return completed
+
     async def is_chat_boosted(self, user_id):
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 query = "SELECT boosted FROM chat_boosts WHERE user_id = %s"
                 await cursor.execute(query, (user_id,))
@@ -356,7 +599,7 @@ class Database:
 
     async def update_bonus_value(self, new_bonus_value):
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 query = "UPDATE settings SET bonus_value = %s WHERE id = 1"
                 await cursor.execute(query, (new_bonus_value,))
@@ -364,7 +607,7 @@ class Database:
 
     async def update_limit_value(self, new_limit_value):
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 query = "UPDATE settings SET limit_value = %s WHERE id = 1"
                 await cursor.execute(query, (new_limit_value,))
@@ -372,7 +615,7 @@ class Database:
 
     async def get_all_users(self):
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor(aiomysql.DictCursor) as cursor:
                 query = "SELECT user_id, tg_name, bonus_points FROM users"
                 await cursor.execute(query)
@@ -380,7 +623,7 @@ class Database:
 
     async def get_user_count(self):
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 query = "SELECT COUNT(*) FROM users"
                 await cursor.execute(query)
@@ -389,7 +632,7 @@ class Database:
 
     async def get_users_paginated(self, offset, limit):
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor(aiomysql.DictCursor) as cursor:
                 query = "SELECT user_id, tg_name, bonus_points FROM users LIMIT %s OFFSET %s"
                 await cursor.execute(query, (limit, offset))
@@ -414,7 +657,7 @@ class Database:
     async def total_referrals_count(self):
         """ Возвращает общее количество рефералов """
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 await cursor.execute("SELECT COUNT(*) FROM users WHERE referer_id IS NOT NULL")
                 return (await cursor.fetchone())[0]
@@ -422,7 +665,7 @@ class Database:
     async def active_referrers_count(self):
         """ Возвращает количество активных рефереров """
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 await cursor.execute("""
                     SELECT COUNT(DISTINCT referer_id)
@@ -434,7 +677,7 @@ class Database:
 
     async def calculate_total_referral_bonuses(self):
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 query = """
                 SELECT SUM(bonus_points)
@@ -447,7 +690,7 @@ class Database:
 
     async def count_total_referrals(self):
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 query = """
                 SELECT COUNT(*)
@@ -460,7 +703,7 @@ class Database:
             
     async def count_active_referrers(self):
         await self.ensure_connected()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 query = """
                 SELECT COUNT(DISTINCT referer_id)
@@ -473,20 +716,62 @@ class Database:
                 return result[0] if result else 0
 
     async def is_bonus_awarded(self, user_id: int) -> bool:
+        bonus_awarded = self._from_snapshot(user_id, "bonus_awarded")
+        if bonus_awarded is not MISSING:
+            return bonus_awarded
         await self.ensure_connected()
         query = "SELECT bonus_awarded FROM users WHERE user_id = %s"
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 await cursor.execute(query, (user_id,))
                 result = await cursor.fetchone()
                 return result[0] if result else False
 
+    async def award_referral(self, user_id, referer_bonus, user_bonus):
+        """ Начисляет реферальные бонусы пользователю и его рефереру из users.referer_id одной транзакцией;
+        False, если реферера нет или бонусы уже были начислены. Реферер берётся из базы, а не из ссылки /start:
+        старый пользователь, пришедший по чужой ссылке, не переназначит бонус """
+        await self.ensure_connected()
+        async with self.acquire() as conn:
+            async with conn.cursor() as cursor:
+                try:
+                    await conn.begin()
+                    # FOR UPDATE: из двух одновременных нажатий второе дождётся первого и увидит флаг
+                    await cursor.execute(
+                        "SELECT referer_id FROM users WHERE user_id = %s AND COALESCE(bonus_awarded, FALSE) = FALSE "
+                        "FOR UPDATE", (user_id,))
+                    row = await cursor.fetchone()
+                    referer_id = row[0] if row else None
+                    if not referer_id or referer_id == user_id:
+                        await conn.rollback()
+                        return False
+                    await cursor.execute(
+                        "UPDATE users SET bonus_awarded = TRUE, bonus_points = bonus_points + %s WHERE user_id = %s",
+                        (user_bonus, user_id))
+                    await cursor.execute(
+                        "UPDATE users SET bonus_points = bonus_points + %s, referral_count = referral_count + 1 "
+                        "WHERE user_id = %s", (referer_bonus, referer_id))
+                    await conn.commit()
+                except Exception as e:
+                    await conn.rollback()
+                    logging.error(f"Ошибка при начислении реферальных бонусов {user_id}: {e}")
+                    raise
+        self.rollups.add_bonus(user_id, user_bonus)
+        self.rollups.add_bonus(referer_id, referer_bonus)
+        logging.info(f"Реферальные бонусы начислены: пользователь {user_id} +{user_bonus}, "
+                     f"реферер {referer_id} +{referer_bonus}")
+        self._patch_snapshot(user_id, "bonus_awarded", lambda _: True)
+        self._patch_snapshot(user_id, "bonus_points", lambda points: points + user_bonus)
+        await self._sync_leaderboard("credit", (user_id, user_bonus), (referer_id, referer_bonus))
+        return True
+
     async def mark_bonus_awarded(self, user_id: int):
         await self.ensure_connected()
         query = "UPDATE users SET bonus_awarded = TRUE WHERE user_id = %s"
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.cursor() as cursor:
                 await cursor.execute(query, (user_id,))
                 await conn.commit()
+        self._patch_snapshot(user_id, "bonus_awarded", lambda _: True)
 
 
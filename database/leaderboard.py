@@ -0,0 +1,220 @@
+import logging
+import uuid
+
+
+class Leaderboard:
+    """ Рейтинг по bonus_points в sorted set Redis: общий и по языкам. Начисление — ZINCRBY, топ читается
+    за O(log n + k), место пользователя — за O(log n) """
+
+    # Скрипты трогают только ключи из KEYS: рейтинг языка читается в Python и передаётся явно, а скрипт сверяет,
+    # что язык пользователя за это время не сменился. Все ключи под одним hash tag, то есть в одном слоте кластера.
+    # KEYS[1] — общий рейтинг, KEYS[2] — языки пользователей, KEYS[3..] — рейтинги языков.
+    # ARGV — четвёрки user_id, points, язык ('' — без языка), номер ключа его рейтинга в KEYS.
+    # Счёт в рейтинге языка — копия общего. Возвращает user_id, у которых язык успел смениться
+    credit_script = """
+        local stale = {}
+        for i = 1, #ARGV, 4 do
+            local score = redis.call('ZINCRBY', KEYS[1], ARGV[i + 1], ARGV[i])
+            local language = redis.call('HGET', KEYS[2], ARGV[i]) or ''
+            if language ~= ARGV[i + 2] then
+                table.insert(stale, ARGV[i])
+            elseif language ~= '' then
+                redis.call('ZADD', KEYS[tonumber(ARGV[i + 3])], score, ARGV[i])
+            end
+        end
+        return stale
+    """
+
+    # KEYS[3] — рейтинг языка пользователя: счёт копируется из общего, если язык всё ещё ARGV[2]
+    sync_language_script = """
+        if (redis.call('HGET', KEYS[2], ARGV[1]) or '') ~= ARGV[2] then
+            return 0
+        end
+        redis.call('ZADD', KEYS[3], redis.call('ZSCORE', KEYS[1], ARGV[1]) or 0, ARGV[1])
+        return 1
+    """
+
+    # KEYS[3] — рейтинг старого языка, KEYS[4] — нового (без языка — любой объявленный ключ, он не трогается).
+    # ARGV[1] — user_id, ARGV[2] — старый язык, ARGV[3] — новый; '' — без языка. 0, если язык успел смениться
+    set_language_script = """
+        if (redis.call('HGET', KEYS[2], ARGV[1]) or '') ~= ARGV[2] then
+            return 0
+        end
+        if ARGV[2] ~= '' then
+            redis.call('ZREM', KEYS[3], ARGV[1])
+        end
+        if ARGV[3] == '' then
+            redis.call('HDEL', KEYS[2], ARGV[1])
+            return 1
+        end
+        redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+        redis.call('ZADD', KEYS[4], redis.call('ZSCORE', KEYS[1], ARGV[1]) or 0, ARGV[1])
+        return 1
+    """
+
+    # Сколько раз перечитываем язык, если он меняется одновременно с начислением
+    attempts = 5
+
+    # Место = число пользователей со строго большим счётом + 1, поэтому при равенстве очков места совпадают.
+    # KEYS[1] — рейтинг, в котором считаем место, KEYS[2] — общий рейтинг со счётом пользователя.
+    # Кого нет в KEYS[1], у того места в нём нет, даже если он есть в общем рейтинге
+    rank_script = """
+        if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+            return false
+        end
+        local score = redis.call('ZSCORE', KEYS[2], ARGV[1])
+        if not score then
+            return false
+        end
+        return {redis.call('ZCOUNT', KEYS[1], '(' .. score, '+inf') + 1, redis.call('ZCARD', KEYS[1])}
+    """
+
+    def __init__(self, redis, prefix="leaderboard"):
+        self.redis = redis
+        self.prefix = prefix
+        # {prefix} — hash tag: рейтинги, имена, языки и временные ключи пересборки попадают в один слот
+        self.tag = f"{{{prefix}}}"
+        self.points_key = f"{self.tag}:points"
+        self.names_key = f"{self.tag}:names"
+        self.languages_key = f"{self.tag}:languages"
+        # Пока рейтинг не пересобран в этом процессе, топ и места читаются из MySQL
+        self.ready = False
+        self._credit = redis.register_script(self.credit_script)
+        self._sync_language = redis.register_script(self.sync_language_script)
+        self._set_language = redis.register_script(self.set_language_script)
+        self._rank = redis.register_script(self.rank_script)
+
+    def language_key(self, language, points_key=None):
+        return f"{points_key or self.points_key}:{language}"
+
+    async def rebuild(self, pool, page=10000):
+        """ Пересобирает рейтинг из users во временные ключи и подменяет их атомарным RENAME.
+        Вызывается в on_startup, до приёма апдейтов: начисления во время пересборки не потеряются """
+        temp_prefix = f"{self.tag}:rebuild:{uuid.uuid4().hex}"
+        temp_points_key = f"{temp_prefix}:points"
+        # Временный ключ -> постоянный; попадают сюда только непустые
+        written = {}
+        after_id = 0
+        total = 0
+        try:
+            while True:
+                async with pool.acquire() as conn:
+                    async with conn.cursor() as cursor:
+                        await cursor.execute(
+                            "SELECT user_id, tg_name, bonus_points, language FROM users WHERE user_id > %s "
+                            "ORDER BY user_id LIMIT %s", (after_id, page))
+                        rows = await cursor.fetchall()
+                if not rows:
+                    break
+                pipe = self.redis.pipeline(transaction=False)
+                pipe.zadd(temp_points_key, {user_id: bonus_points or 0 for user_id, _, bonus_points, _ in rows})
+                written[temp_points_key] = self.points_key
+                names = {user_id: tg_name for user_id, tg_name, _, _ in rows if tg_name}
+                if names:
+                    pipe.hset(f"{temp_prefix}:names", mapping=names)
+                    written[f"{temp_prefix}:names"] = self.names_key
+                languages = {user_id: language for user_id, _, _, language in rows if language}
+                if languages:
+                    pipe.hset(f"{temp_prefix}:languages", mapping=languages)
+                    written[f"{temp_prefix}:languages"] = self.languages_key
+                for user_id, _, bonus_points, language in rows:
+                    if language:
+                        temp_key = self.language_key(language, temp_points_key)
+                        pipe.zadd(temp_key, {user_id: bonus_points or 0})
+                        written[temp_key] = self.language_key(language)
+                await pipe.execute()
+                total += len(rows)
+                after_id = rows[-1][0]
+            # Рейтинги языков, которых больше нет в users, удаляются вместе с пустыми общими ключами
+            stale_keys = {self.points_key, self.names_key, self.languages_key}
+            stale_keys.update([key.decode() async for key in self.redis.scan_iter(match=self.language_key("*"))])
+            # Ключи прежнего формата без hash tag («<prefix>:points» и др.) больше не читаются
+            stale_keys.update([key.decode() async for key in self.redis.scan_iter(match=f"{self.prefix}:*")])
+            pipe = self.redis.pipeline()
+            for key in stale_keys - set(written.values()):
+                pipe.delete(key)
+            for temp_key, key in written.items():
+                pipe.rename(temp_key, key)
+            await pipe.execute()
+            self.ready = True
+        finally:
+            if written:
+                await self.redis.delete(*written)
+        logging.info(f"Рейтинг пересобран: {total} пользователей")
+
+    async def add_user(self, user_id, tg_name=None):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zadd(self.points_key, {user_id: 0}, nx=True)
+        if tg_name:
+            pipe.hset(self.names_key, user_id, tg_name)
+        await pipe.execute()
+
+    async def set_name(self, user_id, tg_name):
+        if tg_name:
+            await self.redis.hset(self.names_key, user_id, tg_name)
+        else:
+            await self.redis.hdel(self.names_key, user_id)
+
+    async def set_language(self, user_id, language):
+        for _ in range(self.attempts):
+            old = await self.redis.hget(self.languages_key, user_id)
+            old = old.decode() if old else ""
+            keys = [self.points_key, self.languages_key,
+                    self.language_key(old) if old else self.points_key,
+                    self.language_key(language) if language else self.points_key]
+            if await self._set_language(keys=keys, args=[user_id, old, language or ""]):
+                return
+        logging.warning(f"Не удалось перенести пользователя {user_id} в рейтинг языка {language}: язык меняется")
+
+    async def credit(self, *credits):
+        """ Принимает пары (user_id, points); все начисления одного события уходят одним вызовом скрипта """
+        languages = await self.redis.hmget(self.languages_key, [user_id for user_id, _ in credits])
+        keys = [self.points_key, self.languages_key]
+        args = []
+        for (user_id, points), language in zip(credits, languages):
+            language = language.decode() if language else ""
+            position = 0
+            if language:
+                key = self.language_key(language)
+                if key not in keys:
+                    keys.append(key)
+                position = keys.index(key) + 1
+            args.extend([user_id, points, language, position])
+        for user_id in await self._credit(keys=keys, args=args):
+            await self.sync_language(int(user_id))
+
+    async def sync_language(self, user_id):
+        """ Копирует общий счёт пользователя в рейтинг его текущего языка """
+        for _ in range(self.attempts):
+            language = await self.redis.hget(self.languages_key, user_id)
+            if not language:
+                return
+            language = language.decode()
+            keys = [self.points_key, self.languages_key, self.language_key(language)]
+            if await self._sync_language(keys=keys, args=[user_id, language]):
+                return
+        logging.warning(f"Не удалось обновить рейтинг языка пользователя {user_id}: язык меняется")
+
+    async def remove(self, user_id):
+        await self.set_language(user_id, None)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zrem(self.points_key, user_id)
+        pipe.hdel(self.names_key, user_id)
+        await pipe.execute()
+
+    async def top(self, limit=10):
+        """ Топ в формате get_top_users: user_id, tg_name, bonus_points """
+        entries = await self.redis.zrevrange(self.points_key, 0, limit - 1, withscores=True)
+        if not entries:
+            return []
+        names = await self.redis.hmget(self.names_key, [user_id for user_id, _ in entries])
+        return [
+            {"user_id": int(user_id), "tg_name": name.decode() if name else None, "bonus_points": int(points)}
+            for (user_id, points), name in zip(entries, names)
+        ]
+
+    async def rank(self, user_id, language=None):
+        """ (место, всего участников) в общем рейтинге или в рейтинге языка; None, если пользователя в нём нет """
+        key = self.language_key(language) if language else self.points_key
+        result = await self._rank(keys=[key, self.points_key], args=[user_id])
+        return (int(result[0]), int(result[1])) if result else None
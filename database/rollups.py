@@ -0,0 +1,231 @@
+import asyncio
+import logging
+from datetime import date, timedelta
+
+
+class DailyRollups:
+    """ Дневные агрегаты в daily_stats по (день, язык): регистрации, рефералы, активные пользователи, начисленные
+    бонусы. Исторические запросы админки читают только их, а не users """
+
+    def __init__(self, db, refresh_interval=600, activity_retention_days=35, flush_interval=5.0):
+        self.db = db
+        self.refresh_interval = refresh_interval
+        self.flush_interval = flush_interval
+        # Сырые отметки активности нужны только для пересчёта последних дней, дальше хватает daily_stats
+        self.activity_retention_days = activity_retention_days
+        # (день, user_id) -> очки. Начисления копятся в памяти и пишутся после своей транзакции: иначе каждое
+        # начисление держало бы строку users и ждало горячую строку daily_stats (день, язык)
+        self._bonuses = {}
+        # (день, user_id) активных: тот же поток апдейтов, что и у HyperLogLog-счётчиков ActiveUsers,
+        # поэтому DAU в /history и на экране аналитики считаются по одним и тем же пользователям
+        self._active = set()
+        self._lock = asyncio.Lock()
+        self._tasks = []
+
+    async def ensure_tables(self):
+        async with self.db.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS daily_stats (
+                        day DATE NOT NULL,
+                        language VARCHAR(8) NOT NULL DEFAULT '',
+                        registrations INT NOT NULL DEFAULT 0,
+                        referrals INT NOT NULL DEFAULT 0,
+                        active_users INT NOT NULL DEFAULT 0,
+                        bonus_points BIGINT NOT NULL DEFAULT 0,
+                        PRIMARY KEY (day, language)
+                    )
+                """)
+                await cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS daily_active_users (
+                        day DATE NOT NULL,
+                        user_id BIGINT NOT NULL,
+                        PRIMARY KEY (day, user_id)
+                    )
+                """)
+                # Последний день, за который refresh успешно пересчитал daily_stats: после простоя пересчёт
+                # начинается с него, а не со вчерашнего дня
+                await cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS rollup_watermarks (
+                        name VARCHAR(32) PRIMARY KEY,
+                        day DATE NOT NULL
+                    )
+                """)
+                await conn.commit()
+
+    async def ensure_backfilled(self):
+        """ Первый запуск: регистрации и рефералы за всю историю восстанавливаются из users одним проходом;
+        активность и бонусы за прошлые дни не восстановить, они копятся с этого момента. Последующие запуски
+        пересчитывают дни с отметки в rollup_watermarks, чтобы простой бота не оставил пропусков.
+        Вызывается из on_startup, а не из connect(). refresh пересчитывает дни целиком, поэтому backfill,
+        прерванный до отметки в schema_migrations, просто повторится """
+        async with self.db.acquire() as conn:
+            async with conn.cursor() as cursor:
+                backfilled = await self.db.is_migration_applied(cursor, "daily_stats_backfill")
+        if backfilled:
+            await self.refresh()
+            return
+        logging.info("Backfilling daily_stats from users...")
+        await self.refresh(since=date(1970, 1, 1))
+        async with self.db.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await self.db.mark_migration_applied(cursor, "daily_stats_backfill")
+                await conn.commit()
+        logging.info("daily_stats backfilled.")
+
+    def add_bonus(self, user_id, points):
+        """ Учитывает начисление в агрегате дня; вызывается после COMMIT самого начисления """
+        key = (date.today(), user_id)
+        self._bonuses[key] = self._bonuses.get(key, 0) + points
+
+    def add_active(self, user_id):
+        self._active.add((date.today(), user_id))
+
+    async def flush(self):
+        """ Пишет накопленных активных в daily_active_users, а начисления раскладывает по языкам пользователей
+        и добавляет в daily_stats """
+        async with self._lock:
+            if self._active:
+                active, self._active = self._active, set()
+                try:
+                    async with self.db.acquire() as conn:
+                        async with conn.cursor() as cursor:
+                            await cursor.executemany(
+                                "INSERT IGNORE INTO daily_active_users (day, user_id) VALUES (%s, %s)", list(active))
+                        await conn.commit()
+                except Exception:
+                    self._active |= active
+                    raise
+            if not self._bonuses:
+                return
+            bonuses, self._bonuses = self._bonuses, {}
+            try:
+                async with self.db.acquire() as conn:
+                    async with conn.cursor() as cursor:
+                        user_ids = list({user_id for _, user_id in bonuses})
+                        placeholders = ", ".join(["%s"] * len(user_ids))
+                        # Обычный SELECT — согласованное чтение без блокировок строк users
+                        await cursor.execute(
+                            f"SELECT user_id, COALESCE(language, '') FROM users WHERE user_id IN ({placeholders})",
+                            user_ids)
+                        languages = dict(await cursor.fetchall())
+                        totals = {}
+                        for (day, user_id), points in bonuses.items():
+                            key = (day, languages.get(user_id, ""))
+                            totals[key] = totals.get(key, 0) + points
+                        await cursor.executemany(
+                            "INSERT INTO daily_stats (day, language, bonus_points) VALUES (%s, %s, %s) "
+                            "ON DUPLICATE KEY UPDATE bonus_points = bonus_points + VALUES(bonus_points)",
+                            [(day, language, points) for (day, language), points in totals.items()])
+                    await conn.commit()
+            except Exception:
+                # Возвращаем начисления в буфер, не теряя пришедшие во время записи
+                for key, points in bonuses.items():
+                    self._bonuses[key] = self._bonuses.get(key, 0) + points
+                raise
+
+    async def refresh(self, since=None):
+        """ Пересчитывает регистрации, рефералов и активных за дни начиная с since (по умолчанию — с прошлого
+        успешного пересчёта, но не позже вчерашнего дня). Читаются только строки этих дней: users по
+        idx_registration_date и daily_active_users по ключу """
+        today = date.today()
+        async with self.db.acquire() as conn:
+            async with conn.cursor() as cursor:
+                if since is None:
+                    await cursor.execute("SELECT day FROM rollup_watermarks WHERE name = 'daily_stats'")
+                    watermark = await cursor.fetchone()
+                    since = min(watermark[0], today - timedelta(days=1)) if watermark else today - timedelta(days=1)
+                # Сначала обычные SELECT — согласованное чтение без блокировок. INSERT ... SELECT FROM users брал бы
+                # разделяемые next-key блокировки на users, пока начисления держат строки пользователей
+                await cursor.execute(
+                    "SELECT DATE(registration_date), COALESCE(language, ''), COUNT(*), COUNT(referer_id) "
+                    "FROM users WHERE registration_date >= %s "
+                    "GROUP BY DATE(registration_date), COALESCE(language, '')", (since,))
+                registrations = await cursor.fetchall()
+                await cursor.execute(
+                    "SELECT a.day, COALESCE(u.language, ''), COUNT(*) FROM daily_active_users a "
+                    "JOIN users u ON u.user_id = a.user_id WHERE a.day >= %s "
+                    "GROUP BY a.day, COALESCE(u.language, '')", (since,))
+                active = await cursor.fetchall()
+                await conn.commit()
+                try:
+                    await conn.begin()
+                    # Обнуляем пересчитываемые колонки: пользователь мог сменить язык, и его группа опустела
+                    await cursor.execute(
+                        "UPDATE daily_stats SET registrations = 0, referrals = 0, active_users = 0 WHERE day >= %s",
+                        (since,))
+                    if registrations:
+                        await cursor.executemany(
+                            "INSERT INTO daily_stats (day, language, registrations, referrals) "
+                            "VALUES (%s, %s, %s, %s) "
+                            "ON DUPLICATE KEY UPDATE registrations = VALUES(registrations), "
+                            "referrals = VALUES(referrals)", registrations)
+                    if active:
+                        await cursor.executemany(
+                            "INSERT INTO daily_stats (day, language, active_users) VALUES (%s, %s, %s) "
+                            "ON DUPLICATE KEY UPDATE active_users = VALUES(active_users)", active)
+                    await cursor.execute("DELETE FROM daily_active_users WHERE day < CURDATE() - INTERVAL %s DAY",
+                                         (self.activity_retention_days,))
+                    await cursor.execute(
+                        "INSERT INTO rollup_watermarks (name, day) VALUES ('daily_stats', %s) "
+                        "ON DUPLICATE KEY UPDATE day = VALUES(day)", (today,))
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._flush_periodically()),
+                           asyncio.create_task(self._refresh_periodically())]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Не удалось записать активность и начисления в дневные агрегаты: {e}")
+
+    async def _refresh_periodically(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.error(f"Не удалось обновить дневные агрегаты: {e}")
+
+    async def get_days(self, start_day, end_day):
+        """ Агрегаты по дням за [start_day, end_day], суммы по всем языкам """
+        async with self.db.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    "SELECT day, SUM(registrations), SUM(referrals), SUM(active_users), SUM(bonus_points) "
+                    "FROM daily_stats WHERE day BETWEEN %s AND %s GROUP BY day ORDER BY day",
+                    (start_day, end_day))
+                return [
+                    {"day": day, "registrations": int(registrations), "referrals": int(referrals),
+                     "active_users": int(active_users), "bonus_points": int(bonus_points)}
+                    for day, registrations, referrals, active_users, bonus_points in await cursor.fetchall()
+                ]
+
+    async def get_languages(self, start_day, end_day):
+        """ Суммы за [start_day, end_day] по языкам; active_user_days — сумма дневных активных, не уникальные """
+        async with self.db.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    "SELECT language, SUM(registrations), SUM(referrals), SUM(active_users), SUM(bonus_points) "
+                    "FROM daily_stats WHERE day BETWEEN %s AND %s GROUP BY language ORDER BY language",
+                    (start_day, end_day))
+                return [
+                    {"language": language or None, "registrations": int(registrations), "referrals": int(referrals),
+                     "active_user_days": int(active_users), "bonus_points": int(bonus_points)}
+                    for language, registrations, referrals, active_users, bonus_points in await cursor.fetchall()
+                ]
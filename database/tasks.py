@@ -0,0 +1,30 @@
+from typing import NamedTuple
+
+
+class Task(NamedTuple):
+    key: str  # Имя задания в коде; для старых заданий совпадает с их бывшей колонкой в users
+    bit: int  # Номер бита в users.task_flags; после выпуска задания не меняется
+
+
+# Выполненные задания хранятся битами в users.task_flags. Новое задание — новая строка со следующим
+# свободным битом, без изменения схемы; номера битов не переиспользуются
+TASKS = {
+    task.key: task for task in (
+        Task("task_name_completed", 0),
+        Task("task_subscribe_completed", 1),
+        Task("task_invite_completed", 2),
+        Task("task_repost_completed", 3),
+        Task("task_boost_completed", 4),
+    )
+}
+
+
+def task_mask(key):
+    try:
+        return 1 << TASKS[key].bit
+    except KeyError:
+        raise ValueError(f"Неизвестное задание: {key}") from None
+
+
+def is_completed(flags, key):
+    return bool(flags & task_mask(key))
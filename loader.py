@@ -0,0 +1,27 @@
+from redis.asyncio import Redis
+
+from config import (redis_config, db_config, DB_POOL_MINSIZE, DB_POOL_MAXSIZE, ACTIVITY_FLUSH_INTERVAL,
+                    ACTIVITY_BUFFER_SIZE, ROLLUP_REFRESH_INTERVAL, ANALYTICS_REFRESH_INTERVAL, MEMBERSHIP_TTL,
+                    MEMBERSHIP_NEGATIVE_TTL, MEMBERSHIP_CHECK_CONCURRENCY, CHANNELS)
+from app.membership import MembershipCache
+from database.active_users import ActiveUsers
+from database.analytics import AnalyticsCache
+from database.db import Database
+from database.leaderboard import Leaderboard
+from spam.suppression import SuppressionSet
+
+# Общие для всего процесса бота объекты
+redis = Redis(host=redis_config['host'], port=redis_config['port'], password=redis_config['password'])
+# Рейтинг по очкам в Redis: пересобирается в on_startup, дальше его обновляет каждое начисление в Database
+leaderboard = Leaderboard(redis)
+# Один Database на все роутеры; пул MySQL открывается и прогревается в on_startup
+db = Database(db_config, DB_POOL_MINSIZE, DB_POOL_MAXSIZE, ACTIVITY_FLUSH_INTERVAL, ACTIVITY_BUFFER_SIZE,
+              leaderboard=leaderboard, rollup_refresh_interval=ROLLUP_REFRESH_INTERVAL)
+suppression = SuppressionSet(redis)
+# Подписки на каналы проекта: индекс из channel_members, Bot API спрашиваем только про незнакомых пользователей
+membership = MembershipCache(redis, [channel_id for _, channel_id, _ in CHANNELS], MEMBERSHIP_TTL,
+                             MEMBERSHIP_NEGATIVE_TTL, MEMBERSHIP_CHECK_CONCURRENCY)
+# Активные пользователи по дням в HyperLogLog: DAU / WAU / MAU без сканирования users
+active_users = ActiveUsers(redis, ACTIVITY_FLUSH_INTERVAL)
+# Снимок аналитики админки, обновляется в фоне
+analytics = AnalyticsCache(db, ANALYTICS_REFRESH_INTERVAL, active_users)
@@ -0,0 +1,30 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from database.active_users import ActiveUsers
+from database.rollups import DailyRollups
+
+
+class ActiveUsersMiddleware(BaseMiddleware):
+    """ Отмечает зарегистрированного пользователя активным сегодня в HyperLogLog и в дневных агрегатах;
+    регистрируется после UserSnapshotMiddleware """
+
+    def __init__(self, active_users: ActiveUsers, rollups: DailyRollups = None):
+        self.active_users = active_users
+        self.rollups = rollups
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        snapshot = data.get("user_snapshot")
+        # Как и в SQL-метриках, считаем только пользователей из users
+        if snapshot is not None and snapshot["exists"]:
+            self.active_users.record(snapshot["user_id"], snapshot.get("referer_id"))
+            if self.rollups is not None:
+                self.rollups.add_active(snapshot["user_id"])
+        return await handler(event, data)
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendChatAction
+from redis.asyncio import Redis
+
+RETRY_AFTER_KEY = "telegram:retry_after"
+
+
+class ApiRateLimitMiddleware(BaseRequestMiddleware):
+    """ Пропускает каждый запрос к Bot API через общий для всех процессов token bucket в Redis """
+
+    # KEYS[1] — общий bucket токена, KEYS[2] — bucket чата, KEYS[3] — пауза после TelegramRetryAfter
+    # ARGV: скорость и ёмкость общего bucket, скорость и ёмкость bucket чата, резерв, учитывать ли чат
+    script = """
+        local paused = redis.call('PTTL', KEYS[3])
+        if paused > 0 then
+            return paused
+        end
+
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+        local function refill(key, rate, burst)
+            local state = redis.call('HMGET', key, 'tokens', 'ts')
+            local tokens = tonumber(state[1]) or burst
+            local ts = tonumber(state[2]) or now
+            return math.min(burst, tokens + (now - ts) * rate)
+        end
+
+        local global_rate, global_burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+        local chat_rate, chat_burst = tonumber(ARGV[3]), tonumber(ARGV[4])
+        local use_chat = ARGV[6] == '1'
+
+        -- Массовые отправки не трогают последние reserve токенов: они остаются для ответов пользователям
+        local need = 1 + tonumber(ARGV[5])
+        local global_tokens = refill(KEYS[1], global_rate, global_burst)
+        local wait = 0
+        if global_tokens < need then
+            wait = (need - global_tokens) / global_rate
+        end
+        local chat_tokens = 0
+        if use_chat then
+            chat_tokens = refill(KEYS[2], chat_rate, chat_burst)
+            if chat_tokens < 1 then
+                wait = math.max(wait, (1 - chat_tokens) / chat_rate)
+            end
+        end
+        if wait > 0 then
+            return math.max(1, math.ceil(wait * 1000))
+        end
+
+        redis.call('HSET', KEYS[1], 'tokens', global_tokens - 1, 'ts', now)
+        redis.call('EXPIRE', KEYS[1], 60)
+        if use_chat then
+            redis.call('HSET', KEYS[2], 'tokens', chat_tokens - 1, 'ts', now)
+            redis.call('EXPIRE', KEYS[2], 60)
+        end
+        return 0
+    """
+
+    def __init__(self, redis: Redis, bulk: bool = False, global_rate: float = 30, global_burst: int = 30,
+                 chat_rate: float = 1, chat_burst: int = 3, bulk_reserve: int = 5, prefix: str = "telegram:bucket"):
+        self.redis = redis
+        self.bulk = bulk
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.reserve = bulk_reserve if bulk else 0
+        self.prefix = prefix
+        self._acquire = redis.register_script(self.script)
+
+    async def acquire(self, chat_id=None):
+        keys = [f"{self.prefix}:global", f"{self.prefix}:chat:{chat_id}", RETRY_AFTER_KEY]
+        args = [self.global_rate, self.global_burst, self.chat_rate, self.chat_burst, self.reserve,
+                1 if chat_id is not None else 0]
+        while True:
+            wait_ms = await self._acquire(keys=keys, args=args)
+            if wait_ms <= 0:
+                return
+            await asyncio.sleep(wait_ms / 1000)
+
+    async def __call__(self, make_request, bot, method):
+        # Лимит на чат относится к сообщениям; запросы вроде get_chat_member идут только через общий bucket
+        chat_id = getattr(method, "chat_id", None)
+        is_message = type(method).__name__.startswith(("Send", "Copy", "Forward")) and not isinstance(
+            method, SendChatAction)
+        try:
+            await self.acquire(chat_id if is_message else None)
+        except Exception as e:
+            # Недоступный Redis не должен останавливать бота
+            logging.error(f"Rate limiter unavailable, sending without it: {e}")
+
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            # Ограничение действует на весь токен: останавливаем и бота, и воркеры рассылки
+            try:
+                await self.redis.set(RETRY_AFTER_KEY, 1, px=int(e.retry_after * 1000))
+            except Exception as redis_error:
+                logging.error(f"Не удалось передать паузу RetryAfter через Redis: {redis_error}")
+            raise e
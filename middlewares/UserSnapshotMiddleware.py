@@ -0,0 +1,40 @@
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from database.db import Database, current_user
+
+
+class UserSnapshotMiddleware(BaseMiddleware):
+    """ Загружает строку пользователя одним запросом на апдейт и отдаёт её хендлерам как user_snapshot """
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        chat = data.get("event_chat")
+        # Групповые чаты бот игнорирует (IgnoreNonPrivateMiddleware), строку для них не читаем
+        if user is None or (chat is not None and chat.type != "private"):
+            return await handler(event, data)
+
+        try:
+            snapshot = await self.db.load_user_snapshot(user.id)
+        except Exception as e:
+            # Без снимка аксессоры Database просто читают из MySQL, как раньше
+            logging.error(f"Не удалось загрузить данные пользователя {user.id}: {e}")
+            return await handler(event, data)
+
+        data["user_snapshot"] = snapshot
+        token = current_user.set(snapshot)
+        try:
+            return await handler(event, data)
+        finally:
+            current_user.reset(token)
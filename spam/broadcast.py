@@ -0,0 +1,79 @@
+import asyncio
+import logging
+
+from spam.rate_limiter import RateLimiter
+
+
+class Broadcast:
+    """ Рассылает одно сообщение списку пользователей: concurrency отправителей, общий темп задаёт limiter """
+
+    def __init__(self, spam_service, language, caption, photo, campaign_id, keyboard=None, rate=25, concurrency=20,
+                 status_writer=None, counters=None, limiter=None, progress=None):
+        self.spam_service = spam_service
+        self.language = language
+        self.caption = caption
+        self.photo = photo
+        self.campaign_id = campaign_id
+        self.keyboard = keyboard
+        self.concurrency = concurrency
+        self.limiter = limiter or RateLimiter(rate)
+        self.status_writer = status_writer
+        self.progress = progress
+        # После stop() (пауза или отмена) оставшиеся в очереди получатели не отправляются, а откладываются
+        self.stopped = False
+        self.deferred = []
+        # При возобновлении кампании счётчики продолжаются с сохранённых значений
+        self.counters = dict(counters) if counters else {"sent": 0, "failed": 0, "blocked": 0}
+        self._queue = None
+        self._workers = []
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        self._workers = [asyncio.create_task(self._worker(self._queue)) for _ in range(self.concurrency)]
+
+    async def submit(self, user_id):
+        await self._queue.put(user_id)
+
+    def stop(self):
+        self.stopped = True
+
+    async def join(self):
+        await self._queue.join()
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+    async def run(self, user_ids):
+        self.start()
+        try:
+            for user_id in user_ids:
+                await self.submit(user_id)
+            await self.join()
+        finally:
+            await self.close()
+        return self.counters
+
+    async def _worker(self, queue):
+        while True:
+            user_id = await queue.get()
+            try:
+                if self.stopped:
+                    self.deferred.append(user_id)
+                    continue
+                if self.progress:
+                    # Отметка до отправки: после падения воркера такой получатель не будет отправлен повторно
+                    await self.progress.mark_inflight(user_id)
+                status = await self.spam_service.send_message(
+                    user_id, self.language, self.caption, self.photo, self.campaign_id, self.keyboard,
+                    limiter=self.limiter, status_writer=self.status_writer
+                )
+            except Exception as e:
+                status = "failed"
+                logging.error(f"Failed to send message to user {user_id}: {e}")
+            finally:
+                queue.task_done()
+            self.counters[status] += 1
+            if self.progress:
+                self.progress.add(status)
@@ -1,24 +1,31 @@
+import json
 import logging
-import asyncio
+import uuid
 import dramatiq
-from aiogram import Bot
-from aiogram.exceptions import TelegramRetryAfter, TelegramAPIError, TelegramForbiddenError
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from dramatiq.brokers.redis import RedisBroker
-from config import db_config, redis_config, TOKEN, ADMINS
-from spam.spam_service import SpamService
+from config import (redis_config, ADMINS, MAILING_RATE, MAILING_CONCURRENCY,
+                    MAILING_STATUS_BATCH, MAILING_STATUS_FLUSH_INTERVAL, MAILING_PAGE_SIZE, MAILING_TIME_BUDGET,
+                    MAILING_SHARD_SIZE, MAILING_PROGRESS_INTERVAL, MAILING_PAUSE_POLL, MAILING_SHARD_STALE_AFTER,
+                    MAILING_PROGRESS_MAX_UPDATES)
+from aiogram.exceptions import TelegramBadRequest
+from spam.broadcast import Broadcast
+from spam.progress import CampaignProgress, ProgressMonitor, render_progress
+from spam.rate_limiter import RedisRateLimiter
+from spam.status_writer import StatusWriter
+from spam.worker import WorkerResources
 import time
 
 # Настройка Dramatiq с использованием Redis как брокера
 redis_broker = RedisBroker(host=redis_config['host'], port=redis_config['port'], password=redis_config['password'])
+# Бот и сервис рассылки живут в потоке воркера и переиспользуются всеми его сообщениями
+worker_resources = WorkerResources()
+redis_broker.add_middleware(worker_resources)
 dramatiq.set_broker(redis_broker)
 
-# Инициализация бота и сервиса рассылки
-bot = Bot(token=TOKEN)
-spam_service = SpamService(db_config, redis_config, bot)
-
 # Проверка нагрузки на бота
 async def check_bot_limits():
+    bot = worker_resources.current().bot
     try:
         start_time = time.time()
         await bot.get_me()  # Запрос к Telegram API для проверки скорости ответа
@@ -28,67 +35,242 @@ async def check_bot_limits():
         logging.error(f"Ошибка при проверке лимитов бота: {e}")
         return None
 
-# Задача для подготовки и отправки массовой рассылки
-async def prepare_mass_mailing_task(language, photo, caption, campaign_id, keyboard_data):
+# Задача для подготовки массовой рассылки: делит аудиторию на шарды и раздаёт их воркерам
+async def prepare_mass_mailing_task(language, photo, caption, campaign_id, keyboard_data, rate=MAILING_RATE,
+                                    progress_chat_id=None, progress_message_id=None):
+    spam_service = worker_resources.current().spam_service
+    await spam_service.connect()
+    campaign = await spam_service.get_or_create_campaign(campaign_id, language, photo, caption, keyboard_data, rate)
+    if campaign['status'] != 'running':
+        logging.info(f"Campaign {campaign_id} is already {campaign['status']}. Skipping.")
+        return
+
+    audience_language = language if language != 'all' else None
+    shards = await spam_service.get_or_create_shards(
+        campaign_id, lambda: spam_service.get_shard_bounds(audience_language, MAILING_SHARD_SIZE)
+    )
+    logging.info(f"Campaign {campaign_id} for language '{language}' split into {len(shards)} shards, rate: {rate} msg/s")
+
+    # Счётчики и управление кампанией живут в Redis: шарды пишут в них, админ видит прогресс и меняет темп
+    progress = CampaignProgress(spam_service.redis, campaign_id)
+    await progress.init(await spam_service.count_audience(audience_language), rate,
+                        progress_chat_id, progress_message_id)
+    if progress_chat_id and progress_message_id and await progress.claim_reporter():
+        report_mailing_progress.send(campaign_id, progress_chat_id, progress_message_id)
+
+    if not shards:
+        await progress.finish('done')
+        await report_campaign(campaign_id, await spam_service.finish_campaign(campaign_id))
+        return
+
+    # При повторе координатора ставим в очередь только шарды, которые ещё никто не взял
+    for shard in shards:
+        if shard['status'] == 'running' and shard['token'] is None:
+            send_mailing_shard.send(campaign_id, shard['shard_no'], str(uuid.uuid4()))
+
+# Задача для отправки одного шарда рассылки
+async def send_mailing_shard_task(campaign_id, shard_no, token):
+    spam_service = worker_resources.current().spam_service
     await spam_service.connect()
-    user_ids = await spam_service.get_user_ids_by_language(language if language != 'all' else None)
-    logging.info(f"Selected users for language '{language}'. Total users: {len(user_ids)}")
+    shard = await spam_service.acquire_shard(campaign_id, shard_no, token)
+    if not shard:
+        logging.info(f"Shard {shard_no} of campaign {campaign_id} is done or owned by another message. Skipping.")
+        return
+    campaign = await spam_service.get_campaign(campaign_id)
+    language, photo, caption = campaign['language'], campaign['photo'], campaign['caption']
+    keyboard_data = json.loads(campaign['keyboard']) if campaign['keyboard'] else None
+
+    # Продолжаем с курсора шарда: повторная попытка Dramatiq или продолжение не начинают шард сначала
+    last_user_id = shard['last_user_id']
+    counters = {
+        "sent": shard['sent_count'],
+        "failed": shard['failed_count'],
+        "blocked": shard['blocked_count'],
+    }
+
+    progress = CampaignProgress(spam_service.redis, campaign_id)
+    control = await progress.get_control()
+    state = control.get('state', 'running')
+    if state == 'paused':
+        # Шард на паузе не держит поток воркера: проверяет состояние снова через MAILING_PAUSE_POLL секунд.
+        # Отметка в checkpoint показывает наблюдателю кампании, что шард жив, хотя курсор стоит
+        await spam_service.save_checkpoint(campaign_id, shard_no, last_user_id, counters)
+        send_mailing_shard.send_with_options(args=(campaign_id, shard_no, token), delay=MAILING_PAUSE_POLL * 1000)
+        return
+    if state == 'cancelled':
+        await finish_mailing_shard(spam_service, progress, campaign_id, shard_no, last_user_id, counters)
+        return
+    rate = float(control.get('rate') or campaign['rate'])
+    logging.info(f"Shard {shard_no} of campaign {campaign_id}: sending to users after {last_user_id}")
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(**btn) for btn in row] for row in keyboard_data
     ]) if keyboard_data else None
 
-    sent_count = 0
-    error_count = 0
-
-    for user_id in user_ids:
-        try:
-            await spam_service.send_message(user_id, language, caption, photo, campaign_id, keyboard)
-            sent_count += 1
-        except TelegramForbiddenError:
-            error_count += 1
-            logging.error(f"Bot was blocked by user {user_id}. Skipping.")
-        except TelegramRetryAfter as e:
-            logging.warning(f"Retry after {e.retry_after} seconds for user {user_id}")
-            await asyncio.sleep(e.retry_after)
-            try:
-                await spam_service.send_message(user_id, language, caption, photo, campaign_id, keyboard)
-                sent_count += 1
-            except Exception as e:
-                error_count += 1
-                logging.error(f"Failed to send message to user {user_id} after retry: {e}")
-        except Exception as e:
-            error_count += 1
-            logging.error(f"Failed to send message to user {user_id}: {e}")
+    # Темп задаётся на всю кампанию и делится между всеми её шардами через Redis
+    limiter = RedisRateLimiter(spam_service.redis, f"mailing:budget:{campaign_id}", rate)
+    status_writer = StatusWriter(spam_service.pool, MAILING_STATUS_BATCH, MAILING_STATUS_FLUSH_INTERVAL,
+                                 suppression=spam_service.suppression, progress=progress)
+    status_writer.start()
+    broadcast = Broadcast(spam_service, language, caption, photo, campaign_id, keyboard,
+                          concurrency=MAILING_CONCURRENCY, status_writer=status_writer, counters=counters,
+                          limiter=limiter, progress=progress)
+    broadcast.start()
+    # Монитор раз в секунду сбрасывает счётчики в Redis и применяет паузу, отмену и новый темп
+    monitor = ProgressMonitor(progress, broadcast)
+    monitor.start()
+    started_at = time.monotonic()
+    finished = True
+    # Свой токен у каждого запуска шарда: повтор того же сообщения не примет чужие закрепления за свои
+    run_token = str(uuid.uuid4())
+    try:
+        # Курсор двигается при постановке в очередь, а не при отправке: после падения воркера закреплённые,
+        # но не отправленные получатели остаются pending до курсора — отправляем их первыми. Тех, чья отправка
+        # уже началась, пропускаем: доставку не проверить, а второй раз сообщение слать нельзя
+        pending = await spam_service.get_pending_recipients(campaign_id, shard['start_after'], last_user_id)
+        pending, started = await progress.split_inflight(pending)
+        if started:
+            logging.warning(f"Shard {shard_no} of campaign {campaign_id}: {len(started)} recipients were being sent "
+                            f"when the previous run stopped, their delivery is unknown. Not resending.")
+        for user_id in pending:
+            await broadcast.submit(user_id)
+        # Отправка начинается с первой страницы, не дожидаясь выборки всей аудитории шарда
+        pages = spam_service.iter_user_ids_by_language(
+            language if language != 'all' else None, last_user_id, shard['end_id'], MAILING_PAGE_SIZE
+        )
+        async for page in pages:
+            # Заблокировавших бота отсекаем по множеству в Redis, без запроса к базе на каждого пользователя
+            recipients = await spam_service.suppression.filter(page)
+            progress.add("skipped", len(page) - len(recipients))
+            for user_id in await spam_service.claim_recipients(campaign_id, recipients, language, caption, photo,
+                                                               run_token):
+                await broadcast.submit(user_id)
+            last_user_id = page[-1]
+            await spam_service.save_checkpoint(campaign_id, shard_no, last_user_id, broadcast.counters)
+
+            if broadcast.stopped:
+                finished = False
+                break
+            # Заканчиваем раньше time_limit и ставим продолжение в очередь вместо таймаута
+            if time.monotonic() - started_at > MAILING_TIME_BUDGET and len(page) == MAILING_PAGE_SIZE:
+                finished = False
+                break
+        await broadcast.join()
+    finally:
+        await broadcast.close()
+        # Сбрасываем буфер статусов и при штатном завершении, и при остановке воркера
+        await status_writer.close()
+        await monitor.close()
 
-    # Уведомляем администраторов о завершении рассылки
-    await notify_admins(f"Рассылка с ID {campaign_id} завершена. Сообщения отправлены: {sent_count}, ошибки: {error_count}.")
+    if broadcast.deferred:
+        # Неотправленных из-за паузы или отмены возвращаем в аудиторию и откатываем курсор к первому из них
+        await spam_service.release_recipients(campaign_id, broadcast.deferred)
+        last_user_id = min(broadcast.deferred) - 1
+
+    if monitor.state == 'cancelled':
+        await finish_mailing_shard(spam_service, progress, campaign_id, shard_no, last_user_id, broadcast.counters)
+        return
+
+    if monitor.state == 'paused':
+        await spam_service.save_checkpoint(campaign_id, shard_no, last_user_id, broadcast.counters)
+        send_mailing_shard.send_with_options(args=(campaign_id, shard_no, token), delay=MAILING_PAUSE_POLL * 1000)
+        logging.info(f"Shard {shard_no} of campaign {campaign_id} paused by admin at user {last_user_id}.")
+        return
+
+    if not finished:
+        await spam_service.save_checkpoint(campaign_id, shard_no, last_user_id, broadcast.counters)
+        send_mailing_shard.send(campaign_id, shard_no, token)
+        logging.info(f"Shard {shard_no} of campaign {campaign_id} paused at user {last_user_id}, continuation enqueued.")
+        return
 
-async def send_notification_task(user_id, photo, caption, campaign_id, delay):
+    await finish_mailing_shard(spam_service, progress, campaign_id, shard_no, last_user_id, broadcast.counters)
+
+async def finish_mailing_shard(spam_service, progress, campaign_id, shard_no, last_user_id, counters):
+    # Итоговый отчёт отправляет только последний завершившийся шард
+    totals = await spam_service.finish_shard(campaign_id, shard_no, last_user_id, counters)
+    if totals:
+        control = await progress.get_control()
+        await progress.finish('cancelled' if control.get('state') == 'cancelled' else 'done')
+        await report_campaign(campaign_id, totals)
+
+# Обновление сообщения администратора с ходом рассылки: скорость, ошибки и оставшееся время.
+# Заодно это наблюдатель кампании: передаёт шарды упавших воркеров новым сообщениям
+async def report_mailing_progress_task(campaign_id, chat_id, message_id):
+    bot = worker_resources.current().bot
+    progress = CampaignProgress(worker_resources.current().redis, campaign_id)
+    data = await progress.get_progress()
+    if not data:
+        return
+    if not data.get('finished'):
+        await watch_campaign(progress, campaign_id)
+        data = await progress.get_progress()
+    control = await progress.get_control()
+    now = time.time()
+    text, keyboard = render_progress(campaign_id, data, control, now)
     try:
-        await spam_service.send_message(user_id, caption, photo, campaign_id)
-        await asyncio.sleep(delay)  # Задержка для управления скоростью отправки
-    except TelegramRetryAfter as e:
-        logging.warning(f"Retry after {e.retry_after} seconds for user {user_id}")
-        await asyncio.sleep(e.retry_after)
-        await send_notification_task(user_id, photo, caption, campaign_id, delay)
-    except TelegramForbiddenError:
-        logging.error(f"Bot was blocked by user {user_id}. Skipping.")
-        await spam_service.update_message_status(user_id, "failed", campaign_id)
-    except TelegramAPIError as e:
-        logging.error(f"Telegram API error: {e}. Message to user {user_id} failed.")
-        await spam_service.update_message_status(user_id, "failed", campaign_id)
-    except Exception as e:
-        logging.error(f"Failed to send message to user {user_id}: {e}")
-        await spam_service.update_message_status(user_id, "failed", campaign_id)
+        await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, reply_markup=keyboard,
+                                    parse_mode="HTML")
+    except TelegramBadRequest as e:
+        # «message is not modified» — прогресс не изменился с прошлого обновления
+        if "not modified" not in str(e):
+            logging.error(f"Не удалось обновить прогресс рассылки {campaign_id}: {e}")
+
+    if data.get('finished'):
+        return
+    processed = sum(int(data.get(field, 0)) for field in ("sent", "failed", "blocked", "skipped"))
+    await progress.redis.hset(progress.progress_key, mapping={"last_processed": processed, "last_ts": now})
+    report_mailing_progress.send_with_options(args=(campaign_id, chat_id, message_id),
+                                              delay=MAILING_PROGRESS_INTERVAL * 1000)
+
+async def watch_campaign(progress, campaign_id):
+    """ Переотправляет брошенные шарды; после MAILING_PROGRESS_MAX_UPDATES обновлений закрывает кампанию как failed,
+    чтобы цепочка обновлений не жила вечно """
+    spam_service = worker_resources.current().spam_service
+    await spam_service.connect()
+    if await progress.count_report() > MAILING_PROGRESS_MAX_UPDATES:
+        # Отмена останавливает ещё живые шарды, fail_campaign закрывает и те, что не завершатся никогда
+        await progress.set_state('cancelled')
+        totals = await spam_service.fail_campaign(campaign_id)
+        await progress.finish('failed')
+        if totals:
+            logging.error(f"Campaign {campaign_id} did not finish after {MAILING_PROGRESS_MAX_UPDATES} progress "
+                          f"updates, marked as failed.")
+            await notify_admins(
+                f"Рассылка с ID {campaign_id} не завершилась вовремя и остановлена. Сообщения отправлены: "
+                f"{totals['sent']}, ошибки: {totals['failed']}, заблокировали бота: {totals['blocked']}."
+            )
+        return
+    for shard_no in await spam_service.reclaim_stale_shards(campaign_id, MAILING_SHARD_STALE_AFTER):
+        logging.warning(f"Shard {shard_no} of campaign {campaign_id} made no progress for "
+                        f"{MAILING_SHARD_STALE_AFTER} s, re-enqueued.")
+        send_mailing_shard.send(campaign_id, shard_no, str(uuid.uuid4()))
+
+async def report_campaign(campaign_id, counters):
+    # Уведомляем администраторов о завершении рассылки
+    await notify_admins(
+        f"Рассылка с ID {campaign_id} завершена. Сообщения отправлены: {counters['sent']}, "
+        f"ошибки: {counters['failed']}, заблокировали бота: {counters['blocked']}."
+    )
+
+async def send_notification_task(user_id, photo, caption, campaign_id):
+    spam_service = worker_resources.current().spam_service
+    await spam_service.connect()
+    if not await spam_service.suppression.filter([user_id]):
+        logging.info(f"User {user_id} has blocked the bot. Skipping notification.")
+        return
+    status = await spam_service.send_message(user_id, None, caption, photo, campaign_id)
+    if status != "sent":
+        logging.error(f"Message to user {user_id} failed with status '{status}'.")
 
 # Уведомление администраторов о ходе рассылки
 async def notify_admins(message):
+    bot = worker_resources.current().bot
     for admin_id in ADMINS:
         await bot.send_message(admin_id, message)
 
 # Уведомление пользователя об ошибке
 async def notify_user_about_error(user_id, message):
+    bot = worker_resources.current().bot
     try:
         await bot.send_message(user_id, message)
     except Exception as e:
@@ -96,10 +278,26 @@ async def notify_user_about_error(user_id, message):
 
 # Акторы Dramatiq для обработки задач в очереди
 @dramatiq.actor(max_retries=5, time_limit=300000)  # Увеличьте время до 300000 мс (5 минут)
-def prepare_mass_mailing(language, photo, caption, campaign_id, keyboard_data):
-    asyncio.run(prepare_mass_mailing_task(language, photo, caption, campaign_id, keyboard_data))
+def prepare_mass_mailing(language, photo, caption, campaign_id, keyboard_data, rate=MAILING_RATE,
+                         progress_chat_id=None, progress_message_id=None):
+    worker_resources.run(prepare_mass_mailing_task(language, photo, caption, campaign_id, keyboard_data, rate,
+                                                   progress_chat_id, progress_message_id))
+
+
+# notify_shutdown: при остановке воркера Dramatiq прерывает актор, и буфер статусов успевает сброситься
+@dramatiq.actor(max_retries=5, time_limit=300000, notify_shutdown=True)
+def send_mailing_shard(campaign_id, shard_no, token):
+    worker_resources.run(send_mailing_shard_task(campaign_id, shard_no, token))
+
+
+# Пропущенное обновление не страшно: следующее покажет актуальные цифры
+@dramatiq.actor(max_retries=3, time_limit=60000)
+def report_mailing_progress(campaign_id, chat_id, message_id):
+    worker_resources.run(report_mailing_progress_task(campaign_id, chat_id, message_id))
 
 
 @dramatiq.actor(max_retries=5, time_limit=300000)  # Увеличьте время до 300000 мс (5 минут)
 def send_notification(user_id, photo, caption, campaign_id):
-    asyncio.run(send_notification_task(user_id, photo, caption, campaign_id))
\ No newline at end of file
+    started_at = time.perf_counter()
+    worker_resources.run(send_notification_task(user_id, photo, caption, campaign_id))
+    logging.info(f"send_notification for user {user_id} took {(time.perf_counter() - started_at) * 1000:.1f} ms")
\ No newline at end of file
@@ -6,8 +6,10 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.filters.state import StateFilter
-from spam.dramatiq_tasks import prepare_mass_mailing, spam_service, notify_admins
+from spam.dramatiq_tasks import prepare_mass_mailing
+from spam.progress import CampaignProgress
 from aiogram.exceptions import TelegramBadRequest
+from loader import redis
 
 from config import TOKEN, ADMINS
 
@@ -210,10 +212,14 @@ async def confirm_spam(callback_query: CallbackQuery, state: FSMContext):
         # Преобразуем кнопки в словари перед отправкой задачи
         keyboard_data = [[{'text': btn.text, 'url': btn.url} for btn in row] for row in keyboard] if keyboard else None
 
-        # Запуск задачи на отправку рассылки
-        prepare_mass_mailing.send(language, photo, caption, campaign_id, keyboard_data)
+        # Сообщение о запуске потом обновляется ходом рассылки, в нём же кнопки управления
+        status_message = await callback_query.message.answer("🚀 Рассылка запущена! Готовим аудиторию…",
+                                                             parse_mode="HTML")
 
-        await callback_query.message.answer("🚀 Рассылка запущена!", parse_mode="HTML")
+        # Запуск задачи на отправку рассылки
+        prepare_mass_mailing.send(language, photo, caption, campaign_id, keyboard_data,
+                                  progress_chat_id=status_message.chat.id,
+                                  progress_message_id=status_message.message_id)
     except TelegramBadRequest as e:
         logging.error(f"Skipping BadRequest error: {e}")
         await callback_query.message.answer("⚠️ Произошла ошибка, но рассылка продолжается.", parse_mode="HTML")
@@ -223,4 +229,30 @@ async def confirm_spam(callback_query: CallbackQuery, state: FSMContext):
     finally:
         await state.clear()
 
-
+# Управление идущей рассылкой из сообщения с её прогрессом; шарды применяют изменения в течение секунды
+@router.callback_query(F.data.startswith(("mailing_pause:", "mailing_resume:", "mailing_cancel:")),
+                       F.from_user.id.in_(ADMINS))
+async def control_mailing(callback_query: CallbackQuery):
+    action, campaign_id = callback_query.data.split(":")
+    progress = CampaignProgress(redis, campaign_id)
+    control = await progress.get_control()
+    if not control or control.get("state") == "cancelled":
+        await callback_query.answer("Рассылка не найдена или уже отменена.", show_alert=True)
+        return
+    state, answer = {
+        "mailing_pause": ("paused", "⏸ Рассылка приостановлена"),
+        "mailing_resume": ("running", "▶️ Рассылка продолжается"),
+        "mailing_cancel": ("cancelled", "⏹ Рассылка отменена"),
+    }[action]
+    await progress.set_state(state)
+    await callback_query.answer(answer)
+
+@router.callback_query(F.data.startswith("mailing_rate:"), F.from_user.id.in_(ADMINS))
+async def change_mailing_rate(callback_query: CallbackQuery):
+    _, campaign_id, delta = callback_query.data.split(":")
+    progress = CampaignProgress(redis, campaign_id)
+    if not await progress.get_control():
+        await callback_query.answer("Рассылка не найдена или уже завершена.", show_alert=True)
+        return
+    rate = await progress.change_rate(int(delta))
+    await callback_query.answer(f"⚡ Новая скорость: {rate:g} сообщ./с")
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import time
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+STATES = {
+    "running": "🚀 идёт",
+    "paused": "⏸ на паузе",
+    "cancelled": "⏹ отменена",
+    "done": "✅ завершена",
+    "failed": "⚠️ прервана",
+}
+
+
+class CampaignProgress:
+    """ Счётчики и управление кампанией в Redis: шарды пишут прогресс, админ меняет состояние и темп """
+
+    ttl = 7 * 24 * 3600
+
+    def __init__(self, redis, campaign_id):
+        self.redis = redis
+        self.campaign_id = campaign_id
+        self.progress_key = f"mailing:progress:{campaign_id}"
+        self.control_key = f"mailing:control:{campaign_id}"
+        # Получатели, чья отправка началась, но итоговый статус ещё не записан в messages
+        self.inflight_key = f"mailing:inflight:{campaign_id}"
+        self._deltas = {}
+
+    async def init(self, total, rate, chat_id=None, message_id=None):
+        pipe = self.redis.pipeline()
+        pipe.hsetnx(self.progress_key, "total", total)
+        pipe.hsetnx(self.progress_key, "started_at", time.time())
+        if chat_id and message_id:
+            pipe.hsetnx(self.progress_key, "chat_id", chat_id)
+            pipe.hsetnx(self.progress_key, "message_id", message_id)
+        pipe.hsetnx(self.control_key, "state", "running")
+        pipe.hsetnx(self.control_key, "rate", rate)
+        pipe.expire(self.progress_key, self.ttl)
+        pipe.expire(self.control_key, self.ttl)
+        await pipe.execute()
+
+    async def claim_reporter(self):
+        """ True только для первого вызова по кампании: цепочка обновлений прогресса запускается один раз,
+        даже если координатор рассылки выполняется повторно """
+        return bool(await self.redis.hsetnx(self.progress_key, "reporter_started", 1))
+
+    async def count_report(self):
+        """ Номер текущего обновления прогресса: по нему цепочка обновлений ограничена сверху """
+        return await self.redis.hincrby(self.progress_key, "reports", 1)
+
+    async def mark_inflight(self, user_id):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.sadd(self.inflight_key, user_id)
+        pipe.expire(self.inflight_key, self.ttl)
+        await pipe.execute()
+
+    async def clear_inflight(self, user_ids):
+        if user_ids:
+            await self.redis.srem(self.inflight_key, *user_ids)
+
+    async def split_inflight(self, user_ids):
+        """ Делит pending-получателей на (не начатых, начатых): исход начатых неизвестен, второй раз их не шлём """
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.sismember(self.inflight_key, user_id)
+        flags = await pipe.execute() if user_ids else []
+        started = {user_id for user_id, flag in zip(user_ids, flags) if flag}
+        return [user_id for user_id in user_ids if user_id not in started], sorted(started)
+
+    def add(self, field, amount=1):
+        self._deltas[field] = self._deltas.get(field, 0) + amount
+
+    async def sync(self):
+        """ Сбрасывает накопленные приращения одной транзакцией и возвращает текущее управление кампанией """
+        deltas, self._deltas = self._deltas, {}
+        pipe = self.redis.pipeline()
+        for field, amount in deltas.items():
+            if isinstance(amount, float):
+                pipe.hincrbyfloat(self.progress_key, field, amount)
+            else:
+                pipe.hincrby(self.progress_key, field, amount)
+        pipe.hgetall(self.control_key)
+        try:
+            control = (await pipe.execute())[-1]
+        except Exception:
+            # Не теряем приращения, если Redis временно недоступен
+            for field, amount in deltas.items():
+                self.add(field, amount)
+            raise
+        return {key.decode(): value.decode() for key, value in control.items()}
+
+    async def get_control(self):
+        control = await self.redis.hgetall(self.control_key)
+        return {key.decode(): value.decode() for key, value in control.items()}
+
+    async def get_progress(self):
+        progress = await self.redis.hgetall(self.progress_key)
+        return {key.decode(): value.decode() for key, value in progress.items()}
+
+    async def set_state(self, state):
+        await self.redis.hset(self.control_key, "state", state)
+
+    async def change_rate(self, delta, minimum=1, maximum=30):
+        rate = float(await self.redis.hget(self.control_key, "rate") or minimum)
+        rate = min(maximum, max(minimum, rate + delta))
+        await self.redis.hset(self.control_key, "rate", rate)
+        return rate
+
+    async def finish(self, state):
+        await self.redis.hset(self.progress_key, "finished", state)
+
+
+class ProgressMonitor:
+    """ Фоновая задача шарда: раз в interval секунд пишет прогресс и применяет паузу, отмену и новый темп """
+
+    def __init__(self, progress, broadcast, interval=1.0):
+        self.progress = progress
+        self.broadcast = broadcast
+        self.interval = interval
+        self.state = "running"
+        self._retry_after_seen = broadcast.limiter.retry_after_total
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def apply(self):
+        retry_after = self.broadcast.limiter.retry_after_total
+        if retry_after > self._retry_after_seen:
+            self.progress.add("retry_after", float(retry_after - self._retry_after_seen))
+            self._retry_after_seen = retry_after
+        control = await self.progress.sync()
+        self.state = control.get("state", "running")
+        if self.state != "running":
+            self.broadcast.stop()
+        rate = float(control.get("rate") or 0)
+        if rate > 0 and rate != self.broadcast.limiter.rate:
+            self.broadcast.limiter.rate = rate
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        try:
+            await self.apply()
+        except Exception as e:
+            logging.error(f"Failed to sync progress of campaign {self.progress.campaign_id}: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.apply()
+            except Exception as e:
+                logging.error(f"Failed to sync progress of campaign {self.progress.campaign_id}: {e}")
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours} ч {minutes} мин"
+    if minutes:
+        return f"{minutes} мин {seconds} с"
+    return f"{seconds} с"
+
+
+def render_progress(campaign_id, progress, control, now=None):
+    """ Текст и клавиатура сообщения о ходе рассылки; rate — средняя скорость с прошлого обновления """
+    now = now or time.time()
+    total = int(progress.get("total", 0))
+    sent = int(progress.get("sent", 0))
+    failed = int(progress.get("failed", 0))
+    blocked = int(progress.get("blocked", 0))
+    skipped = int(progress.get("skipped", 0))
+    processed = sent + failed + blocked + skipped
+    state = progress.get("finished") or control.get("state", "running")
+
+    last_processed = int(float(progress.get("last_processed", 0)))
+    last_ts = float(progress.get("last_ts") or progress.get("started_at") or now)
+    rate = (processed - last_processed) / (now - last_ts) if now > last_ts else 0.0
+    eta = (total - processed) / rate if rate > 0 and total > processed else None
+    percent = processed * 100 // total if total else 100
+
+    text = (
+        f"📬 <b>Рассылка</b> <code>{campaign_id}</code>\n"
+        f"Статус: {STATES.get(state, state)}\n\n"
+        f"Обработано: {processed} из {total} ({percent}%)\n"
+        f"✅ Отправлено: {sent}\n"
+        f"❌ Ошибки: {failed}\n"
+        f"🚫 Заблокировали бота: {blocked}\n"
+        f"⏭ Пропущено: {skipped}\n"
+        f"⏳ Ожидание по RetryAfter: {float(progress.get('retry_after', 0)):.0f} с\n\n"
+        f"⚡ Скорость: {rate:.1f} сообщ./с (цель {float(control.get('rate', 0)):g})\n"
+        f"🕒 Осталось: {format_duration(eta) if eta is not None else '—'}"
+    )
+
+    if state in ("done", "cancelled", "failed"):
+        return text, None
+    toggle = (InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"mailing_resume:{campaign_id}")
+              if state == "paused" else
+              InlineKeyboardButton(text="⏸ Пауза", callback_data=f"mailing_pause:{campaign_id}"))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [toggle, InlineKeyboardButton(text="⏹ Отменить", callback_data=f"mailing_cancel:{campaign_id}")],
+        [InlineKeyboardButton(text="➖ 5 сообщ./с", callback_data=f"mailing_rate:{campaign_id}:-5"),
+         InlineKeyboardButton(text="➕ 5 сообщ./с", callback_data=f"mailing_rate:{campaign_id}:5")],
+    ])
+    return text, keyboard
@@ -0,0 +1,96 @@
+import asyncio
+
+
+class RateLimiter:
+    """ Раздаёт слоты на отправку не чаще rate сообщений в секунду для всех корутин рассылки """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self.retry_after_total = 0.0  # Сколько секунд ожидания TelegramRetryAfter получено, для прогресса
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, value):
+        if value <= 0:
+            raise ValueError("Скорость рассылки должна быть больше нуля")
+        self._rate = value
+        self._interval = 1 / value
+
+    async def pause(self, seconds):
+        # TelegramRetryAfter относится ко всему токену, поэтому останавливаем всех отправителей сразу
+        loop = asyncio.get_running_loop()
+        self._paused_until = max(self._paused_until, loop.time() + seconds)
+        self.retry_after_total += seconds
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self._interval
+            if slot > now:
+                await asyncio.sleep(slot - now)
+
+            # Пока ждали свой слот, кто-то мог получить RetryAfter
+            if self._paused_until <= loop.time():
+                return
+
+
+class RedisRateLimiter:
+    """ Тот же темп, но общий для всех процессов: слоты раздаются атомарно в Redis (GCRA) """
+
+    # KEYS[1] — время следующего свободного слота (мс), KEYS[2] — пауза после TelegramRetryAfter
+    script = """
+        local now = redis.call('TIME')
+        local now_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+        local slot = tonumber(redis.call('GET', KEYS[1]) or now_ms)
+        if slot < now_ms then
+            slot = now_ms
+        end
+        local paused = redis.call('PTTL', KEYS[2])
+        if paused > 0 and slot < now_ms + paused then
+            slot = now_ms + paused
+        end
+        local next_slot = slot + 1000 / tonumber(ARGV[1])
+        redis.call('SET', KEYS[1], tostring(next_slot), 'PX', math.ceil(next_slot - now_ms) + 60000)
+        return math.ceil(slot - now_ms)
+    """
+
+    def __init__(self, redis, key, rate, pause_key="telegram:retry_after"):
+        self.redis = redis
+        self.key = key
+        self.pause_key = pause_key
+        self.rate = rate
+        self.retry_after_total = 0.0
+        self._acquire = redis.register_script(self.script)
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, value):
+        if value <= 0:
+            raise ValueError("Скорость рассылки должна быть больше нуля")
+        self._rate = value
+
+    async def pause(self, seconds):
+        # Пауза общая для всех кампаний, воркеров и бота (см. ApiRateLimitMiddleware): ограничение действует на весь токен
+        self.retry_after_total += seconds
+        current = await self.redis.pttl(self.pause_key)
+        if current < seconds * 1000:
+            await self.redis.set(self.pause_key, 1, px=int(seconds * 1000))
+
+    async def acquire(self):
+        delay_ms = await self._acquire(keys=[self.key, self.pause_key], args=[self.rate])
+        if delay_ms > 0:
+            await asyncio.sleep(delay_ms / 1000)
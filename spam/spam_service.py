@@ -1,17 +1,25 @@
+import json
 import logging
 import asyncio
 import aiomysql
 from aiogram import Bot
 from aiogram.exceptions import TelegramRetryAfter, TelegramAPIError, TelegramForbiddenError
+from redis.asyncio import Redis
+from spam.status_writer import StatusWriter
+from spam.suppression import SuppressionSet
 
 class SpamService:
-    def __init__(self, db_config, redis_config, bot_instance, initial_delay=0.05, max_delay=1.0):
+    def __init__(self, db_config, redis_config, bot_instance, max_attempts=3, redis=None, pool_minsize=1,
+                 pool_maxsize=12):
         self.db_config = db_config
         self.redis_config = redis_config
         self.bot = bot_instance
         self.pool = None
-        self.delay = initial_delay  # Начальная задержка между отправками сообщений
-        self.max_delay = max_delay  # Максимальная задержка между отправками сообщений
+        self.redis = redis
+        self.suppression = None
+        self.max_attempts = max_attempts  # Сколько раз пробуем отправить сообщение после TelegramRetryAfter
+        self.pool_minsize = pool_minsize
+        self.pool_maxsize = pool_maxsize
 
     async def connect(self):
         attempt = 0
@@ -26,28 +34,139 @@ class SpamService:
                         user=self.db_config['user'],
                         password=self.db_config['password'],
                         db=self.db_config['database'],
-                        minsize=10,
-                        maxsize=120
+                        minsize=self.pool_minsize,
+                        maxsize=self.pool_maxsize
                     )
 
-                    async with self.pool.acquire() as conn:
-                        async with conn.cursor() as cursor:
-                            await cursor.execute(f"USE {self.db_config['database']};")
+                    try:
+                        async with self.pool.acquire() as conn:
+                            async with conn.cursor() as cursor:
+                                await cursor.execute(f"USE {self.db_config['database']};")
 
+                        await self.ensure_tables()
+                        await self.ensure_indexes()
+                    except Exception:
+                        # Без таблиц и уникального ключа рассылка не должна стартовать: закрываем пул,
+                        # чтобы следующая попытка снова прошла всю подготовку схемы
+                        pool, self.pool = self.pool, None
+                        pool.close()
+                        await pool.wait_closed()
+                        raise
                     logging.info("Соединение с базой данных установлено.")
-                    break
+                if not self.redis:
+                    # Redis хранит общий для всех шардов бюджет отправки
+                    self.redis = Redis(host=self.redis_config['host'], port=self.redis_config['port'],
+                                       password=self.redis_config['password'])
+                if not self.suppression:
+                    suppression = SuppressionSet(self.redis, self.pool)
+                    await suppression.ensure_table()
+                    await suppression.ensure_loaded()
+                    self.suppression = suppression
+                break
             except Exception as e:
                 attempt += 1
                 logging.error(f"Ошибка при подключении к базе данных (попытка {attempt}): {e}")
                 await asyncio.sleep(5)
+        else:
+            raise RuntimeError(f"Не удалось подключиться к базе данных после {attempt} попыток")
 
-    async def record_message_status(self, user_id, language, message, photo, status, campaign_id):
+    async def close(self):
+        if self.pool:
+            self.pool.close()
+            await self.pool.wait_closed()
+            self.pool = None
+        if self.redis:
+            await self.redis.aclose()
+            self.redis = None
+        logging.info("Соединения сервиса рассылки закрыты.")
+
+    async def ensure_tables(self):
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cursor:
+                # Кампания и её итоговые счётчики; shards_left — сколько шардов ещё не закончили
+                await cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS campaigns (
+                        campaign_id VARCHAR(36) PRIMARY KEY,
+                        language VARCHAR(8) NOT NULL,
+                        photo VARCHAR(255) NULL,
+                        caption TEXT NULL,
+                        keyboard TEXT NULL,
+                        rate FLOAT NOT NULL,
+                        status VARCHAR(16) NOT NULL DEFAULT 'running',
+                        shards_left INT NULL,
+                        sent_count INT NOT NULL DEFAULT 0,
+                        failed_count INT NOT NULL DEFAULT 0,
+                        blocked_count INT NOT NULL DEFAULT 0,
+                        created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+                    )
+                """)
+                # Диапазон пользователей (start_after, end_id] с собственным курсором: перезапущенный
+                # шард продолжает с last_user_id; token — владелец шарда, чтобы его не выполняли дважды
+                await cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS campaign_shards (
+                        campaign_id VARCHAR(36) NOT NULL,
+                        shard_no INT NOT NULL,
+                        start_after BIGINT NOT NULL,
+                        end_id BIGINT NULL,
+                        token VARCHAR(36) NULL,
+                        status VARCHAR(16) NOT NULL DEFAULT 'running',
+                        last_user_id BIGINT NOT NULL,
+                        sent_count INT NOT NULL DEFAULT 0,
+                        failed_count INT NOT NULL DEFAULT 0,
+                        blocked_count INT NOT NULL DEFAULT 0,
+                        updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                        PRIMARY KEY (campaign_id, shard_no)
+                    )
+                """)
+                # claim_token — запуск шарда, закрепивший получателя: по нему claim_recipients читает свои строки
                 await cursor.execute(
-                    "INSERT INTO messages (user_id, language, message, photo, status, campaign_id) VALUES (%s, %s, %s, %s, %s, %s)",
-                    (user_id, language, message, photo, status, campaign_id)
-                )
+                    "SELECT COUNT(1) FROM INFORMATION_SCHEMA.COLUMNS "
+                    "WHERE table_schema=DATABASE() AND table_name='messages' AND column_name='claim_token'")
+                if (await cursor.fetchone())[0] == 0:
+                    await cursor.execute("ALTER TABLE messages ADD COLUMN claim_token VARCHAR(36) NULL")
+                await conn.commit()
+
+    async def ensure_indexes(self):
+        index_queries = [
+            # Уникальный ключ нужен для INSERT ... ON DUPLICATE KEY UPDATE в StatusWriter
+            ("messages", "uq_messages_campaign_user", "UNIQUE", "campaign_id, user_id"),
+            # Постраничный обход аудитории по языку: WHERE language = %s AND user_id > %s ORDER BY user_id
+            ("users", "idx_language_user_id", "", "language, user_id"),
+        ]
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                for table, index_name, kind, columns in index_queries:
+                    await cursor.execute(
+                        "SELECT COUNT(1) FROM INFORMATION_SCHEMA.STATISTICS "
+                        "WHERE table_schema=DATABASE() AND table_name=%s AND index_name=%s", (table, index_name))
+                    index_is_there = await cursor.fetchone()
+                    if index_is_there[0] == 0:
+                        if kind == "UNIQUE":
+                            await self._remove_duplicates(cursor, table, columns)
+                        await cursor.execute(f"CREATE {kind} INDEX {index_name} ON {table} ({columns})")
+                await conn.commit()
+
+    @staticmethod
+    async def _remove_duplicates(cursor, table, columns):
+        """ Оставляет по одной строке на значение уникального ключа, иначе CREATE UNIQUE INDEX упадёт.
+        Старая рассылка при повторе вставляла вторую строку pending, поэтому удаляем в первую очередь их """
+        await cursor.execute(
+            f"SELECT {columns}, COUNT(*) FROM {table} GROUP BY {columns} HAVING COUNT(*) > 1")
+        duplicates = await cursor.fetchall()
+        names = [name.strip() for name in columns.split(",")]
+        condition = " AND ".join(f"{name} = %s" for name in names)
+        for *values, count in duplicates:
+            await cursor.execute(
+                f"DELETE FROM {table} WHERE {condition} ORDER BY status = 'pending' DESC LIMIT %s",
+                (*values, count - 1))
+        if duplicates:
+            logging.warning(f"Удалены повторы в {table} по ({columns}): {len(duplicates)} ключей")
+
+    async def record_message_status(self, user_id, language, message, photo, status, campaign_id):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(StatusWriter.query, (user_id, language, message, photo, status, campaign_id))
                 await conn.commit()
 
     async def update_message_status(self, user_id, status, campaign_id):
@@ -59,45 +178,312 @@ class SpamService:
                 )
                 await conn.commit()
 
-    async def get_user_ids_by_language(self, language=None):
-        query = "SELECT user_id FROM users WHERE language=%s" if language else "SELECT user_id FROM users"
-        logging.info(f"Используемый запрос: {query}")
+    def _audience_filter(self, language, after_id, until_id=None):
+        query = "FROM users WHERE user_id > %s"
+        params = [after_id]
+        if until_id is not None:
+            query += " AND user_id <= %s"
+            params.append(until_id)
+        if language:
+            query += " AND language=%s"
+            params.append(language)
+        return query, params
+
+    async def iter_user_ids_by_language(self, language=None, after_id=0, until_id=None, page_size=500):
+        """ Отдаёт аудиторию страницами по keyset (user_id > последнего), не загружая её целиком """
+        while True:
+            condition, params = self._audience_filter(language, after_id, until_id)
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(f"SELECT user_id {condition} ORDER BY user_id LIMIT %s", (*params, page_size))
+                    page = [row[0] for row in await cursor.fetchall()]
+            if not page:
+                return
+            yield page
+            if len(page) < page_size:
+                return
+            after_id = page[-1]
+
+    async def get_user_ids_by_language(self, language=None, after_id=0, until_id=None):
+        user_ids = []
+        async for page in self.iter_user_ids_by_language(language, after_id, until_id):
+            user_ids.extend(page)
+        logging.info(f"Получены идентификаторы пользователей: {len(user_ids)}")
+        return user_ids
+
+    async def count_audience(self, language=None):
+        condition, params = self._audience_filter(language, 0)
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cursor:
-                await cursor.execute(query, (language,) if language else ())
-                user_ids = [row[0] for row in await cursor.fetchall()]
-                logging.info(f"Получены идентификаторы пользователей: {len(user_ids)}")
-                return user_ids
+                await cursor.execute(f"SELECT COUNT(*) {condition}", params)
+                return (await cursor.fetchone())[0]
 
-    async def send_message(self, user_id, language, caption, photo=None, campaign_id=None, keyboard=None):
-        try:
-            # Добавляем запись сообщения в базу данных перед отправкой
-            await self.record_message_status(user_id, language, caption, photo, "pending", campaign_id)
+    async def get_shard_bounds(self, language, shard_size):
+        """ Делит аудиторию на диапазоны (start_after, end_id] примерно по shard_size пользователей """
+        bounds = []
+        after_id = 0
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                while True:
+                    condition, params = self._audience_filter(language, after_id)
+                    await cursor.execute(f"SELECT user_id {condition} ORDER BY user_id LIMIT 1 OFFSET %s",
+                                         (*params, shard_size - 1))
+                    row = await cursor.fetchone()
+                    if not row:
+                        break
+                    bounds.append((after_id, row[0]))
+                    after_id = row[0]
+                # Последний шард открыт сверху: в него попадут и пользователи, пришедшие во время рассылки
+                await cursor.execute(f"SELECT 1 {condition} LIMIT 1", params)
+                if await cursor.fetchone():
+                    bounds.append((after_id, None))
+        return bounds
+
+    async def get_or_create_campaign(self, campaign_id, language, photo, caption, keyboard_data, rate):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                await cursor.execute(
+                    "INSERT IGNORE INTO campaigns (campaign_id, language, photo, caption, keyboard, rate) "
+                    "VALUES (%s, %s, %s, %s, %s, %s)",
+                    (campaign_id, language, photo, caption, json.dumps(keyboard_data) if keyboard_data else None, rate)
+                )
+                await conn.commit()
+                await cursor.execute("SELECT * FROM campaigns WHERE campaign_id = %s", (campaign_id,))
+                return await cursor.fetchone()
+
+    async def get_campaign(self, campaign_id):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                await cursor.execute("SELECT * FROM campaigns WHERE campaign_id = %s", (campaign_id,))
+                return await cursor.fetchone()
+
+    async def get_or_create_shards(self, campaign_id, bounds_factory):
+        """ Возвращает шарды кампании; при первом запуске создаёт их из bounds_factory() """
+        async with self.pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                await cursor.execute("SELECT shards_left FROM campaigns WHERE campaign_id = %s", (campaign_id,))
+                campaign = await cursor.fetchone()
+                if campaign['shards_left'] is None:
+                    bounds = await bounds_factory()
+                    await cursor.executemany(
+                        "INSERT INTO campaign_shards (campaign_id, shard_no, start_after, end_id, last_user_id) "
+                        "VALUES (%s, %s, %s, %s, %s)",
+                        [(campaign_id, shard_no, start_after, end_id, start_after)
+                         for shard_no, (start_after, end_id) in enumerate(bounds)]
+                    )
+                    await cursor.execute("UPDATE campaigns SET shards_left = %s WHERE campaign_id = %s",
+                                         (len(bounds), campaign_id))
+                    await conn.commit()
+                await cursor.execute("SELECT * FROM campaign_shards WHERE campaign_id = %s ORDER BY shard_no",
+                                     (campaign_id,))
+                return await cursor.fetchall()
+
+    async def acquire_shard(self, campaign_id, shard_no, token):
+        """ Закрепляет шард за токеном сообщения; None, если шард уже выполняет другое сообщение или он завершён """
+        async with self.pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                await cursor.execute(
+                    "UPDATE campaign_shards SET token = %s "
+                    "WHERE campaign_id = %s AND shard_no = %s AND status = 'running' AND token IS NULL",
+                    (token, campaign_id, shard_no)
+                )
+                await conn.commit()
+                await cursor.execute(
+                    "SELECT * FROM campaign_shards WHERE campaign_id = %s AND shard_no = %s AND token = %s "
+                    "AND status = 'running'",
+                    (campaign_id, shard_no, token)
+                )
+                return await cursor.fetchone()
+
+    async def claim_recipients(self, campaign_id, user_ids, language, caption, photo, claim_token):
+        """ Закрепляет получателей страницы за запуском шарда claim_token и возвращает тех, кого закрепил именно он """
+        if not user_ids:
+            return []
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                # Строка pending по уникальному ключу (campaign_id, user_id) — гарантия «не больше одного раза».
+                # executemany собирает один многострочный INSERT IGNORE; чужие строки он не трогает
+                await cursor.executemany(
+                    "INSERT IGNORE INTO messages (user_id, language, message, photo, status, campaign_id, claim_token) "
+                    "VALUES (%s, %s, %s, %s, 'pending', %s, %s)",
+                    [(user_id, language, caption, photo, campaign_id, claim_token) for user_id in user_ids]
+                )
+                await conn.commit()
+                placeholders = ", ".join(["%s"] * len(user_ids))
+                await cursor.execute(
+                    f"SELECT user_id FROM messages WHERE campaign_id = %s AND claim_token = %s "
+                    f"AND user_id IN ({placeholders}) ORDER BY user_id",
+                    (campaign_id, claim_token, *user_ids)
+                )
+                return [row[0] for row in await cursor.fetchall()]
+
+    async def get_pending_recipients(self, campaign_id, after_id, until_id):
+        """ Получатели из (after_id, until_id], закреплённые прошлым запуском шарда, но не получившие итоговый статус:
+        курсор уже прошёл их, а запуск оборвался до отправки или записи статуса """
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    "SELECT user_id FROM messages WHERE campaign_id = %s AND status = 'pending' "
+                    "AND user_id > %s AND user_id <= %s ORDER BY user_id",
+                    (campaign_id, after_id, until_id)
+                )
+                return [row[0] for row in await cursor.fetchall()]
+
+    async def release_recipients(self, campaign_id, user_ids):
+        """ Снимает закрепление с получателей, до которых не дошла очередь из-за паузы или отмены """
+        if not user_ids:
+            return
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                placeholders = ", ".join(["%s"] * len(user_ids))
+                await cursor.execute(
+                    f"DELETE FROM messages WHERE campaign_id = %s AND status = 'pending' AND user_id IN ({placeholders})",
+                    (campaign_id, *user_ids)
+                )
+                await conn.commit()
 
-            # Отправка сообщения с использованием HTML форматирования
-            if photo:
-                await self.bot.send_photo(user_id, photo=photo, caption=caption, reply_markup=keyboard,
-                                          parse_mode="HTML")
+    async def save_checkpoint(self, campaign_id, shard_no, last_user_id, counters):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    # updated_at обновляем явно: отметка нужна и тогда, когда курсор стоит (шард на паузе),
+                    # иначе reclaim_stale_shards сочтёт живой шард брошенным
+                    "UPDATE campaign_shards SET last_user_id = %s, sent_count = %s, failed_count = %s, "
+                    "blocked_count = %s, updated_at = CURRENT_TIMESTAMP WHERE campaign_id = %s AND shard_no = %s",
+                    (last_user_id, counters['sent'], counters['failed'], counters['blocked'], campaign_id, shard_no)
+                )
+                await conn.commit()
+
+    async def reclaim_stale_shards(self, campaign_id, stale_after):
+        """ Снимает владельца с шардов, чей курсор не двигался stale_after секунд, и возвращает их номера:
+        воркер с ними упал, и без нового сообщения shards_left никогда не дойдёт до нуля """
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    "SELECT shard_no FROM campaign_shards WHERE campaign_id = %s AND status = 'running' "
+                    "AND updated_at < NOW() - INTERVAL %s SECOND FOR UPDATE",
+                    (campaign_id, stale_after)
+                )
+                shard_nos = [row[0] for row in await cursor.fetchall()]
+                if shard_nos:
+                    placeholders = ", ".join(["%s"] * len(shard_nos))
+                    # Новая отметка времени: следующий reclaim этого шарда — не раньше чем через stale_after
+                    await cursor.execute(
+                        f"UPDATE campaign_shards SET token = NULL, updated_at = CURRENT_TIMESTAMP "
+                        f"WHERE campaign_id = %s AND shard_no IN ({placeholders})",
+                        (campaign_id, *shard_nos)
+                    )
+                await conn.commit()
+                return shard_nos
+
+    async def finish_shard(self, campaign_id, shard_no, last_user_id, counters):
+        """ Завершает шард; для последнего шарда закрывает кампанию и возвращает её суммарные счётчики """
+        async with self.pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                await cursor.execute(
+                    "UPDATE campaign_shards SET status = 'done', last_user_id = %s, sent_count = %s, "
+                    "failed_count = %s, blocked_count = %s "
+                    "WHERE campaign_id = %s AND shard_no = %s AND status = 'running'",
+                    (last_user_id, counters['sent'], counters['failed'], counters['blocked'], campaign_id, shard_no)
+                )
+                if cursor.rowcount == 0:
+                    await conn.commit()
+                    return None
+
+                await cursor.execute("UPDATE campaigns SET shards_left = shards_left - 1 WHERE campaign_id = %s",
+                                     (campaign_id,))
+                await cursor.execute("SELECT shards_left FROM campaigns WHERE campaign_id = %s FOR UPDATE",
+                                     (campaign_id,))
+                if (await cursor.fetchone())['shards_left'] > 0:
+                    await conn.commit()
+                    return None
+
+                totals = await self._close_campaign(cursor, campaign_id)
+                await conn.commit()
+                return totals
+
+    async def finish_campaign(self, campaign_id):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                totals = await self._close_campaign(cursor, campaign_id)
+                await conn.commit()
+                return totals
+
+    async def fail_campaign(self, campaign_id):
+        """ Закрывает кампанию как failed вместе с незавершёнными шардами; None, если она уже закрыта.
+        Сообщения шардов после этого не возьмут шард, а finish_shard их запусков ничего не изменит """
+        async with self.pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                await cursor.execute("SELECT status FROM campaigns WHERE campaign_id = %s FOR UPDATE", (campaign_id,))
+                campaign = await cursor.fetchone()
+                if not campaign or campaign['status'] != 'running':
+                    await conn.commit()
+                    return None
+                await cursor.execute(
+                    "UPDATE campaign_shards SET status = 'failed' WHERE campaign_id = %s AND status = 'running'",
+                    (campaign_id,)
+                )
+                await cursor.execute("UPDATE campaigns SET shards_left = 0 WHERE campaign_id = %s", (campaign_id,))
+                totals = await self._close_campaign(cursor, campaign_id, status='failed')
+                await conn.commit()
+                return totals
+
+    async def _close_campaign(self, cursor, campaign_id, status='done'):
+        await cursor.execute(
+            "SELECT COALESCE(SUM(sent_count), 0) AS sent, COALESCE(SUM(failed_count), 0) AS failed, "
+            "COALESCE(SUM(blocked_count), 0) AS blocked FROM campaign_shards WHERE campaign_id = %s",
+            (campaign_id,)
+        )
+        totals = {key: int(value) for key, value in (await cursor.fetchone()).items()}
+        await cursor.execute(
+            "UPDATE campaigns SET status = %s, sent_count = %s, failed_count = %s, blocked_count = %s "
+            "WHERE campaign_id = %s",
+            (status, totals['sent'], totals['failed'], totals['blocked'], campaign_id)
+        )
+        return totals
+
+    async def deliver(self, user_id, caption, photo=None, keyboard=None):
+        # Отправка сообщения с использованием HTML форматирования
+        if photo:
+            await self.bot.send_photo(user_id, photo=photo, caption=caption, reply_markup=keyboard,
+                                      parse_mode="HTML")
+        else:
+            await self.bot.send_message(user_id, caption, reply_markup=keyboard, parse_mode="HTML")
+
+    async def send_message(self, user_id, language, caption, photo=None, campaign_id=None, keyboard=None,
+                           limiter=None, status_writer=None):
+        """ Отправляет сообщение и возвращает итоговый статус: sent, failed или blocked """
+        status = "failed"
+        try:
+            for attempt in range(self.max_attempts):
+                if limiter:
+                    await limiter.acquire()
+                try:
+                    await self.deliver(user_id, caption, photo, keyboard)
+                    status = "sent"
+                    logging.info(f"Сообщение успешно отправлено пользователю {user_id}")
+                    break
+                except TelegramRetryAfter as e:
+                    logging.warning(f"Повторная попытка через {e.retry_after} секунд для пользователя {user_id}")
+                    if limiter:
+                        await limiter.pause(e.retry_after)
+                    else:
+                        await asyncio.sleep(e.retry_after)
             else:
-                await self.bot.send_message(user_id, caption, reply_markup=keyboard, parse_mode="HTML")
-
-            # Обновляем статус сообщения в базе данных после успешной отправки
-            await self.update_message_status(user_id, "sent", campaign_id)
-            logging.info(f"Сообщение успешно отправлено пользователю {user_id}")
-            self.delay = max(self.delay / 2, 0.05)  # Снижаем задержку после успешной отправки
-        except TelegramRetryAfter as e:
-            logging.warning(f"Повторная попытка через {e.retry_after} секунд для пользователя {user_id}")
-            self.delay = min(self.delay * 2, self.max_delay)  # Увеличиваем задержку при ошибке по лимитам
-            await asyncio.sleep(e.retry_after)
-            await self.send_message(user_id, caption, photo, campaign_id, keyboard)
-        except TelegramForbiddenError as e:
+                logging.error(f"Сообщение пользователю {user_id} не доставлено после {self.max_attempts} попыток.")
+        except TelegramForbiddenError:
             logging.error(f"Бот был заблокирован пользователем {user_id}. Пропускаем.")
-            await self.update_message_status(user_id, "failed", campaign_id)
+            status = "blocked"
         except TelegramAPIError as e:
             logging.error(f"Ошибка API Telegram: {e}. Сообщение пользователю {user_id} не доставлено.")
-            await self.update_message_status(user_id, "failed", campaign_id)
         except Exception as e:
             logging.error(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
-            await self.update_message_status(user_id, "failed", campaign_id)
-        finally:
-            await asyncio.sleep(self.delay)  # Используем текущую задержку перед отправкой следующего сообщенияисправь оба кода
\ No newline at end of file
+
+        # Одна запись итогового статуса вместо pending + UPDATE; при рассылке — через буфер StatusWriter
+        if status_writer:
+            await status_writer.add(user_id, language, caption, photo, status, campaign_id)
+        else:
+            await self.record_message_status(user_id, language, caption, photo, status, campaign_id)
+            if status == "blocked" and self.suppression:
+                await self.suppression.add_many([user_id])
+        return status
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+
+
+class StatusWriter:
+    """ Копит итоговые статусы рассылки и пишет их в messages пачками: каждые batch_size строк или flush_interval секунд """
+
+    query = (
+        "INSERT INTO messages (user_id, language, message, photo, status, campaign_id) "
+        "VALUES (%s, %s, %s, %s, %s, %s) "
+        "ON DUPLICATE KEY UPDATE status = VALUES(status)"
+    )
+
+    def __init__(self, pool, batch_size=500, flush_interval=1.0, suppression=None, progress=None):
+        self.pool = pool
+        self.suppression = suppression
+        # CampaignProgress: записанные статусы снимают отметку «отправка начата»
+        self.progress = progress
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._rows = []
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_periodically())
+
+    async def add(self, user_id, language, message, photo, status, campaign_id):
+        self._rows.append((user_id, language, message, photo, status, campaign_id))
+        if len(self._rows) >= self.batch_size:
+            try:
+                await self.flush()
+            except Exception:
+                # Сообщение уже доставлено: ошибка записи не должна сделать его failed в send_message.
+                # flush вернул строки в буфер и записал ошибку в лог, их запишет следующий сброс
+                pass
+
+    async def flush(self):
+        async with self._lock:
+            if not self._rows:
+                return
+            rows, self._rows = self._rows, []
+            try:
+                async with self.pool.acquire() as conn:
+                    async with conn.cursor() as cursor:
+                        # executemany собирает из строк один многострочный INSERT
+                        await cursor.executemany(self.query, rows)
+                    await conn.commit()
+                logging.info(f"Записано статусов рассылки: {len(rows)}")
+            except Exception as e:
+                # Возвращаем строки в буфер, чтобы записать их при следующем сбросе
+                self._rows[:0] = rows
+                logging.error(f"Не удалось записать {len(rows)} статусов рассылки: {e}")
+                raise
+
+            if self.progress:
+                try:
+                    await self.progress.clear_inflight([row[0] for row in rows])
+                except Exception as e:
+                    logging.error(f"Не удалось снять отметки отправки с {len(rows)} получателей: {e}")
+
+            # Заблокировавших бота исключаем из следующих рассылок той же пачкой
+            blocked = [row[0] for row in rows if row[4] == "blocked"]
+            if blocked and self.suppression:
+                try:
+                    await self.suppression.add_many(blocked)
+                except Exception as e:
+                    logging.error(f"Не удалось добавить {len(blocked)} пользователей в список заблокировавших: {e}")
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                pass
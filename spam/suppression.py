@@ -0,0 +1,80 @@
+import logging
+
+
+class SuppressionSet:
+    """ Пользователи, заблокировавшие бота: таблица blocked_users и её зеркало в множестве Redis """
+
+    def __init__(self, redis, pool=None, prefix="suppressed"):
+        self.redis = redis
+        self.pool = pool
+        self.prefix = prefix
+        # Множество, а не битовая карта по user_id: id Telegram доходят до ~8e9 и разрежены, и карта
+        # тратила бы по 128 КБ на кусок ради единственного бита. Множество растёт только с числом заблокировавших
+        self.users_key = f"{prefix}:users"
+        self.loaded_key = f"{prefix}:users:loaded"
+
+    async def ensure_table(self):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS blocked_users (
+                        user_id BIGINT PRIMARY KEY,
+                        blocked_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+                await conn.commit()
+
+    async def ensure_loaded(self):
+        # Если Redis потерял зеркало, восстанавливаем его из таблицы
+        if await self.redis.exists(self.loaded_key):
+            return
+        after_id = 0
+        total = 0
+        while True:
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(
+                        "SELECT user_id FROM blocked_users WHERE user_id > %s ORDER BY user_id LIMIT 10000",
+                        (after_id,))
+                    user_ids = [row[0] for row in await cursor.fetchall()]
+            if not user_ids:
+                break
+            await self.redis.sadd(self.users_key, *user_ids)
+            total += len(user_ids)
+            after_id = user_ids[-1]
+        # Куски битовой карты прежнего формата «<prefix>:<номер куска>» больше не читаются
+        stale_keys = [key async for key in self.redis.scan_iter(match=f"{self.prefix}:[0-9]*")]
+        if stale_keys:
+            await self.redis.delete(*stale_keys)
+        await self.redis.set(self.loaded_key, 1)
+        logging.info(f"Список заблокировавших бота загружен в Redis: {total} пользователей")
+
+    async def add_many(self, user_ids):
+        if not user_ids:
+            return
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.executemany("INSERT IGNORE INTO blocked_users (user_id) VALUES (%s)",
+                                         [(user_id,) for user_id in user_ids])
+                await conn.commit()
+        await self.redis.sadd(self.users_key, *user_ids)
+
+    async def remove(self, user_id):
+        # /start присылают часто, а заблокированных среди них мало: в базу идём только за ними
+        if await self.filter([user_id]):
+            return
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("DELETE FROM blocked_users WHERE user_id = %s", (user_id,))
+                await conn.commit()
+        await self.redis.srem(self.users_key, user_id)
+
+    async def filter(self, user_ids):
+        """ Убирает из страницы аудитории заблокировавших бота — один запрос к Redis на всю страницу """
+        if not user_ids:
+            return []
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.sismember(self.users_key, user_id)
+        flags = await pipe.execute()
+        return [user_id for user_id, suppressed in zip(user_ids, flags) if not suppressed]
@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import threading
+
+import dramatiq
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from redis.asyncio import Redis
+
+from config import db_config, redis_config, TOKEN, TELEGRAM_API_SERVER, MAILING_DB_POOL_MIN, MAILING_DB_POOL_MAX
+from middlewares.ApiRateLimitMiddleware import ApiRateLimitMiddleware
+from spam.spam_service import SpamService
+
+
+class WorkerContext:
+    """ Ресурсы одного потока воркера: event loop, сессия Bot и SpamService с пулами MySQL и Redis """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.redis = Redis(host=redis_config['host'], port=redis_config['port'], password=redis_config['password'])
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_SERVER)) if TELEGRAM_API_SERVER else None
+        self.bot = Bot(token=TOKEN, session=session)
+        # Рассылка идёт с низким приоритетом: часть общего лимита токена остаётся ответам бота
+        self.bot.session.middleware(ApiRateLimitMiddleware(self.redis, bulk=True))
+        self.spam_service = SpamService(db_config, redis_config, self.bot, redis=self.redis,
+                                        pool_minsize=MAILING_DB_POOL_MIN, pool_maxsize=MAILING_DB_POOL_MAX)
+
+    def run(self, coro):
+        task = self.loop.create_task(coro)
+        try:
+            return self.loop.run_until_complete(task)
+        except BaseException:
+            # TimeLimitExceeded и Shutdown Dramatiq бросает прямо в поток: отменяем задачу и даём
+            # её finally-блокам (сброс буферов статусов) доработать в том же цикле
+            if not task.done():
+                task.cancel()
+                try:
+                    self.loop.run_until_complete(task)
+                except BaseException:
+                    pass
+            raise
+
+    def close(self):
+        try:
+            self.loop.run_until_complete(self.spam_service.close())
+            self.loop.run_until_complete(self.bot.session.close())
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+        except Exception as e:
+            logging.error(f"Error while closing worker resources: {e}")
+        finally:
+            self.loop.close()
+
+
+class WorkerResources(dramatiq.Middleware):
+    """ Каждый поток воркера держит один WorkerContext на все свои сообщения вместо asyncio.run на каждое """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def current(self):
+        context = getattr(self._local, "context", None)
+        if context is None:
+            context = self._local.context = WorkerContext()
+        return context
+
+    def run(self, coro):
+        return self.current().run(coro)
+
+    def after_worker_thread_boot(self, broker, thread):
+        self.current()
+
+    def before_worker_thread_shutdown(self, broker, thread):
+        context = getattr(self._local, "context", None)
+        if context is not None:
+            context.close()
+            self._local.context = None